@@ -0,0 +1,327 @@
+import srez_eval
+import srez_input
+import srez_model
+import srez_parallel
+
+import os.path
+import time
+import numpy as np
+import tensorflow as tf
+
+FLAGS = tf.app.flags.FLAGS
+
+def _images_per_second(sess, fetches, warmup_batches, feed_dict=None, batch_size=None):
+    """Throughput of `fetches` in images per second, after some warm-up batches"""
+
+    if batch_size is None:
+        batch_size = FLAGS.batch_size
+
+    for _ in range(warmup_batches):
+        sess.run(fetches, feed_dict=feed_dict)
+
+    start_time = time.time()
+    for _ in range(FLAGS.bench_batches):
+        sess.run(fetches, feed_dict=feed_dict)
+
+    return FLAGS.bench_batches * batch_size / (time.time() - start_time)
+
+def bench_input(filenames):
+    """Compares the images/s delivered by the queue-runner and tf.data input pipelines"""
+
+    pipelines = [('queue',         lambda sess: srez_input.setup_queue_inputs(sess, filenames)),
+                 ('dataset',       lambda sess: srez_input.setup_dataset_inputs(sess, filenames, cache=False)),
+                 ('dataset+cache', lambda sess: srez_input.setup_dataset_inputs(sess, filenames, cache=True))]
+
+    if FLAGS.input_shards:
+        pipelines.append(('shards', lambda sess: srez_input.setup_shard_inputs(sess, FLAGS.input_shards, 'train')))
+
+    # Enough batches to fill the queues, and the cache with a whole epoch
+    warmup_batches = max(10, len(filenames) // FLAGS.batch_size + 1)
+
+    results = {}
+    for name, setup in pipelines:
+        with tf.Graph().as_default():
+            sess = tf.Session()
+            features, labels = setup(sess)
+
+            results[name] = _images_per_second(sess, [features, labels], warmup_batches)
+            sess.close()
+
+        print("    %-14s %8.1f images/s" % (name, results[name]))
+
+    return results
+
+def _psnr(a, b):
+    # Per image, for floats in [0, 1]
+    mse = np.square(a - b).mean(axis=(1, 2, 3))
+    return 10. * np.log10(1. / np.maximum(mse, 1e-10))
+
+def _decoded_batch(filenames, decode):
+    # Batches of `decode` applied to the encoded files, repeating forever
+    dataset = tf.data.Dataset.from_tensor_slices(filenames).repeat()
+    dataset = dataset.map(lambda filename: decode(tf.read_file(filename)),
+                          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.batch(FLAGS.batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+    return dataset.make_one_shot_iterator().get_next()
+
+def bench_decode(filenames):
+    """Compares JPEG decoding at 1/2, 1/4 and 1/8 scale with decoding at full
+    size followed by resize_area.
+
+    Reports the PSNR of the scaled crops against the resize_area reference,
+    both at crop size and 4x smaller, where they become generator inputs, and
+    the images/s of each way of decoding."""
+
+    num_batches = max(1, min(FLAGS.bench_batches, len(filenames) // FLAGS.batch_size))
+
+    results = {}
+    for ratio in srez_input.DECODE_RATIOS[1:]:
+        with tf.Graph().as_default():
+            sess = tf.Session()
+
+            scaled, reference = _decoded_batch(filenames, lambda value: srez_input.decode_crop_pair(value, ratio))
+
+            # Generator inputs are a further 4x area downscale
+            K    = 4
+            size = scaled.get_shape()[1].value
+            scaled_feature    = tf.image.resize_area(scaled,    [size//K, size//K])
+            reference_feature = tf.image.resize_area(reference, [size//K, size//K])
+
+            crop_psnr    = []
+            feature_psnr = []
+            for _ in range(num_batches):
+                values = sess.run([scaled, reference, scaled_feature, reference_feature])
+                crop_psnr.append(_psnr(values[0], values[1]))
+                feature_psnr.append(_psnr(values[2], values[3]))
+
+            crop_psnr    = np.concatenate(crop_psnr)
+            feature_psnr = np.concatenate(feature_psnr)
+
+            # Each way of decoding timed on its own
+            scaled_only    = _decoded_batch(filenames, lambda value: srez_input.decode_crop_pair(value, ratio)[0])
+            reference_only = _decoded_batch(filenames, lambda value: srez_input.decode_crop_pair(value, ratio)[1])
+
+            results[ratio] = {'crop_psnr_mean':    float(crop_psnr.mean()),
+                              'crop_psnr_min':     float(crop_psnr.min()),
+                              'feature_psnr_mean': float(feature_psnr.mean()),
+                              'feature_psnr_min':  float(feature_psnr.min()),
+                              'scaled':            _images_per_second(sess, scaled_only, 10),
+                              'resize_area':       _images_per_second(sess, reference_only, 10)}
+            sess.close()
+
+        print("    1/%d: crop PSNR %.2f dB mean, %.2f dB min; feature PSNR %.2f dB mean, %.2f dB min"
+              % (ratio, results[ratio]['crop_psnr_mean'], results[ratio]['crop_psnr_min'],
+                 results[ratio]['feature_psnr_mean'], results[ratio]['feature_psnr_min']))
+        print("         scaled decode %8.1f images/s, full decode + resize_area %8.1f images/s"
+              % (results[ratio]['scaled'], results[ratio]['resize_area']))
+
+    return results
+
+def bench_parallel(filenames):
+    """Training images/s with each number of workers in FLAGS.bench_workers,
+    and the speedup over the first one"""
+
+    port    = FLAGS.worker_port
+    results = {}
+    for num_workers in [int(n) for n in FLAGS.bench_workers.split(',')]:
+        with tf.Graph().as_default():
+            cluster = srez_parallel.LocalCluster(num_workers, port)
+            try:
+                sess  = tf.Session(cluster.target, config=srez_parallel.worker_config(num_workers))
+                names = srez_parallel.create_towers(filenames, num_workers)
+                sess.run(tf.global_variables_initializer())
+
+                step = [names['gene_minimize'], names['disc_minimize']]
+                feed = {names['learning_rate']: FLAGS.learning_rate_start}
+                batch_size = (FLAGS.batch_size // num_workers) * num_workers
+
+                results[num_workers] = _images_per_second(sess, step, 10, feed_dict=feed, batch_size=batch_size)
+                sess.close()
+            finally:
+                cluster.close()
+
+        # The training process keeps its port
+        port += num_workers
+
+        baseline = results[min(results)]
+        print("    %d workers %8.1f images/s, %.2fx" % (num_workers, results[num_workers],
+                                                         results[num_workers] / baseline))
+
+    return results
+
+# Generator inputs timed by bench_generator: (batch size, side in pixels)
+def _generator_inputs():
+    return [(FLAGS.batch_size, FLAGS.sample_size // 4), (1, 128)]
+
+# Convolutions, transposed convolutions and the depthwise half of separable ones
+_CONV_OPS = ('Conv2D', 'Conv2DBackpropInput', 'DepthwiseConv2dNative')
+
+def _conv_flops(sess, feed_dict):
+    """Floating point operations of the convolutions in the default graph, for `feed_dict`.
+
+    The shapes are only known at run time. Every multiply-add of a
+    convolution counts as two."""
+
+    convs = [op for op in tf.get_default_graph().get_operations() if op.type in _CONV_OPS]
+
+    # Pixels in the output, and multiply-adds per pixel
+    pixels = sess.run([tf.reduce_prod(tf.shape(op.outputs[0])[:3]) for op in convs], feed_dict=feed_dict)
+    macs   = [int(np.prod(op.inputs[1].get_shape().as_list())) for op in convs]
+
+    return 2 * sum(int(p) * m for p, m in zip(pixels, macs))
+
+def bench_generator():
+    """Compares the nearest neighbor and sub-pixel generator layouts: FLOPs and
+    CPU latency of the forward pass for each size of `_generator_inputs`.
+
+    Weights are random. Quality needs trained checkpoints of each layout,
+    compared with --run=evaluate and the matching --generator_upsample."""
+
+    results = {}
+    for upsample in ('nearest', 'subpixel'):
+        for batch_size, size in _generator_inputs():
+            with tf.Graph().as_default():
+                sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+
+                features = tf.placeholder(tf.float32, shape=[None, size, size, 3])
+                gene_output, gene_var_list = srez_model.create_generator(features, norm='batch',
+                                                                         upsample=upsample)
+                sess.run(tf.variables_initializer(gene_var_list))
+
+                feed = {features: np.random.uniform(size=[batch_size, size, size, 3])}
+                flops = _conv_flops(sess, feed)
+
+                # Per batch, not per image
+                latency = batch_size / _images_per_second(sess, gene_output, 3, feed_dict=feed,
+                                                          batch_size=batch_size)
+                sess.close()
+
+            results[(upsample, batch_size, size)] = {'flops':   flops,
+                                                     'latency': latency,
+                                                     'weights': sum(int(np.prod(v.get_shape().as_list()))
+                                                                    for v in gene_var_list)}
+
+            print("    %-8s %2d x %3dpx: %8.2f GFLOPs, %8.1fms, %d weights" %
+                  (upsample, batch_size, size, flops / 1e9, 1000 * latency,
+                   results[(upsample, batch_size, size)]['weights']))
+
+    return results
+
+def bench_batch_norm():
+    """Compares the unfused batch norm layer the models used to have with the
+    fused one: CPU time of a training step, and CPU latency of the generator
+    as served, for each size of `_generator_inputs`.
+
+    The unfused layer always normalizes by batch statistics, the fused one
+    uses its moving averages outside training, which the timed training
+    steps move off their initial values. Inputs and weights are random."""
+
+    results = {}
+    for fused in (False, True):
+        name = 'fused' if fused else 'unfused'
+
+        with tf.Graph().as_default():
+            sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+
+            size     = FLAGS.sample_size
+            features = tf.random_uniform([FLAGS.batch_size, size // 4, size // 4, 3])
+            labels   = tf.random_uniform([FLAGS.batch_size, size, size, 3])
+
+            [gene_minput, gene_moutput,
+             gene_output, gene_var_list,
+             disc_real_output, disc_fake_output, disc_var_list] = \
+                    srez_model.create_model(sess, features, labels, fused=fused)
+
+            # gene_moutput may use per-sample statistics
+            served, _ = srez_model.create_generator(gene_minput, norm='moving', fused=fused, reuse=True)
+
+            gene_loss = srez_model.create_generator_loss(disc_fake_output, gene_output, features)
+            disc_real_loss, disc_fake_loss = \
+                             srez_model.create_discriminator_loss(disc_real_output, disc_fake_output)
+            disc_loss = tf.add(disc_real_loss, disc_fake_loss, name='disc_loss')
+
+            (global_step, learning_rate, gene_minimize, disc_minimize) = \
+                    srez_model.create_optimizers(gene_loss, gene_var_list,
+                                                 disc_loss, disc_var_list)
+            sess.run(tf.global_variables_initializer())
+
+            step = [gene_minimize, disc_minimize]
+            feed = {learning_rate: FLAGS.learning_rate_start}
+            results[(name, 'step')] = FLAGS.batch_size / _images_per_second(sess, step, 3, feed_dict=feed)
+
+            print("    %-8s training step %8.1fms" % (name, 1000 * results[(name, 'step')]))
+
+            for batch_size, size in _generator_inputs():
+                feed = {gene_minput: np.random.uniform(size=[batch_size, size, size, 3])}
+
+                # Per batch, not per image
+                latency = batch_size / _images_per_second(sess, served, 3, feed_dict=feed,
+                                                          batch_size=batch_size)
+                results[(name, batch_size, size)] = latency
+
+                print("    %-8s %2d x %3dpx: %8.1fms" % (name, batch_size, size, 1000 * latency))
+
+            sess.close()
+
+    return results
+
+def _largest_activation(sess, feed_dict):
+    """Bytes of the largest convolution output in the default graph, for `feed_dict`"""
+
+    convs = [op for op in tf.get_default_graph().get_operations() if op.type in _CONV_OPS]
+    sizes = sess.run([tf.size(op.outputs[0]) for op in convs], feed_dict=feed_dict)
+
+    return max(int(size) * op.outputs[0].dtype.size for size, op in zip(sizes, convs))
+
+def bench_variants(filenames, variants):
+    """Compares generator variants, e.g. distilled students and their teacher:
+    PSNR and SSIM on `filenames`, then FLOPs, CPU latency and memory of the
+    forward pass for each size of `_generator_inputs`.
+
+    `variants` are (spec, checkpoint folder) pairs. Memory is given as the
+    bytes of the weights, and of the largest layer output, which grows with
+    the image and is the bulk of the working memory."""
+
+    results = {}
+    for spec, checkpoint_dir in variants:
+        checkpoint = tf.train.latest_checkpoint(checkpoint_dir)
+        if checkpoint is None:
+            raise FileNotFoundError("No checkpoint in `%s'" % (checkpoint_dir,))
+
+        quality = srez_eval.evaluate(filenames, [checkpoint], spec=spec,
+                                     cache_path=os.path.join(checkpoint_dir, srez_eval.CACHE_FILE))[checkpoint]
+
+        for batch_size, size in _generator_inputs():
+            with tf.Graph().as_default():
+                sess = tf.Session(config=tf.ConfigProto(device_count={'GPU': 0}))
+
+                features = tf.placeholder(tf.float32, shape=[None, size, size, 3])
+                gene_output, gene_var_list = srez_model.create_generator(features, spec=spec)
+                if FLAGS.inference_norm == 'moving':
+                    srez_model.check_moving_averages(checkpoint, gene_var_list)
+                tf.train.Saver(gene_var_list).restore(sess, checkpoint)
+
+                feed = {features: np.random.uniform(size=[batch_size, size, size, 3])}
+
+                # Per batch, not per image
+                latency = batch_size / _images_per_second(sess, gene_output, 3, feed_dict=feed,
+                                                          batch_size=batch_size)
+
+                result = {'psnr':       quality['generator_psnr'],
+                          'ssim':       quality['generator_ssim'],
+                          'flops':      _conv_flops(sess, feed),
+                          'latency':    latency,
+                          'weights':    sum(int(np.prod(v.get_shape().as_list())) * v.dtype.base_dtype.size
+                                            for v in gene_var_list),
+                          'activation': _largest_activation(sess, feed)}
+                sess.close()
+
+            results[(spec, batch_size, size)] = result
+
+            print("    %-24s %2d x %3dpx: %6.2f dB, SSIM %.3f, %8.2f GFLOPs, %8.1fms, "
+                  "%6.1fMB weights, %6.1fMB largest activation" %
+                  (spec, batch_size, size, result['psnr'], result['ssim'], result['flops'] / 1e9,
+                   1000 * result['latency'], result['weights'] / 2**20, result['activation'] / 2**20))
+
+    return results
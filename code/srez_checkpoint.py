@@ -0,0 +1,198 @@
+import json
+import os.path
+import threading
+import time
+
+import tensorflow as tf
+
+FLAGS = tf.app.flags.FLAGS
+
+class CheckpointManager(object):
+    """Saves training checkpoints without holding up the training loop.
+
+    Created once per training run. `save` only copies the variables out of
+    the session, and a background thread writes the copy through a graph and
+    saver of its own. Each checkpoint gets a prefix of its own,
+    `checkpoint-<global step>`, and only becomes visible when the `checkpoint`
+    state file naming it is replaced, so readers using
+    `tf.train.latest_checkpoint` never see a partly written one.
+
+    The `keep` most recent checkpoints are kept, plus the one with the best
+    metric passed to `save`, recorded in `best_checkpoint.json`. With `keep=0`
+    only the best one is, or the latest while there is no metric. Checkpoints
+    not named like the ones it writes, e.g. the legacy `checkpoint_new.txt`,
+    are never deleted."""
+
+    PREFIX    = 'checkpoint'
+    BEST_FILE = 'best_checkpoint.json'
+
+    def __init__(self, sess, checkpoint_dir, global_step, keep=5, higher_is_better=False, var_list=None):
+        assert keep >= 0
+
+        if var_list is None:
+            var_list = tf.global_variables()
+
+        self.sess             = sess
+        self.checkpoint_dir   = checkpoint_dir
+        self.keep             = keep
+        self.higher_is_better = higher_is_better
+
+        self._var_list    = var_list
+        self._global_step = global_step
+
+        # Restoring goes through the training graph, once
+        self._restore_saver = tf.train.Saver(var_list)
+
+        # Copies of the variables the writer thread saves from
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            self._copies = [tf.Variable(tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+                                        trainable=False, name=var.op.name)
+                            for var in var_list]
+            self._saver  = tf.train.Saver({var.op.name: copy for var, copy in zip(var_list, self._copies)},
+                                          max_to_keep=None)
+        self._writer_sess = tf.Session(graph=self._graph)
+
+        state = tf.train.get_checkpoint_state(checkpoint_dir)
+        self._checkpoints = [os.path.basename(path) for path in state.all_model_checkpoint_paths] if state else []
+        self._best        = self._read_best()
+
+        self._thread = None
+        self._error  = None
+        self.stalls  = []
+
+    def _read_best(self):
+        path = os.path.join(self.checkpoint_dir, self.BEST_FILE)
+        if not tf.gfile.Exists(path):
+            return None
+
+        with tf.gfile.GFile(path, 'r') as f:
+            return json.load(f)
+
+    def _write_best(self, best):
+        # Replaced in one rename, like the checkpoint state
+        path = os.path.join(self.checkpoint_dir, self.BEST_FILE)
+        with tf.gfile.GFile(path + '.tmp', 'w') as f:
+            json.dump(best, f)
+        tf.gfile.Rename(path + '.tmp', path, overwrite=True)
+
+    def _is_better(self, metric):
+        if self._best is None:
+            return True
+        if self.higher_is_better:
+            return metric > self._best['metric']
+        return metric < self._best['metric']
+
+    def latest(self):
+        """Path prefix of the latest committed checkpoint, or None"""
+        return tf.train.latest_checkpoint(self.checkpoint_dir)
+
+    def best(self):
+        """Path prefix and metric of the best checkpoint, or None"""
+
+        if self._best is None:
+            return None
+
+        return os.path.join(self.checkpoint_dir, self._best['checkpoint']), self._best['metric']
+
+    def restore(self, path=None):
+        """Restores the training variables from `path`, by default the latest checkpoint.
+
+        Returns False when there is no checkpoint to restore yet."""
+
+        if path is None:
+            path = self.latest()
+
+        if path is None:
+            print("    No checkpoint in %s, training from scratch" % (self.checkpoint_dir,))
+            return False
+
+        self._restore_saver.restore(self.sess, path)
+        print("    Restored %s" % (path,))
+        return True
+
+    def save(self, metric=None):
+        """Snapshots the variables and writes them in the background.
+
+        Waits for the previous checkpoint to be written first. Returns how long
+        the training loop was stalled, in seconds."""
+
+        start_time = time.time()
+        self.wait()
+
+        values, step = self.sess.run([self._var_list, self._global_step])
+
+        self._thread = threading.Thread(target=self._write, args=(values, int(step), metric),
+                                        name='checkpoint-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+        stall = time.time() - start_time
+        self.stalls.append(stall)
+        print("    Checkpoint %d snapshot taken, stalled training for %.3fs" % (step, stall))
+
+        return stall
+
+    def wait(self):
+        """Blocks until the checkpoint being written, if any, is committed"""
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        self.wait()
+        self._writer_sess.close()
+
+    def _write(self, values, step, metric):
+        try:
+            start_time = time.time()
+
+            for copy, value in zip(self._copies, values):
+                copy.load(value, self._writer_sess)
+
+            name = '%s-%d' % (self.PREFIX, step)
+            self._saver.save(self._writer_sess, os.path.join(self.checkpoint_dir, name),
+                             write_meta_graph=False, write_state=False)
+
+            # Commit
+            checkpoints = [c for c in self._checkpoints if c != name] + [name]
+            tf.train.update_checkpoint_state(self.checkpoint_dir, name, checkpoints)
+            self._checkpoints = checkpoints
+
+            if metric is not None and self._is_better(metric):
+                self._best = {'checkpoint': name, 'step': step, 'metric': float(metric)}
+                self._write_best(self._best)
+
+            self._apply_retention()
+
+            print("    Checkpoint %s written in %.2fs" % (name, time.time() - start_time))
+        except Exception as e:
+            self._error = e
+
+    def _is_managed(self, name):
+        prefix, _, step = name.rpartition('-')
+        return prefix == self.PREFIX and step.isdigit()
+
+    def _apply_retention(self):
+        best     = self._best['checkpoint'] if self._best else None
+        managed  = [c for c in self._checkpoints if self._is_managed(c)]
+
+        # Never none at all, the state must name a checkpoint
+        keep     = self.keep if best is not None else max(self.keep, 1)
+        retained = managed[len(managed) - keep:]
+        removed  = [c for c in managed if c not in retained and c != best]
+        if not removed:
+            return
+
+        # Forget them before deleting, so that the state never names missing files
+        self._checkpoints = [c for c in self._checkpoints if c not in removed]
+        tf.train.update_checkpoint_state(self.checkpoint_dir, self._checkpoints[-1], self._checkpoints)
+
+        for name in removed:
+            for path in tf.gfile.Glob(os.path.join(self.checkpoint_dir, name + '.*')):
+                tf.gfile.Remove(path)
@@ -0,0 +1,153 @@
+import srez_input
+import srez_model
+
+import hashlib
+import json
+import os.path
+import time
+import numpy as np
+import tensorflow as tf
+
+FLAGS = tf.app.flags.FLAGS
+
+METHODS = ('nearest', 'bicubic', 'generator')
+
+CACHE_FILE = 'evaluation.json'
+
+def _build_metrics(features, labels, spec=None):
+    """Per-image PSNR and SSIM of every method against the labels"""
+
+    size = [int(labels.get_shape()[1]), int(labels.get_shape()[2])]
+
+    gene_output, gene_var_list = srez_model.create_generator(features, spec=spec)
+
+    outputs = {'nearest':   tf.image.resize_nearest_neighbor(features, size),
+               'bicubic':   tf.image.resize_bicubic(features, size),
+               'generator': gene_output}
+
+    metrics = {}
+    for method in METHODS:
+        output = tf.maximum(tf.minimum(outputs[method], 1.0), 0.0)
+        metrics[method] = {'psnr': tf.image.psnr(output, labels, max_val=1.0),
+                           'ssim': tf.image.ssim(output, labels, max_val=1.0)}
+
+    return metrics, gene_var_list
+
+def _fingerprint(filenames):
+    # Results are only reused for the same images at the same size, normalized the same way
+    digest = hashlib.sha1()
+    digest.update(('%d %s\n' % (FLAGS.sample_size, FLAGS.inference_norm)).encode('utf-8'))
+    for filename in sorted(filenames):
+        digest.update((os.path.basename(filename) + '\n').encode('utf-8'))
+
+    return digest.hexdigest()
+
+def _checkpoint_mtime(path):
+    return os.path.getmtime(path + '.index')
+
+def _read_cache(path):
+    if not tf.gfile.Exists(path):
+        return {}
+
+    with tf.gfile.GFile(path, 'r') as f:
+        return json.load(f)
+
+def _write_cache(path, cache):
+    with tf.gfile.GFile(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    tf.gfile.Rename(path + '.tmp', path, overwrite=True)
+
+def list_checkpoints(checkpoint_dir):
+    """Every checkpoint named by the `checkpoint` state file of `checkpoint_dir`, oldest first"""
+
+    state = tf.train.get_checkpoint_state(checkpoint_dir)
+    if state is None:
+        return []
+
+    paths = [path if os.path.isabs(path) else os.path.join(checkpoint_dir, path)
+             for path in state.all_model_checkpoint_paths]
+
+    return [path for path in paths if tf.gfile.Exists(path + '.index')]
+
+def evaluate(filenames, checkpoints, batch_size=None, cache_path=None, spec=None):
+    """Mean PSNR and SSIM of nearest, bicubic and generator upscales of
+    `filenames` for each of the `checkpoints`, and the images/s evaluated.
+
+    The generator is built once, with the batch norms of
+    FLAGS.inference_norm, and each checkpoint is restored into it. Per-sample
+    statistics, the default, don't depend on the batch size.
+    Results are cached in `cache_path`, by default in FLAGS.checkpoint_dir,
+    by checkpoint and set of images. A checkpoint is only evaluated again if
+    its files changed. `spec` is the generator layout of the checkpoints,
+    by default FLAGS.generator_spec. Returns the results by checkpoint path."""
+
+    if batch_size is None:
+        batch_size = FLAGS.eval_batch_size
+
+    if cache_path is None:
+        cache_path = os.path.join(FLAGS.checkpoint_dir, CACHE_FILE)
+
+    fingerprint = _fingerprint(filenames)
+    cache       = _read_cache(cache_path)
+
+    pending = []
+    results = {}
+    for path in checkpoints:
+        key    = '%s:%s' % (os.path.basename(path), fingerprint)
+        cached = cache.get(key)
+        if cached is not None and cached['checkpoint_mtime'] == _checkpoint_mtime(path):
+            results[path] = dict(cached, cached=True)
+        else:
+            pending.append((path, key))
+
+    if pending:
+        with tf.Graph().as_default():
+            initializer, features, labels = srez_input.setup_eval_inputs(filenames, batch_size)
+            metrics, gene_var_list = _build_metrics(features, labels, spec)
+
+            saver = tf.train.Saver(gene_var_list)
+            sess  = tf.Session()
+
+            for path, key in pending:
+                if FLAGS.inference_norm == 'moving':
+                    srez_model.check_moving_averages(path, gene_var_list)
+                saver.restore(sess, path)
+                sess.run(initializer)
+
+                values     = {method: {'psnr': [], 'ssim': []} for method in METHODS}
+                start_time = time.time()
+                while True:
+                    try:
+                        batch = sess.run(metrics)
+                    except tf.errors.OutOfRangeError:
+                        break
+
+                    for method in METHODS:
+                        for metric in ('psnr', 'ssim'):
+                            values[method][metric].append(batch[method][metric])
+
+                elapsed = time.time() - start_time
+                num_images = sum(len(v) for v in values['generator']['psnr'])
+
+                result = {'checkpoint_mtime': _checkpoint_mtime(path),
+                          'images':           num_images,
+                          'images_per_second': num_images / elapsed}
+                for method in METHODS:
+                    for metric in ('psnr', 'ssim'):
+                        result['%s_%s' % (method, metric)] = float(np.mean(np.concatenate(values[method][metric])))
+
+                cache[key]    = result
+                results[path] = dict(result, cached=False)
+                _write_cache(cache_path, cache)
+
+            sess.close()
+
+    for path in checkpoints:
+        result = results[path]
+        print("    %-24s %s, %6.1f images/s%s" %
+              (os.path.basename(path),
+               ', '.join('%s %.2f dB / %.3f' % (method, result[method + '_psnr'], result[method + '_ssim'])
+                         for method in METHODS),
+               result['images_per_second'], ' (cached)' if result['cached'] else ''))
+
+    return results
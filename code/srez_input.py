@@ -1,8 +1,19 @@
+import os.path
 import tensorflow as tf
 
 FLAGS = tf.app.flags.FLAGS
 
-def setup_inputs(sess, filenames, image_size=None, capacity_factor=3):
+def setup_inputs(sess, filenames, image_size=None):
+    """Returns batches of features and labels read from `filenames`.
+
+    Built with the pipeline selected by FLAGS.input_pipeline."""
+
+    if FLAGS.input_pipeline == 'queue':
+        return setup_queue_inputs(sess, filenames, image_size)
+
+    return setup_dataset_inputs(sess, filenames, image_size)
+
+def setup_queue_inputs(sess, filenames, image_size=None, capacity_factor=3):
 
     if image_size is None:
         image_size = FLAGS.sample_size
@@ -51,3 +62,231 @@ def setup_inputs(sess, filenames, image_size=None, capacity_factor=3):
     tf.train.start_queue_runners(sess=sess)
       
     return features, labels
+
+# Crop around the face in the aligned CelebA images, with some wiggle room
+# for the random crop
+_WIGGLE         = 8
+_CROP_SIZE      = 128
+_CROP_SIZE_PLUS = _CROP_SIZE + 2*_WIGGLE
+_OFF_X, _OFF_Y  = 25-_WIGGLE, 60-_WIGGLE
+
+# Scales libjpeg can decode at, by skipping DCT coefficients
+DECODE_RATIOS = (1, 2, 4, 8)
+
+def decode_ratio(image_size):
+    """Largest of DECODE_RATIOS the crop can be decoded at without going below `image_size`"""
+
+    ratio = 1
+    while 2*ratio in DECODE_RATIOS and _CROP_SIZE // (2*ratio) >= image_size:
+        ratio *= 2
+
+    return ratio
+
+def _read_file(filename):
+    return tf.data.Dataset.from_tensors(tf.read_file(filename))
+
+def _decode_and_crop(value, ratio=1):
+    # Only the deterministic part, so that its result can be cached. At a
+    # reduced scale the bounding box snaps to the grid of the smaller image
+    image = tf.image.decode_jpeg(value, channels=3, ratio=ratio, name="dataset_image")
+    return tf.image.crop_to_bounding_box(image, _OFF_Y // ratio, _OFF_X // ratio,
+                                         _CROP_SIZE_PLUS // ratio, _CROP_SIZE_PLUS // ratio)
+
+def decode_crop_pair(value, ratio):
+    """Bounding box crop decoded at `ratio`, and the same crop decoded at full
+    size and shrunk with resize_area, the reference it is compared against.
+
+    Both are float32 in [0, 1]."""
+
+    size  = _CROP_SIZE_PLUS // ratio
+    image = tf.image.decode_jpeg(value, channels=3)
+    image = tf.image.crop_to_bounding_box(image, (_OFF_Y // ratio) * ratio, (_OFF_X // ratio) * ratio,
+                                          size * ratio, size * ratio)
+    image = tf.cast(tf.expand_dims(image, 0), tf.float32)/255.0
+
+    reference = tf.image.resize_area(image, [size, size])[0]
+    scaled    = tf.cast(_decode_and_crop(value, ratio), tf.float32)/255.0
+
+    return scaled, reference
+
+def _augment_and_scale(image, image_size, ratio=1):
+    # Crop and other random augmentations. The bounding box is centered
+    # horizontally, so flipping after it is the same as flipping before
+    image = tf.image.random_flip_left_right(image)
+    image = tf.image.random_saturation(image, .95, 1.05)
+    image = tf.image.random_brightness(image, .05)
+    image = tf.image.random_contrast(image, .95, 1.05)
+
+    crop_size = _CROP_SIZE // ratio
+    image = tf.random_crop(image, [crop_size, crop_size, 3])
+
+    return _features_and_label(image, image_size, crop_size)
+
+def _features_and_label(image, image_size, crop_size):
+    # Label at `image_size` and its downscaled feature, from a uint8 crop
+    image = tf.reshape(image, [1, crop_size, crop_size, 3])
+    image = tf.cast(image, tf.float32)/255.0
+
+    if crop_size != image_size:
+        image = tf.image.resize_area(image, [image_size, image_size])
+
+    # The feature is simply a Kx downscaled version
+    K = 4
+    downsampled = tf.image.resize_area(image, [image_size//K, image_size//K])
+
+    feature = tf.reshape(downsampled, [image_size//K, image_size//K, 3])
+    label   = tf.reshape(image,       [image_size,   image_size,     3])
+
+    return feature, label
+
+def setup_dataset_inputs(sess, filenames, image_size=None, cache=None, scaled_decode=None, batch_size=None):
+    """Same batches as `setup_queue_inputs`, from a tf.data pipeline.
+
+    Files are read in parallel and decoded by FLAGS.input_parallel_calls
+    threads (0 lets tf.data tune it), and batches are prefetched. With
+    `cache`, by default FLAGS.input_cache, the decoded 144x144 crops are kept
+    in memory after the first epoch and only the random augmentations are
+    recomputed.
+
+    With `scaled_decode`, by default FLAGS.input_scaled_decode, JPEGs are
+    decoded at 1/2, 1/4 or 1/8 scale when the labels are at least that much
+    smaller than the crop (see `decode_ratio`), instead of being decoded at
+    full size and shrunk with resize_area.
+
+    Batches hold `batch_size` images, by default FLAGS.batch_size."""
+
+    if image_size is None:
+        image_size = FLAGS.sample_size
+
+    if cache is None:
+        cache = FLAGS.input_cache
+
+    if scaled_decode is None:
+        scaled_decode = FLAGS.input_scaled_decode
+
+    ratio = decode_ratio(image_size) if scaled_decode else 1
+
+    parallel_calls = FLAGS.input_parallel_calls or tf.data.experimental.AUTOTUNE
+
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    if not cache:
+        dataset = dataset.shuffle(len(filenames)).repeat()
+
+    dataset = dataset.apply(tf.data.experimental.parallel_interleave(_read_file,
+                                                                    cycle_length=FLAGS.input_parallel_reads,
+                                                                    sloppy=True))
+    dataset = dataset.map(lambda value: _decode_and_crop(value, ratio), num_parallel_calls=parallel_calls)
+
+    if cache:
+        dataset = dataset.cache() \
+                         .shuffle(min(len(filenames), FLAGS.input_shuffle_buffer)) \
+                         .repeat()
+
+    return _batch_crops(dataset, image_size, parallel_calls, ratio, batch_size)
+
+def _batch_crops(dataset, image_size, parallel_calls, ratio=1, batch_size=None):
+    # Random augmentations of 144x144 uint8 crops, or 144/ratio when decoded
+    # at a reduced scale, batched as features and labels
+    dataset = dataset.map(lambda image: _augment_and_scale(image, image_size, ratio),
+                          num_parallel_calls=parallel_calls)
+    dataset = dataset.batch(batch_size or FLAGS.batch_size, drop_remainder=True)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    features, labels = dataset.make_one_shot_iterator().get_next(name='labels_and_features')
+
+    return features, labels
+
+def _center_crop(value):
+    # Deterministic counterpart of the random crop, for evaluation
+    image = _decode_and_crop(value)
+    return tf.image.crop_to_bounding_box(image, _WIGGLE, _WIGGLE, _CROP_SIZE, _CROP_SIZE)
+
+def setup_eval_inputs(filenames, batch_size, image_size=None):
+    """Features and labels of every file once, center cropped and without augmentation.
+
+    Returns the initializer of the iterator, to be run before every pass,
+    and the batches of features and labels. The last batch may be smaller."""
+
+    if image_size is None:
+        image_size = FLAGS.sample_size
+
+    parallel_calls = FLAGS.input_parallel_calls or tf.data.experimental.AUTOTUNE
+
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    dataset = dataset.map(lambda filename: _features_and_label(_center_crop(tf.read_file(filename)),
+                                                               image_size, _CROP_SIZE),
+                          num_parallel_calls=parallel_calls)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    iterator = dataset.make_initializable_iterator()
+    features, labels = iterator.get_next()
+
+    return iterator.initializer, features, labels
+
+def _shard_paths(shard_dir, prefix, num_shards):
+    return [os.path.join(shard_dir, '%s-%05d-of-%05d.tfrecord' % (prefix, i, num_shards))
+            for i in range(num_shards)]
+
+def write_shards(sess, filenames, shard_dir, prefix, shard_size=None):
+    """Decodes and crops every file once, and writes the 144x144 uint8 crops
+    as raw TFRecord shards of `shard_size` crops named `prefix`-*.
+
+    Returns the paths of the shards. Each shard only appears under its final
+    name once it is complete."""
+
+    if shard_size is None:
+        shard_size = FLAGS.shard_size
+
+    parallel_calls = FLAGS.input_parallel_calls or tf.data.experimental.AUTOTUNE
+
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    dataset = dataset.map(lambda filename: _decode_and_crop(tf.read_file(filename)),
+                          num_parallel_calls=parallel_calls)
+    dataset = dataset.batch(256).prefetch(2)
+    crops   = dataset.make_one_shot_iterator().get_next()
+
+    num_shards = max(1, -(-len(filenames) // shard_size))
+    paths      = _shard_paths(shard_dir, prefix, num_shards)
+
+    pending = []
+    for path in paths:
+        with tf.python_io.TFRecordWriter(path + '.tmp') as writer:
+            for _ in range(shard_size):
+                if not pending:
+                    try:
+                        pending = list(sess.run(crops))
+                    except tf.errors.OutOfRangeError:
+                        break
+
+                writer.write(pending.pop(0).tobytes())
+
+        tf.gfile.Rename(path + '.tmp', path, overwrite=True)
+        print("    Wrote %s" % (path,))
+
+    return paths
+
+def _parse_crop(record):
+    image = tf.decode_raw(record, tf.uint8)
+    return tf.reshape(image, [_CROP_SIZE_PLUS, _CROP_SIZE_PLUS, 3])
+
+def setup_shard_inputs(sess, shard_dir, prefix, image_size=None, batch_size=None):
+    """Same batches as `setup_dataset_inputs`, from the crops `write_shards` stored.
+
+    Nothing is decoded: shards are read in parallel and in random order, and
+    only the random augmentations are computed per epoch."""
+
+    if image_size is None:
+        image_size = FLAGS.sample_size
+
+    parallel_calls = FLAGS.input_parallel_calls or tf.data.experimental.AUTOTUNE
+
+    dataset = tf.data.Dataset.list_files(os.path.join(shard_dir, prefix + '-*.tfrecord'), shuffle=True)
+    dataset = dataset.repeat()
+    dataset = dataset.apply(tf.data.experimental.parallel_interleave(tf.data.TFRecordDataset,
+                                                                    cycle_length=FLAGS.input_parallel_reads,
+                                                                    sloppy=True))
+    dataset = dataset.map(_parse_crop, num_parallel_calls=parallel_calls)
+    dataset = dataset.shuffle(FLAGS.input_shuffle_buffer)
+
+    return _batch_crops(dataset, image_size, parallel_calls, batch_size=batch_size)
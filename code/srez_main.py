@@ -1,6 +1,9 @@
+import srez_bench
 import srez_demo
+import srez_eval
 import srez_input
 import srez_model
+import srez_parallel
 import srez_train
 
 import os.path
@@ -16,24 +19,87 @@ FLAGS = tf.app.flags.FLAGS
 tf.app.flags.DEFINE_integer('batch_size', 30,
                             "Number of samples per batch.")
 
+tf.app.flags.DEFINE_string('bench_variants', '',
+                           "Generator variants compared by --run=bench_variants, as spec=checkpoint_dir pairs separated by ';'.")
+
+tf.app.flags.DEFINE_string('bench_workers', '1,2,4,8',
+                           "Numbers of workers timed by --run=bench_parallel.")
+
 tf.app.flags.DEFINE_string('checkpoint_dir', 'checkpoint',
                            "Output folder where checkpoints are dumped.")
 
+tf.app.flags.DEFINE_integer('bench_batches', 100,
+                            "Number of batches timed by the benchmarks.")
+
+tf.app.flags.DEFINE_integer('checkpoint_keep', 5,
+                            "Number of most recent checkpoints kept, besides the one with the best test loss.")
+
 tf.app.flags.DEFINE_integer('checkpoint_period', 50,
                             "Number of batches in between checkpoints")
 
 tf.app.flags.DEFINE_string('dataset', 'dataset',
                            "Path to the dataset directory.")
 
+tf.app.flags.DEFINE_float('distill_factor', .5,
+                          "Multiplier for the L1 distance to the teacher in the generator loss of --run=distill.")
+
+tf.app.flags.DEFINE_string('distill_teacher_dir', '',
+                           "Checkpoint folder of the teacher generator for --run=distill.")
+
+tf.app.flags.DEFINE_string('distill_teacher_spec', 'full',
+                           "Generator spec of the teacher for --run=distill.")
+
+tf.app.flags.DEFINE_string('distill_teacher_upsample', '',
+                           "Generator upsampling of the teacher for --run=distill. --generator_upsample when empty.")
+
+tf.app.flags.DEFINE_integer('eval_batch_size', 64,
+                            "Number of images evaluated at once by --run=evaluate.")
+
+tf.app.flags.DEFINE_string('eval_checkpoint', '',
+                           "Checkpoint evaluated by --run=evaluate. Every checkpoint in checkpoint_dir when empty.")
+
+tf.app.flags.DEFINE_string('eval_dir', '',
+                           "Folder of held-out images evaluated by --run=evaluate. The test vectors of the dataset when empty.")
+
 tf.app.flags.DEFINE_float('epsilon', 1e-8,
                           "Fuzz term to avoid numerical instability")
 
 tf.app.flags.DEFINE_string('run', 'demo',
-                            "Which operation to run. [demo|train]")
+                            "Which operation to run. [demo|train|distill|evaluate|preprocess|bench_input|bench_decode|bench_parallel|bench_generator|bench_batch_norm|bench_variants]")
 
 tf.app.flags.DEFINE_float('gene_l1_factor', .90,
                           "Multiplier for generator L1 loss term")
 
+tf.app.flags.DEFINE_string('generator_spec', 'full',
+                           "Generator layout, a name from srez_model.GENERATOR_SPECS or e.g. '128x2,64x2,64/separable'.")
+
+tf.app.flags.DEFINE_string('generator_upsample', 'nearest',
+                           "Generator upsampling. nearest: upscale then convolve, subpixel: convolve then depth_to_space. [nearest|subpixel]")
+
+tf.app.flags.DEFINE_string('inference_norm', 'batch',
+                           "Statistics batch norms use outside training, in test images, montages and --run=evaluate. batch: each image its own, moving: the moving averages, which the checkpoint must have trained. [batch|moving]")
+
+tf.app.flags.DEFINE_bool('input_cache', False,
+                         "Keep decoded training crops in memory after the first epoch.")
+
+tf.app.flags.DEFINE_integer('input_parallel_calls', 0,
+                            "Threads decoding and augmenting training images. 0 lets tf.data tune it.")
+
+tf.app.flags.DEFINE_integer('input_parallel_reads', 8,
+                            "Training files read at the same time.")
+
+tf.app.flags.DEFINE_string('input_pipeline', 'dataset',
+                           "Training input pipeline. [dataset|queue]")
+
+tf.app.flags.DEFINE_bool('input_scaled_decode', False,
+                         "Decode training JPEGs at 1/2, 1/4 or 1/8 scale when the samples are that much smaller than the crop.")
+
+tf.app.flags.DEFINE_string('input_shards', '',
+                           "Folder of preprocessed crops written by --run=preprocess. Trains from them instead of the dataset when set.")
+
+tf.app.flags.DEFINE_integer('input_shuffle_buffer', 10000,
+                            "Cached crops shuffled together when input_cache is set.")
+
 tf.app.flags.DEFINE_float('learning_beta1', 0.5,
                           "Beta1 parameter used for AdamOptimizer")
 
@@ -46,15 +112,30 @@ tf.app.flags.DEFINE_integer('learning_rate_half_life', 5000,
 tf.app.flags.DEFINE_bool('log_device_placement', False,
                          "Log the device where variables are placed.")
 
+tf.app.flags.DEFINE_integer('num_workers', 1,
+                            "Local processes training in parallel, each on its share of the batch.")
+
+tf.app.flags.DEFINE_string('profile_log', '',
+                           "JSON lines file per-step training timings are written to. No profiling when empty.")
+
+tf.app.flags.DEFINE_integer('profile_trace_period', 100,
+                            "Number of batches between per-layer traces when profiling. 0 disables them.")
+
 tf.app.flags.DEFINE_integer('sample_size', 64,
                             "Image sample size in pixels. Range [64,128]")
 
+tf.app.flags.DEFINE_integer('shard_size', 4096,
+                            "Number of crops per shard written by --run=preprocess.")
+
 tf.app.flags.DEFINE_integer('summary_period', 30,
                             "Number of batches between summary data dumps")
 
 tf.app.flags.DEFINE_integer('random_seed', 0,
                             "Seed used to initialize rng.")
 
+tf.app.flags.DEFINE_integer('task_index', 0,
+                            "Worker served by a --run=worker process, started by parallel training.")
+
 tf.app.flags.DEFINE_integer('test_vectors', 16,
                             """Number of features to use for testing""")
                             
@@ -64,7 +145,10 @@ tf.app.flags.DEFINE_string('train_dir', 'train',
 tf.app.flags.DEFINE_integer('train_time', 300,
                             "Time in minutes to train the model")
 
-def prepare_dirs(delete_train_dir=False):
+tf.app.flags.DEFINE_integer('worker_port', 2222,
+                            "First localhost port of the workers when training in parallel.")
+
+def prepare_dirs(delete_train_dir=False, list_dataset=True):
     # Create checkpoint dir (do not delete anything)
     if not tf.gfile.Exists(FLAGS.checkpoint_dir):
         tf.gfile.MakeDirs(FLAGS.checkpoint_dir)
@@ -75,23 +159,28 @@ def prepare_dirs(delete_train_dir=False):
             tf.gfile.DeleteRecursively(FLAGS.train_dir)
         tf.gfile.MakeDirs(FLAGS.train_dir)
 
+    if not list_dataset:
+        return []
+
     # Return names of training files
     if not tf.gfile.Exists(FLAGS.dataset) or \
        not tf.gfile.IsDirectory(FLAGS.dataset):
         raise FileNotFoundError("Could not find folder `%s'" % (FLAGS.dataset,))
 
+    # Same order in every run, so that the last FLAGS.test_vectors files stay held out
     filenames = tf.gfile.ListDirectory(FLAGS.dataset)
     filenames = sorted(filenames)
-    random.shuffle(filenames)
+    random.Random(FLAGS.random_seed).shuffle(filenames)
     filenames = [os.path.join(FLAGS.dataset, f) for f in filenames]
 
     return filenames
 
 
-def setup_tensorflow():
+def setup_tensorflow(target='', config=None):
     # Create session
-    config = tf.ConfigProto(log_device_placement=FLAGS.log_device_placement)
-    sess = tf.Session(config=config)
+    if config is None:
+        config = tf.ConfigProto(log_device_placement=FLAGS.log_device_placement)
+    sess = tf.Session(target, config=config)
 
     # Initialize rng with a deterministic seed
     with sess.graph.as_default(): #создание графа
@@ -122,12 +211,20 @@ def _demo():
     [gene_minput, gene_moutput,
      gene_output, gene_var_list,
      disc_real_output, disc_fake_output, disc_var_list] = \
-            srez_model.create_model(sess, features, labels)
+            srez_model.create_model(sess, features, labels, training=False)
+
+    # Restore variables from checkpoint. Folders without a state file hold checkpoint_new.txt
+    filename = tf.train.latest_checkpoint(FLAGS.checkpoint_dir) or \
+               os.path.join(FLAGS.checkpoint_dir, 'checkpoint_new.txt')
+
+    # Moving averages missing from older checkpoints keep their initial
+    # values. The demo only replays the images written during training
+    reader   = tf.train.NewCheckpointReader(filename)
+    var_list = [var for var in tf.global_variables()
+                if reader.has_tensor(var.op.name) or not var.op.name.endswith(('/moving_mean', '/moving_variance'))]
 
-    # Restore variables from checkpoint
-    saver = tf.train.Saver()
-    filename = 'checkpoint_new.txt'
-    filename = os.path.join(FLAGS.checkpoint_dir, filename)
+    sess.run(tf.global_variables_initializer())
+    saver = tf.train.Saver(var_list)
     saver.restore(sess, filename)
 
     # Execute demo
@@ -137,12 +234,25 @@ class TrainData(object):
     def __init__(self, dictionary):
         self.__dict__.update(dictionary)
 
-def _train():
+def _train(distill=False):
+    if distill and not FLAGS.distill_teacher_dir:
+        raise ValueError("--distill_teacher_dir must name the checkpoint folder of the teacher")
+    if distill and FLAGS.num_workers > 1:
+        raise ValueError("Distillation only trains in a single process")
+
     # Prepare directories
-    all_filenames = prepare_dirs(delete_train_dir=True)
+    all_filenames = prepare_dirs(delete_train_dir=True, list_dataset=not FLAGS.input_shards)
+
+    # Workers training in parallel, in other processes
+    cluster = None
+    if FLAGS.num_workers > 1:
+        cluster = srez_parallel.LocalCluster(FLAGS.num_workers)
 
     # Setup global tensorflow state
-    sess, summary_writer = setup_tensorflow()
+    if cluster is None:
+        sess, summary_writer = setup_tensorflow()
+    else:
+        sess, summary_writer = setup_tensorflow(cluster.target, srez_parallel.worker_config(FLAGS.num_workers))
 	
     #saver = tf.train.Saver()	
     #filename = 'checkpoint'
@@ -157,8 +267,26 @@ def _train():
     # TBD: Maybe download dataset here
 
     # Setup async input queues
-    train_features, train_labels = srez_input.setup_inputs(sess, train_filenames)
-    test_features,  test_labels  = srez_input.setup_inputs(sess, test_filenames)
+    if FLAGS.input_shards:
+        test_features, test_labels = srez_input.setup_shard_inputs(sess, FLAGS.input_shards, 'test')
+    else:
+        test_features, test_labels = srez_input.setup_inputs(sess, test_filenames)
+
+    if cluster is not None:
+        # One tower per worker, each with its own inputs
+        train_data = TrainData(dict(srez_parallel.create_towers(train_filenames, FLAGS.num_workers),
+                                    sess=sess, test_features=test_features, test_labels=test_labels))
+        try:
+            srez_train.train_model(train_data)
+        finally:
+            cluster.close()
+        return
+
+    if FLAGS.input_shards:
+        train_features, train_labels = srez_input.setup_shard_inputs(sess, FLAGS.input_shards, 'train')
+    else:
+        train_features, train_labels = srez_input.setup_inputs(sess, train_filenames)
+    train_inputs = [train_features, train_labels]
 
     # Add some noise during training (think denoising autoencoders)
     noise_level = .03
@@ -175,6 +303,19 @@ def _train():
     disc_real_loss, disc_fake_loss = \
                      srez_model.create_discriminator_loss(disc_real_output, disc_fake_output)
     disc_loss = tf.add(disc_real_loss, disc_fake_loss, name='disc_loss')
+
+    # The student generator also learns from the output of a frozen teacher
+    teacher_saver = teacher_checkpoint = None
+    teacher_var_list = []
+    if distill:
+        teacher_output, teacher_var_list, teacher_saver = \
+                srez_model.create_teacher(noisy_train_features, FLAGS.distill_teacher_spec,
+                                          FLAGS.distill_teacher_upsample or None)
+        teacher_checkpoint = tf.train.latest_checkpoint(FLAGS.distill_teacher_dir)
+        if teacher_checkpoint is None:
+            raise FileNotFoundError("No checkpoint in `%s'" % (FLAGS.distill_teacher_dir,))
+
+        gene_loss = srez_model.create_distillation_loss(gene_loss, gene_output, teacher_output)
     
     (global_step, learning_rate, gene_minimize, disc_minimize) = \
             srez_model.create_optimizers(gene_loss, gene_var_list,
@@ -184,6 +325,80 @@ def _train():
     train_data = TrainData(locals())
     srez_train.train_model(train_data)
 
+def _bench_parallel():
+    # Prepare directories
+    filenames = prepare_dirs(delete_train_dir=False)
+
+    srez_bench.bench_parallel(filenames)
+
+def _bench_generator():
+    srez_bench.bench_generator()
+
+def _bench_batch_norm():
+    srez_bench.bench_batch_norm()
+
+def _eval_filenames():
+    if FLAGS.eval_dir:
+        filenames = sorted(tf.gfile.ListDirectory(FLAGS.eval_dir))
+        return [os.path.join(FLAGS.eval_dir, f) for f in filenames]
+
+    # Same held-out split as training
+    return prepare_dirs(delete_train_dir=False)[-FLAGS.test_vectors:]
+
+def _bench_variants():
+    if not FLAGS.bench_variants:
+        raise ValueError("--bench_variants must list the variants to compare, e.g. full=checkpoint;small=small")
+
+    variants = [variant.split('=', 1) for variant in FLAGS.bench_variants.split(';')]
+    if any(len(variant) != 2 for variant in variants):
+        raise ValueError("Invalid --bench_variants `%s'" % (FLAGS.bench_variants,))
+
+    srez_bench.bench_variants(_eval_filenames(), variants)
+
+def _evaluate():
+    filenames = _eval_filenames()
+
+    if FLAGS.eval_checkpoint:
+        checkpoints = [FLAGS.eval_checkpoint]
+    else:
+        checkpoints = srez_eval.list_checkpoints(FLAGS.checkpoint_dir)
+
+    if not checkpoints:
+        raise FileNotFoundError("No checkpoint to evaluate in `%s'" % (FLAGS.checkpoint_dir,))
+
+    srez_eval.evaluate(filenames, checkpoints)
+
+def _preprocess():
+    if not FLAGS.input_shards:
+        raise ValueError("--input_shards must name the folder the shards are written to")
+
+    # Prepare directories
+    all_filenames = prepare_dirs(delete_train_dir=False)
+    if not tf.gfile.Exists(FLAGS.input_shards):
+        tf.gfile.MakeDirs(FLAGS.input_shards)
+
+    # Setup global tensorflow state
+    sess, summary_writer = setup_tensorflow()
+
+    # Same split as training
+    train_filenames = all_filenames[:-FLAGS.test_vectors]
+    test_filenames  = all_filenames[-FLAGS.test_vectors:]
+
+    srez_input.write_shards(sess, train_filenames, FLAGS.input_shards, 'train')
+    srez_input.write_shards(sess, test_filenames,  FLAGS.input_shards, 'test')
+
+def _bench_input():
+    # Prepare directories
+    filenames = prepare_dirs(delete_train_dir=False)
+
+    srez_bench.bench_input(filenames)
+
+def _bench_decode():
+    # Prepare directories
+    filenames = prepare_dirs(delete_train_dir=False)
+
+    srez_bench.bench_decode(filenames)
+
 def main(argv=None):
     # Training or showing off?
 
@@ -191,6 +406,26 @@ def main(argv=None):
         _demo()
     elif FLAGS.run == 'train':
         _train()
+    elif FLAGS.run == 'distill':
+        _train(distill=True)
+    elif FLAGS.run == 'evaluate':
+        _evaluate()
+    elif FLAGS.run == 'preprocess':
+        _preprocess()
+    elif FLAGS.run == 'bench_input':
+        _bench_input()
+    elif FLAGS.run == 'bench_decode':
+        _bench_decode()
+    elif FLAGS.run == 'bench_parallel':
+        _bench_parallel()
+    elif FLAGS.run == 'bench_generator':
+        _bench_generator()
+    elif FLAGS.run == 'bench_batch_norm':
+        _bench_batch_norm()
+    elif FLAGS.run == 'bench_variants':
+        _bench_variants()
+    elif FLAGS.run == 'worker':
+        srez_parallel.run_worker()
 
 if __name__ == '__main__':
   tf.app.run()
\ No newline at end of file
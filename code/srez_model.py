@@ -1,16 +1,68 @@
+import collections
+import re
+
 import numpy as np
 import tensorflow as tf
 
 FLAGS = tf.app.flags.FLAGS
 
+# Generator layouts by name, see `generator_spec`. 'full' is the original one
+GENERATOR_SPECS = {'full':   '256x2,128x2,96',
+                   'medium': '128x2,64x2,64',
+                   'small':  '64x1,32x1,32/separable',
+                   'tiny':   '32x1,16x1,16/separable'}
+
+GeneratorSpec = collections.namedtuple('GeneratorSpec', ['res_units', 'blocks', 'separable'])
+
+# Statistics batch norms use outside training:
+#   batch  - every image is normalized by its own statistics, which any checkpoint supports
+#   moving - the moving averages, which the checkpoint must have trained, see `check_moving_averages`
+INFERENCE_NORMS = ('batch', 'moving')
+
+def generator_spec(spec=None):
+    """Parses a generator layout, either a name from GENERATOR_SPECS or e.g.
+    '128x2,64x2,64/separable'. Defaults to FLAGS.generator_spec.
+
+    Each stage before a 2x upscale is given as its width and number of
+    residual blocks, then comes the width of the final convolutions. With
+    '/separable' the 3x3 convolutions are depthwise separable."""
+
+    if spec is None:
+        spec = FLAGS.generator_spec
+    if isinstance(spec, GeneratorSpec):
+        return spec
+
+    text = GENERATOR_SPECS.get(spec, spec)
+    try:
+        stages, _, options = text.partition('/')
+        stages = stages.split(',')
+
+        widths = [int(stage.split('x')[0]) for stage in stages]
+        blocks = [int(stage.split('x')[1]) for stage in stages[:-1]]
+    except (ValueError, IndexError):
+        raise ValueError("Invalid generator spec `%s'" % (spec,))
+
+    if len(widths) < 2 or 'x' in stages[-1] or options not in ('', 'separable'):
+        raise ValueError("Invalid generator spec `%s'" % (spec,))
+
+    return GeneratorSpec(tuple(widths), tuple(blocks), options == 'separable')
+
 class Model:
     """A neural network model.
 
-    Currently only supports a feedforward architecture."""
+    Currently only supports a feedforward architecture.
+
+    `training` switches batch norms between batch statistics, whose moving
+    averages are then updated, and the moving averages. `fused=False` keeps
+    the unfused tf.contrib.layers.batch_norm this model used to have, always
+    on batch statistics, to compare against."""
     
-    def __init__(self, name, features):
+    def __init__(self, name, features, per_sample_norm=False, training=True, fused=True):
         self.name = name
         self.outputs = [features]
+        self.per_sample_norm = per_sample_norm
+        self.training = training
+        self.fused = fused
 
     def _get_layer_str(self, layer=None):
         if layer is None:
@@ -21,6 +73,14 @@ class Model:
     def _get_num_inputs(self):
         return int(self.get_output().get_shape()[-1])
 
+    def _get_scaled_shape(self, factor, num_units):
+        """Static shape of the top layer with rows and columns times `factor`, None where unknown"""
+
+        shape = self.get_output().get_shape().as_list()
+        rows, cols = [s * factor if s is not None else None for s in shape[1:3]]
+
+        return [shape[0], rows, cols, num_units]
+
     def _glorot_initializer(self, prev_units, num_units, stddev_factor=1.0):
         """Initialization in the style of Glorot 2010.
 
@@ -46,13 +106,76 @@ class Model:
 
         See ArXiv 1502.03167v3 for details."""
 
-        # TBD: This appears to be very flaky, often raising InvalidArgumentError internally
         with tf.variable_scope(self._get_layer_str()):
-            out = tf.contrib.layers.batch_norm(self.get_output(), scale=scale)
+            if self.per_sample_norm:
+                out = self._per_sample_norm(self.get_output(), scale=scale)
+            elif self.fused:
+                out = self._fused_batch_norm(self.get_output(), scale=scale)
+            else:
+                # TBD: This appears to be very flaky, often raising InvalidArgumentError internally
+                out = tf.contrib.layers.batch_norm(self.get_output(), scale=scale)
         
         self.outputs.append(out)
         return self
 
+    def _fused_batch_norm(self, features, scale=False, decay=0.999, epsilon=0.001):
+        """Batch normalization through the fused kernel.
+
+        Same variables, names and defaults as tf.contrib.layers.batch_norm, so
+        checkpoints written with either restore into the other. In training
+        mode the moving average updates go to the UPDATE_OPS collection, the
+        optimizers of `create_optimizers` run them. In inference mode the
+        moving averages are used, see `check_moving_averages`."""
+
+        num_units = self._get_num_inputs()
+
+        with tf.variable_scope('BatchNorm'):
+            beta  = tf.get_variable('beta', shape=[num_units], initializer=tf.zeros_initializer())
+            if scale:
+                gamma = tf.get_variable('gamma', shape=[num_units], initializer=tf.ones_initializer())
+            else:
+                gamma = tf.ones([num_units])
+
+            moving_mean     = tf.get_variable('moving_mean', shape=[num_units],
+                                              initializer=tf.zeros_initializer(), trainable=False)
+            moving_variance = tf.get_variable('moving_variance', shape=[num_units],
+                                              initializer=tf.ones_initializer(), trainable=False)
+
+            if not self.training:
+                out, _, _ = tf.nn.fused_batch_norm(features, gamma, beta,
+                                                   mean=moving_mean, variance=moving_variance,
+                                                   epsilon=epsilon, is_training=False)
+                return out
+
+            out, mean, variance = tf.nn.fused_batch_norm(features, gamma, beta,
+                                                         epsilon=epsilon, is_training=True)
+
+            for moving, value in ((moving_mean, mean), (moving_variance, variance)):
+                update = tf.assign_sub(moving, (1.0 - decay) * (moving - value))
+                tf.add_to_collection(tf.GraphKeys.UPDATE_OPS, update)
+
+        return out
+
+    def _per_sample_norm(self, features, scale=False, epsilon=0.001):
+        """Batch normalization with statistics computed over each sample alone.
+
+        Same result and variable names as tf.contrib.layers.batch_norm in
+        training mode at batch size 1, but images that are batched together
+        no longer change each other's output."""
+
+        num_units = self._get_num_inputs()
+
+        with tf.variable_scope('BatchNorm'):
+            beta  = tf.get_variable('beta', shape=[num_units], initializer=tf.zeros_initializer())
+            gamma = None
+            if scale:
+                gamma = tf.get_variable('gamma', shape=[num_units], initializer=tf.ones_initializer())
+
+            mean, variance = tf.nn.moments(features, [1, 2], keep_dims=True)
+            out = tf.nn.batch_normalization(features, mean, variance, beta, gamma, epsilon)
+
+        return out
+
     def add_flatten(self):
         """Transforms the output of this network to a 1D tensor"""
 
@@ -166,6 +289,34 @@ class Model:
         self.outputs.append(out)
         return self
 
+    def add_separable_conv2d(self, num_units, mapsize=1, stride=1, stddev_factor=1.0):
+        """Adds a depthwise separable 2D convolutional layer, see Arxiv 1610.02357.
+
+        About `mapsize*mapsize` times cheaper than `add_conv2d` for many units"""
+
+        assert len(self.get_output().get_shape()) == 4 and "Previous layer must be 4-dimensional (batch, width, height, channels)"
+
+        with tf.variable_scope(self._get_layer_str()):
+            prev_units = self._get_num_inputs()
+
+            # Spatial filter per input channel, then a 1x1 convolution
+            initd     = self._glorot_initializer_conv2d(prev_units, 1, mapsize, stddev_factor=1.)
+            depthwise = tf.get_variable('depthwise', initializer=initd)
+            initp     = self._glorot_initializer_conv2d(prev_units, num_units, 1,
+                                                        stddev_factor=stddev_factor)
+            pointwise = tf.get_variable('pointwise', initializer=initp)
+            out       = tf.nn.separable_conv2d(self.get_output(), depthwise, pointwise,
+                                               strides=[1, stride, stride, 1],
+                                               padding='SAME')
+
+            # Bias term
+            initb  = tf.constant(0.0, shape=[num_units])
+            bias   = tf.get_variable('bias', initializer=initb)
+            out    = tf.nn.bias_add(out, bias)
+
+        self.outputs.append(out)
+        return self
+
     def add_conv2d_transpose(self, num_units, mapsize=1, stride=1, stddev_factor=1.0):
         """Adds a transposed 2D convolutional layer"""
 
@@ -181,14 +332,15 @@ class Model:
             weight = tf.get_variable('weight', initializer=initw)
             weight = tf.transpose(weight, perm=[0, 1, 3, 2])
             prev_output = self.get_output()
-            output_shape = [FLAGS.batch_size,
-                            int(prev_output.get_shape()[1]) * stride,
-                            int(prev_output.get_shape()[2]) * stride,
-                            num_units]
+            # Output shape from the input at run time, so that any batch and
+            # image size can go through the same graph
+            prev_shape   = tf.shape(prev_output)
+            output_shape = tf.stack([prev_shape[0], prev_shape[1] * stride, prev_shape[2] * stride, num_units])
             out    = tf.nn.conv2d_transpose(self.get_output(), weight,
                                             output_shape=output_shape,
                                             strides=[1, stride, stride, 1],
                                             padding='SAME')
+            out.set_shape(self._get_scaled_shape(stride, num_units))
 
             # Bias term
             initb  = tf.constant(0.0, shape=[num_units])
@@ -198,8 +350,9 @@ class Model:
         self.outputs.append(out)
         return self
 
-    def add_residual_block(self, num_units, mapsize=3, num_layers=2, stddev_factor=1e-3):
-        """Adds a residual block as per Arxiv 1512.03385, Figure 3"""
+    def add_residual_block(self, num_units, mapsize=3, num_layers=2, stddev_factor=1e-3, separable=False):
+        """Adds a residual block as per Arxiv 1512.03385, Figure 3, optionally
+        with depthwise separable convolutions"""
 
         assert len(self.get_output().get_shape()) == 4 and "Previous layer must be 4-dimensional (batch, width, height, channels)"
 
@@ -213,7 +366,10 @@ class Model:
         for _ in range(num_layers):
             self.add_batch_norm()
             self.add_relu()
-            self.add_conv2d(num_units, mapsize=mapsize, stride=1, stddev_factor=stddev_factor)
+            if separable:
+                self.add_separable_conv2d(num_units, mapsize=mapsize, stride=1, stddev_factor=stddev_factor)
+            else:
+                self.add_conv2d(num_units, mapsize=mapsize, stride=1, stddev_factor=stddev_factor)
 
         self.add_sum(bypass)
 
@@ -290,13 +446,48 @@ class Model:
     def add_upscale(self):
         """Adds a layer that upscales the output by 2x through nearest neighbor interpolation"""
 
-        prev_shape = self.get_output().get_shape()
-        size = [2 * int(s) for s in prev_shape[1:3]]
+        size = 2 * tf.shape(self.get_output())[1:3]
         out  = tf.image.resize_nearest_neighbor(self.get_output(), size)
+        out.set_shape(self._get_scaled_shape(2, self._get_num_inputs()))
 
         self.outputs.append(out)
         return self        
 
+    def add_subpixel_upscale(self, num_units, mapsize=3, stddev_factor=1.0):
+        """Adds a layer that upscales the output by 2x through sub-pixel convolution.
+
+        A convolution at the input resolution to 4x `num_units`, rearranged
+        into 2x2 blocks by depth_to_space (see ArXiv 1609.05158). The four
+        sub-kernels start out identical, so that the layer first behaves like
+        a convolution followed by a nearest neighbor upscale and has no
+        checkerboard artifacts (see ArXiv 1707.02937)."""
+
+        assert len(self.get_output().get_shape()) == 4 and "Previous layer must be 4-dimensional (batch, width, height, channels)"
+
+        with tf.variable_scope(self._get_layer_str()):
+            prev_units = self._get_num_inputs()
+
+            # Weight term and convolution. Output channel c of block position
+            # k comes from convolution output k*num_units + c
+            initw  = self._glorot_initializer_conv2d(prev_units, num_units,
+                                                     mapsize,
+                                                     stddev_factor=stddev_factor)
+            initw  = tf.tile(initw, [1, 1, 1, 4])
+            weight = tf.get_variable('weight', initializer=initw)
+            out    = tf.nn.conv2d(self.get_output(), weight,
+                                  strides=[1, 1, 1, 1],
+                                  padding='SAME')
+
+            # Bias term
+            initb  = tf.constant(0.0, shape=[4*num_units])
+            bias   = tf.get_variable('bias', initializer=initb)
+            out    = tf.nn.bias_add(out, bias)
+
+            out    = tf.depth_to_space(out, 2)
+
+        self.outputs.append(out)
+        return self
+
     def get_output(self):
         """Returns the output from the topmost layer of the network"""
         return self.outputs[-1]
@@ -321,14 +512,14 @@ class Model:
         scope = self._get_layer_str(layer)
         return tf.get_collection(tf.GraphKeys.VARIABLES, scope=scope)
 
-def _discriminator_model(sess, features, disc_input):
+def _discriminator_model(sess, features, disc_input, training=True, fused=True):
     # Fully convolutional model
     mapsize = 3
     layers  = [64, 128, 256, 512]
 
     old_vars = tf.all_variables()
 
-    model = Model('DIS', 2*disc_input - 1)
+    model = Model('DIS', 2*disc_input - 1, training=training, fused=fused)
 
     for layer in range(len(layers)):
         nunits = layers[layer]
@@ -357,22 +548,36 @@ def _discriminator_model(sess, features, disc_input):
 
     return model.get_output(), disc_vars
 
-def _generator_model(sess, features, labels, channels):
+def _generator_model(sess, features, labels, channels, per_sample_norm=False, upsample=None,
+                     training=True, fused=True, spec=None):
     # Upside-down all-convolutional resnet
 
+    if upsample is None:
+        upsample = FLAGS.generator_upsample
+
+    spec = generator_spec(spec)
+
     mapsize = 3
-    res_units  = [256, 128, 96]
+    res_units  = spec.res_units
 
     old_vars = tf.all_variables()
 
     # See Arxiv 1603.05027
-    model = Model('GEN', features)
+    model = Model('GEN', features, per_sample_norm=per_sample_norm, training=training, fused=fused)
 
     for ru in range(len(res_units)-1):
         nunits  = res_units[ru]
 
-        for j in range(2):
-            model.add_residual_block(nunits, mapsize=mapsize)
+        for j in range(spec.blocks[ru]):
+            model.add_residual_block(nunits, mapsize=mapsize, separable=spec.separable)
+
+        if upsample == 'subpixel':
+            # Same batch norm statistics as after a nearest neighbor upscale,
+            # but the convolution runs before the upscale
+            model.add_batch_norm()
+            model.add_relu()
+            model.add_subpixel_upscale(nunits, mapsize=mapsize, stddev_factor=1.)
+            continue
 
         # Spatial upscale (see http://distill.pub/2016/deconv-checkerboard/)
         # and transposed convolution
@@ -380,11 +585,17 @@ def _generator_model(sess, features, labels, channels):
         
         model.add_batch_norm()
         model.add_relu()
-        model.add_conv2d_transpose(nunits, mapsize=mapsize, stride=1, stddev_factor=1.)
+        if spec.separable:
+            model.add_separable_conv2d(nunits, mapsize=mapsize, stride=1, stddev_factor=1.)
+        else:
+            model.add_conv2d_transpose(nunits, mapsize=mapsize, stride=1, stddev_factor=1.)
 
     # Finalization a la "all convolutional net"
     nunits = res_units[-1]
-    model.add_conv2d(nunits, mapsize=mapsize, stride=1, stddev_factor=2.)
+    if spec.separable:
+        model.add_separable_conv2d(nunits, mapsize=mapsize, stride=1, stddev_factor=2.)
+    else:
+        model.add_conv2d(nunits, mapsize=mapsize, stride=1, stddev_factor=2.)
     # Worse: model.add_batch_norm()
     model.add_relu()
 
@@ -401,22 +612,104 @@ def _generator_model(sess, features, labels, channels):
 
     return model.get_output(), gene_vars
 
-def create_model(sess, features, labels):
+def _uses_per_sample_norm(norm):
+    if norm is None:
+        norm = FLAGS.inference_norm
+    if norm not in INFERENCE_NORMS:
+        raise ValueError("Invalid inference batch norm `%s'" % (norm,))
+
+    return norm == 'batch'
+
+def create_generator(features, norm=None, upsample=None, fused=True, spec=None, reuse=False):
+    """Builds the generator alone on top of `features`, in inference mode, e.g.
+    to evaluate checkpoints.
+
+    Returns its output and variables, which have the same names as in
+    `create_model`. `norm` is one of INFERENCE_NORMS: with 'batch' images
+    batched together don't change each other's output, like in the inference
+    engine, with 'moving' batch norms use their moving averages. `norm`,
+    `upsample` and `spec` default to FLAGS.inference_norm,
+    FLAGS.generator_upsample and FLAGS.generator_spec. With `reuse` the
+    generator shares the variables of one built before, and none are returned."""
+
+    channels = int(features.get_shape()[3])
+
+    with tf.variable_scope('gene', reuse=reuse):
+        gene_output, gene_var_list = _generator_model(None, features, None, channels,
+                                                      per_sample_norm=_uses_per_sample_norm(norm),
+                                                      upsample=upsample,
+                                                      training=False, fused=fused, spec=spec)
+
+    return gene_output, gene_var_list
+
+def check_moving_averages(checkpoint, var_list):
+    """Raises ValueError unless `checkpoint` has trained moving averages for
+    every batch norm of `var_list`, as built with norm='moving'.
+
+    Checkpoints trained before the batch norms updated them either lack them
+    or hold their initial values, and are only served right with 'batch'."""
+
+    reader  = tf.train.NewCheckpointReader(checkpoint)
+    moving  = [var.op.name for var in var_list if var.op.name.endswith(('/moving_mean', '/moving_variance'))]
+    missing = [name for name in moving if not reader.has_tensor(name)]
+    if missing:
+        raise ValueError("Checkpoint `%s' has no moving averages for `%s', use --inference_norm=batch"
+                         % (checkpoint, missing[0]))
+
+    initial = [np.all(reader.get_tensor(name) == (0. if name.endswith('/moving_mean') else 1.))
+               for name in moving]
+    if initial and all(initial):
+        raise ValueError("Moving averages of checkpoint `%s' were never updated, use --inference_norm=batch"
+                         % (checkpoint,))
+
+def create_teacher(features, spec, upsample=None):
+    """Frozen generator of layout `spec` on top of `features`, to distill a smaller one from.
+
+    Built in the 'teacher' variable scope with per-sample batch norm, which
+    works whether or not its checkpoint has moving averages. `upsample` is
+    the upsampling it was trained with, FLAGS.generator_upsample by default.
+    Returns its output, its variables and a saver restoring them from a
+    checkpoint of that layout, where they are named like in `create_model`."""
+
+    channels = int(features.get_shape()[3])
+
+    with tf.variable_scope('teacher'), tf.variable_scope('gene'):
+        teacher_output, teacher_var_list = _generator_model(None, features, None, channels,
+                                                            per_sample_norm=True, upsample=upsample,
+                                                            training=False, spec=spec)
+
+    saver = tf.train.Saver({var.op.name[len('teacher/'):]: var for var in teacher_var_list})
+
+    return tf.stop_gradient(teacher_output), teacher_var_list, saver
+
+def create_model(sess, features, labels, training=True, fused=True, spec=None):
+    """Builds the generator and discriminator.
+
+    `gene_output` and the discriminators run in training mode when
+    `training`, updating the moving averages of their batch norms through
+    the optimizers. `gene_moutput`, fed through `gene_minput` for demos and
+    test images, normalizes like FLAGS.inference_norm, as the inference
+    engine and `srez_eval` do, so that montages and the test metric the best
+    checkpoint is chosen by show what is served. The generator layout `spec`
+    defaults to FLAGS.generator_spec."""
+
     # Generator
-    rows      = int(features.get_shape()[1])
-    cols      = int(features.get_shape()[2])
     channels  = int(features.get_shape()[3])
 
-    gene_minput = tf.placeholder(tf.float32, shape=[FLAGS.batch_size, rows, cols, channels])
+    # Any batch and image size can be fed for demos and test images
+    gene_minput = tf.placeholder(tf.float32, shape=[None, None, None, channels])
 
     # TBD: Is there a better way to instance the generator?
     with tf.variable_scope('gene') as scope:
         gene_output, gene_var_list = \
-                    _generator_model(sess, features, labels, channels)
+                    _generator_model(sess, features, labels, channels, training=training, fused=fused,
+                                     spec=spec)
 
         scope.reuse_variables()
 
-        gene_moutput, _ = _generator_model(sess, gene_minput, labels, channels)
+        gene_moutput, _ = _generator_model(sess, gene_minput, labels, channels,
+                                           per_sample_norm=_uses_per_sample_norm(None),
+                                           training=False, fused=fused, spec=spec)
     
     # Discriminator with real data
     disc_real_input = tf.identity(labels, name='disc_real_input')
@@ -424,11 +717,11 @@ def create_model(sess, features, labels):
     # TBD: Is there a better way to instance the discriminator?
     with tf.variable_scope('disc') as scope:
         disc_real_output, disc_var_list = \
-                _discriminator_model(sess, features, disc_real_input)
+                _discriminator_model(sess, features, disc_real_input, training=training, fused=fused)
 
         scope.reuse_variables()
             
-        disc_fake_output, _ = _discriminator_model(sess, features, gene_output)
+        disc_fake_output, _ = _discriminator_model(sess, features, gene_output, training=training, fused=fused)
 
     return [gene_minput,      gene_moutput,
             gene_output,      gene_var_list,
@@ -464,6 +757,15 @@ def create_generator_loss(disc_output, gene_output, features):
     
     return gene_loss
 
+def create_distillation_loss(gene_loss, gene_output, teacher_output):
+    # I.e. does the student look like the teacher?
+    distill_l1_loss = tf.reduce_mean(tf.abs(gene_output - teacher_output), name='distill_l1_loss')
+
+    gene_loss       = tf.add((1.0 - FLAGS.distill_factor) * gene_loss,
+                             FLAGS.distill_factor * distill_l1_loss, name='distill_gene_loss')
+
+    return gene_loss
+
 def create_discriminator_loss(disc_real_output, disc_fake_output):
     # I.e. did we correctly identify the input as real or not?
     cross_entropy_real = tf.nn.sigmoid_cross_entropy_with_logits(logits = disc_real_output, labels = tf.ones_like(disc_real_output))
@@ -474,6 +776,60 @@ def create_discriminator_loss(disc_real_output, disc_fake_output):
 
     return disc_real_loss, disc_fake_loss
 
+def _update_ops(scope):
+    """Moving average updates of the batch norms under variable scope `scope`, in every tower"""
+
+    return [op for op in tf.get_collection(tf.GraphKeys.UPDATE_OPS)
+            if re.search(r'(^|/)%s/' % (scope,), op.name)]
+
+def _average_gradients(tower_grads_and_vars):
+    """Mean over the towers of each variable's gradient, computed where the variable lives"""
+
+    averaged = []
+    for grads_and_vars in zip(*tower_grads_and_vars):
+        var = grads_and_vars[0][1]
+        if grads_and_vars[0][0] is None:
+            # E.g. moving batch norm statistics, skipped by apply_gradients
+            averaged.append((None, var))
+            continue
+
+        with tf.device(var.device):
+            grad = tf.add_n([g for g, _ in grads_and_vars]) / len(grads_and_vars)
+        averaged.append((grad, var))
+
+    return averaged
+
+def create_parallel_optimizers(gene_losses, gene_var_list,
+                               disc_losses, disc_var_list):
+    """Same as `create_optimizers` for one loss per tower of a data-parallel model.
+
+    Each tower's gradients are computed next to its forward pass, and the
+    variables are updated once per step with the mean gradient, so the
+    towers train synchronously."""
+
+    global_step    = tf.Variable(0, dtype=tf.int64,   trainable=False, name='global_step')
+    learning_rate  = tf.placeholder(dtype=tf.float32, name='learning_rate')
+
+    gene_opti = tf.train.AdamOptimizer(learning_rate=learning_rate,
+                                       beta1=FLAGS.learning_beta1,
+                                       name='gene_optimizer')
+    disc_opti = tf.train.AdamOptimizer(learning_rate=learning_rate,
+                                       beta1=FLAGS.learning_beta1,
+                                       name='disc_optimizer')
+
+    gene_grads = [gene_opti.compute_gradients(loss, var_list=gene_var_list, colocate_gradients_with_ops=True)
+                  for loss in gene_losses]
+    disc_grads = [disc_opti.compute_gradients(loss, var_list=disc_var_list, colocate_gradients_with_ops=True)
+                  for loss in disc_losses]
+
+    with tf.control_dependencies(_update_ops('gene')):
+        gene_minimize = gene_opti.apply_gradients(_average_gradients(gene_grads), name='gene_loss_minimize', global_step=global_step)
+
+    with tf.control_dependencies(_update_ops('disc')):
+        disc_minimize = disc_opti.apply_gradients(_average_gradients(disc_grads), name='disc_loss_minimize', global_step=global_step)
+
+    return (global_step, learning_rate, gene_minimize, disc_minimize)
+
 def create_optimizers(gene_loss, gene_var_list,
                       disc_loss, disc_var_list):    
     # TBD: Does this global step variable need to be manually incremented? I think so.
@@ -487,8 +843,11 @@ def create_optimizers(gene_loss, gene_var_list,
                                        beta1=FLAGS.learning_beta1,
                                        name='disc_optimizer')
 
-    gene_minimize = gene_opti.minimize(gene_loss, var_list=gene_var_list, name='gene_loss_minimize', global_step=global_step)
+    # Moving averages of the batch norms are updated with each step
+    with tf.control_dependencies(_update_ops('gene')):
+        gene_minimize = gene_opti.minimize(gene_loss, var_list=gene_var_list, name='gene_loss_minimize', global_step=global_step)
     
-    disc_minimize     = disc_opti.minimize(disc_loss, var_list=disc_var_list, name='disc_loss_minimize', global_step=global_step)
+    with tf.control_dependencies(_update_ops('disc')):
+        disc_minimize     = disc_opti.minimize(disc_loss, var_list=disc_var_list, name='disc_loss_minimize', global_step=global_step)
     
     return (global_step, learning_rate, gene_minimize, disc_minimize)
@@ -0,0 +1,152 @@
+"""Synchronous data-parallel training over local worker processes.
+
+The training process and `num_workers - 1` processes started with
+--run=worker form a TensorFlow cluster on localhost. The training process
+builds a single graph with one tower per worker (in-graph replication):
+every tower reads its own share of the files and runs the generator and
+discriminator on its share of the batch in its own process, and the
+gradients are averaged where the variables live, in the training process,
+before one update per step. The training loop doesn't change, each
+`sess.run` drives every worker."""
+
+import srez_input
+import srez_model
+
+import os
+import subprocess
+import sys
+
+import tensorflow as tf
+
+FLAGS = tf.app.flags.FLAGS
+
+def cluster_spec(num_workers, port=None):
+    if port is None:
+        port = FLAGS.worker_port
+
+    return tf.train.ClusterSpec({'worker': ['localhost:%d' % (port + i,) for i in range(num_workers)]})
+
+def worker_config(num_workers):
+    """Session config splitting the CPUs of the host between the workers"""
+
+    threads = max(1, (os.cpu_count() or 1) // num_workers)
+    return tf.ConfigProto(intra_op_parallelism_threads=threads,
+                          inter_op_parallelism_threads=2,
+                          log_device_placement=FLAGS.log_device_placement)
+
+def run_worker():
+    """Serves one worker task until the training process stops it"""
+
+    server = tf.train.Server(cluster_spec(FLAGS.num_workers), job_name='worker',
+                             task_index=FLAGS.task_index, config=worker_config(FLAGS.num_workers))
+    server.join()
+
+class LocalCluster(object):
+    """The server of the training process, task 0, and the processes of the other workers.
+
+    Workers listen on consecutive ports from `port`, by default
+    FLAGS.worker_port. The server of the training process can't be stopped,
+    so its port stays taken until the process exits."""
+
+    def __init__(self, num_workers, port=None):
+        if port is None:
+            port = FLAGS.worker_port
+
+        self.num_workers = num_workers
+
+        self.server    = tf.train.Server(cluster_spec(num_workers, port), job_name='worker', task_index=0,
+                                         config=worker_config(num_workers))
+        self.processes = [subprocess.Popen([sys.executable, sys.argv[0], '--run=worker',
+                                            '--num_workers=%d' % (num_workers,),
+                                            '--task_index=%d' % (i,),
+                                            '--worker_port=%d' % (port,)])
+                          for i in range(1, num_workers)]
+
+    @property
+    def target(self):
+        return self.server.target
+
+    def close(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+def create_towers(train_filenames, num_workers):
+    """Builds one training tower per worker. Must be called in the graph of a
+    session on the `LocalCluster` target.
+
+    FLAGS.batch_size is split evenly between the towers. Returns the same
+    names `_train` sets up for `srez_train.train_model`, losses being the
+    mean over the towers, plus `train_inputs`, the features and labels of
+    every tower."""
+
+    tower_batch = FLAGS.batch_size // num_workers
+    if tower_batch < 1:
+        raise ValueError("Can't split a batch of %d between %d workers" % (FLAGS.batch_size, num_workers))
+    if tower_batch * num_workers != FLAGS.batch_size:
+        print("    Training with batches of %d, %d per worker" % (tower_batch * num_workers, tower_batch))
+
+    towers = []
+    for i in range(num_workers):
+        # Variables stay in the training process, everything else runs in the worker
+        device = tf.train.replica_device_setter(ps_tasks=1, ps_device='/job:worker',
+                                                worker_device='/job:worker/task:%d' % (i,))
+        with tf.device(device), tf.variable_scope(tf.get_variable_scope(), reuse=i > 0), \
+             tf.name_scope('tower%d' % (i,)):
+            if FLAGS.input_shards:
+                features, labels = srez_input.setup_shard_inputs(None, FLAGS.input_shards, 'train',
+                                                                 batch_size=tower_batch)
+            else:
+                features, labels = srez_input.setup_dataset_inputs(None, train_filenames[i::num_workers],
+                                                                   batch_size=tower_batch)
+
+            # Add some noise during training (think denoising autoencoders)
+            noise_level = .03
+            noisy_features = features + tf.random_normal(features.get_shape(), stddev=noise_level)
+
+            [gene_minput, gene_moutput,
+             gene_output, gene_var_list,
+             disc_real_output, disc_fake_output, disc_var_list] = \
+                    srez_model.create_model(None, noisy_features, labels)
+
+            gene_loss = srez_model.create_generator_loss(disc_fake_output, gene_output, features)
+            disc_real_loss, disc_fake_loss = \
+                             srez_model.create_discriminator_loss(disc_real_output, disc_fake_output)
+            disc_loss = tf.add(disc_real_loss, disc_fake_loss, name='disc_loss')
+
+        towers.append({'features':       features,
+                       'labels':         labels,
+                       'gene_minput':    gene_minput,
+                       'gene_moutput':   gene_moutput,
+                       'gene_var_list':  gene_var_list,
+                       'disc_var_list':  disc_var_list,
+                       'gene_loss':      gene_loss,
+                       'disc_real_loss': disc_real_loss,
+                       'disc_fake_loss': disc_fake_loss,
+                       'disc_loss':      disc_loss})
+
+    # Variables are only created by the first tower
+    first = towers[0]
+
+    with tf.device('/job:worker/task:0'):
+        (global_step, learning_rate, gene_minimize, disc_minimize) = \
+                srez_model.create_parallel_optimizers([t['gene_loss'] for t in towers], first['gene_var_list'],
+                                                      [t['disc_loss'] for t in towers], first['disc_var_list'])
+
+        names = {'gene_minput':    first['gene_minput'],
+                 'gene_moutput':   first['gene_moutput'],
+                 'gene_var_list':  first['gene_var_list'],
+                 'disc_var_list':  first['disc_var_list'],
+                 'train_features': first['features'],
+                 'train_labels':   first['labels'],
+                 'train_inputs':   [t[key] for t in towers for key in ('features', 'labels')],
+                 'gene_loss':      tf.add_n([t['gene_loss'] for t in towers]) / num_workers,
+                 'disc_real_loss': tf.add_n([t['disc_real_loss'] for t in towers]) / num_workers,
+                 'disc_fake_loss': tf.add_n([t['disc_fake_loss'] for t in towers]) / num_workers,
+                 'global_step':    global_step,
+                 'learning_rate':  learning_rate,
+                 'gene_minimize':  gene_minimize,
+                 'disc_minimize':  disc_minimize}
+
+    return names
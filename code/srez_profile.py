@@ -0,0 +1,154 @@
+import collections
+import json
+import re
+import time
+
+import numpy as np
+import tensorflow as tf
+
+FLAGS = tf.app.flags.FLAGS
+
+# Layer scopes from Model._get_layer_str, e.g. gene/GEN_L004/Conv2D, or
+# disc/DIS_L001_1/Conv2D for the second instance of the discriminator
+_LAYER_NAME = re.compile(r'\b((?:GEN|DIS)_L\d{3})(?!\d)')
+
+def layer_of(node_name):
+    """`GEN_Lxxx` or `DIS_Lxxx` layer a graph node belongs to, with '/grad' appended
+    for its gradients, or 'other' for nodes outside the models' layers"""
+
+    match = _LAYER_NAME.search(node_name)
+    if match is None:
+        return 'other'
+
+    if node_name.startswith('gradients') or '/gradients' in node_name:
+        return match.group(1) + '/grad'
+
+    return match.group(1)
+
+def _traced_devices(step_stats):
+    # On GPUs 'stream:all' holds the kernel times. The device's own entry only
+    # has launch times, and individual streams repeat 'stream:all'
+    names = [dev_stats.device for dev_stats in step_stats.dev_stats]
+    streams = set(name[:-len('/stream:all')] for name in names if name.endswith('/stream:all'))
+
+    for dev_stats in step_stats.dev_stats:
+        name = dev_stats.device
+        if '/stream:' in name and not name.endswith('/stream:all'):
+            continue
+        if name in streams:
+            continue
+        yield dev_stats
+
+def layer_times(run_metadata):
+    """Microseconds spent in each layer by a traced run, see `layer_of`"""
+
+    times = collections.Counter()
+    for dev_stats in _traced_devices(run_metadata.step_stats):
+        for node in dev_stats.node_stats:
+            times[layer_of(node.node_name)] += node.all_end_rel_micros
+
+    return times
+
+class StepProfiler(object):
+    """Times every training step split in input wait, generator update and
+    discriminator update, and traces one step in `trace_period` per layer.
+
+    Each step becomes a JSON line in `log_path`. `close` appends a summary
+    with the mean timings and the costliest layers, and prints it.
+
+    To be told apart the input and both updates run separately: the batch is
+    fetched first and fed to both updates. The discriminator therefore sees
+    the generator after its update, and different noise, unlike unprofiled
+    training where both updates share one run."""
+
+    def __init__(self, sess, log_path, trace_period=100, top_layers=10):
+        self.sess         = sess
+        self.trace_period = trace_period
+        self.top_layers   = top_layers
+
+        self._log    = open(log_path, 'w')
+        self._steps  = collections.defaultdict(list)
+        self._layers = {'gene': collections.Counter(), 'disc': collections.Counter()}
+        self._traces = 0
+
+    def run_step(self, batch, inputs, gene_fetches, disc_fetches, feed_dict):
+        """Runs one training step. Returns the values of `gene_fetches` and `disc_fetches`"""
+
+        start_time = time.time()
+        feed_dict  = dict(feed_dict)
+        feed_dict.update(zip(inputs, self.sess.run(inputs)))
+        input_time = time.time()
+
+        trace = self.trace_period > 0 and batch % self.trace_period == 0
+        if trace:
+            options  = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+            metadata = {'gene': tf.RunMetadata(), 'disc': tf.RunMetadata()}
+        else:
+            options  = None
+            metadata = {'gene': None, 'disc': None}
+
+        gene_values = self.sess.run(gene_fetches, feed_dict=feed_dict,
+                                    options=options, run_metadata=metadata['gene'])
+        gene_time   = time.time()
+
+        disc_values = self.sess.run(disc_fetches, feed_dict=feed_dict,
+                                    options=options, run_metadata=metadata['disc'])
+        disc_time   = time.time()
+
+        record = {'batch':      batch,
+                  'input_wait': input_time - start_time,
+                  'gene':       gene_time - input_time,
+                  'disc':       disc_time - gene_time,
+                  'total':      disc_time - start_time}
+
+        # Traced steps are slower and would skew the timings
+        if trace:
+            record['traced'] = True
+            record['layers'] = {}
+            for name in ('gene', 'disc'):
+                times = layer_times(metadata[name])
+                self._layers[name].update(times)
+                record['layers'][name] = dict(times)
+            self._traces += 1
+        else:
+            for key in ('input_wait', 'gene', 'disc', 'total'):
+                self._steps[key].append(record[key])
+
+        self._log.write(json.dumps(record) + '\n')
+
+        return gene_values, disc_values
+
+    def summary(self):
+        """Mean and 90th percentile step timings in seconds, and the costliest
+        layers of each update in mean microseconds per traced step"""
+
+        summary = {'steps': len(self._steps['total']), 'traces': self._traces}
+        for key, values in self._steps.items():
+            if not values:
+                continue
+            summary[key] = {'mean': float(np.mean(values)), 'p90': float(np.percentile(values, 90))}
+
+        summary['top_layers'] = {}
+        for name, times in self._layers.items():
+            summary['top_layers'][name] = [(layer, micros / max(self._traces, 1))
+                                           for layer, micros in times.most_common(self.top_layers)]
+
+        return summary
+
+    def close(self):
+        """Writes and prints the summary, and closes the log"""
+
+        summary = self.summary()
+        self._log.write(json.dumps({'summary': summary}) + '\n')
+        self._log.close()
+
+        print("Profiled %d steps:" % (summary['steps'],))
+        for key in ('input_wait', 'gene', 'disc', 'total'):
+            if key in summary:
+                print("    %-10s %8.2fms mean, %8.2fms p90" %
+                      (key, 1000 * summary[key]['mean'], 1000 * summary[key]['p90']))
+
+        for name in ('gene', 'disc'):
+            print("Costliest layers of the %s update, over %d traced steps:" % (name, summary['traces']))
+            for layer, micros in summary['top_layers'][name]:
+                print("    %-14s %10.0fus" % (layer, micros))
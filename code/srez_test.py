@@ -0,0 +1,92 @@
+import os.path
+import random
+import shutil
+import tempfile
+import unittest
+
+import tensorflow as tf
+
+import srez_checkpoint
+import srez_main
+
+FLAGS = tf.app.flags.FLAGS
+
+
+class PrepareDirsTest(unittest.TestCase):
+    """Training and evaluation must see the same held-out images in every run"""
+
+    def setUp(self):
+        FLAGS(['srez_test'])
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        dataset = os.path.join(self.directory, 'dataset')
+        os.makedirs(dataset)
+        for i in range(50):
+            open(os.path.join(dataset, '%06d.jpg' % (i,)), 'wb').close()
+
+        for name, value in (('dataset', dataset), ('checkpoint_dir', os.path.join(self.directory, 'checkpoint'))):
+            self.addCleanup(setattr, FLAGS, name, getattr(FLAGS, name))
+            setattr(FLAGS, name, value)
+
+    def test_split_is_deterministic(self):
+        first = srez_main.prepare_dirs()
+
+        random.seed()
+        second = srez_main.prepare_dirs()
+
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, sorted(first))
+
+
+class CheckpointRetentionTest(unittest.TestCase):
+    """Retention must only delete checkpoints the manager wrote"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        # Shipped checkpoint, from before CheckpointManager
+        self.legacy = os.path.join(self.directory, 'checkpoint_new.txt.index')
+        open(self.legacy, 'wb').close()
+        tf.train.update_checkpoint_state(self.directory, 'checkpoint_new.txt')
+
+    def test_legacy_checkpoint_is_kept(self):
+        with tf.Graph().as_default(), tf.Session() as sess:
+            global_step = tf.Variable(0, name='global_step')
+            sess.run(tf.global_variables_initializer())
+
+            manager = srez_checkpoint.CheckpointManager(sess, self.directory, global_step, keep=1)
+            for step in range(1, 4):
+                sess.run(global_step.assign(step))
+                manager.save()
+            manager.close()
+
+        self.assertTrue(os.path.exists(self.legacy))
+        self.assertEqual(tf.train.latest_checkpoint(self.directory), os.path.join(self.directory, 'checkpoint-3'))
+        self.assertFalse(tf.gfile.Glob(os.path.join(self.directory, 'checkpoint-1.*')))
+
+    def _save(self, metrics, keep):
+        with tf.Graph().as_default(), tf.Session() as sess:
+            global_step = tf.Variable(0, name='global_step')
+            sess.run(tf.global_variables_initializer())
+
+            manager = srez_checkpoint.CheckpointManager(sess, self.directory, global_step, keep=keep)
+            for step, metric in enumerate(metrics, 1):
+                sess.run(global_step.assign(step))
+                manager.save(metric)
+            manager.close()
+
+        return sorted(os.path.basename(path)[:-len('.index')]
+                      for path in tf.gfile.Glob(os.path.join(self.directory, 'checkpoint-*.index')))
+
+    def test_keep_zero_keeps_the_best(self):
+        self.assertEqual(self._save([3., 1., 2.], keep=0), ['checkpoint-2'])
+
+    def test_keep_zero_without_metrics_keeps_the_latest(self):
+        self.assertEqual(self._save([None, None], keep=0), ['checkpoint-2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
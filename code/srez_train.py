@@ -1,15 +1,29 @@
+import srez_checkpoint
+import srez_profile
+
 import numpy as np
 import os.path
+import queue
 import scipy.misc
 import tensorflow as tf
+import threading
 import time
 
 FLAGS = tf.app.flags.FLAGS
 
-def _summarize_progress(train_data, feature, label, gene_output, batch, suffix, max_samples=8):
+def _build_montage(train_data, label_shape, max_samples=8):
+    """Montage of the nearest, bicubic, generator and reference images of the
+    test vectors, stacked vertically. Built once at setup.
+
+    Returns the montage and the placeholder its labels are fed to, the
+    features go to `gene_minput`."""
+
     td = train_data
 
-    size = [label.shape[1], label.shape[2]]
+    feature = td.gene_minput
+    label   = tf.placeholder(tf.float32, shape=label_shape, name='montage_label')
+
+    size = [label_shape[1], label_shape[2]]
 
     nearest = tf.image.resize_nearest_neighbor(feature, size)
     nearest = tf.maximum(tf.minimum(nearest, 1.0), 0.0)
@@ -17,55 +31,82 @@ def _summarize_progress(train_data, feature, label, gene_output, batch, suffix,
     bicubic = tf.image.resize_bicubic(feature, size)
     bicubic = tf.maximum(tf.minimum(bicubic, 1.0), 0.0)
 
-    clipped = tf.maximum(tf.minimum(gene_output, 1.0), 0.0)
+    clipped = tf.maximum(tf.minimum(td.gene_moutput, 1.0), 0.0)
 
     image   = tf.concat([nearest, bicubic, clipped, label], 2)
 
+    max_samples = min(max_samples, label_shape[0])
     image = image[0:max_samples,:,:,:]
     image = tf.concat([image[i,:,:,:] for i in range(max_samples)], 0)
-    image = td.sess.run(image)
 
-    filename = 'batch%06d_%s.png' % (batch, suffix)
-    filename = os.path.join(FLAGS.train_dir, filename)
-    scipy.misc.toimage(image, cmin=0., cmax=1.).save(filename)
-    print("    Saved %s" % (filename,))
+    return image, label
 
-def _save_checkpoint(train_data, batch):
-    td = train_data
+class ImageWriter(object):
+    """Encodes and saves montages on a background thread.
+
+    At most `max_pending` images wait to be written. Further ones are skipped
+    rather than holding up training."""
+
+    def __init__(self, max_pending=4):
+        self.skipped = 0
+
+        self._queue  = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='summary-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, filename, image):
+        try:
+            self._queue.put_nowait((filename, image))
+        except queue.Full:
+            self.skipped += 1
+            print("    Skipped %s, %d images still being written" % (filename, self._queue.maxsize))
 
-    oldname = 'checkpoint_old.txt'
-    newname = 'checkpoint_new.txt'
+    def close(self):
+        """Waits for the pending images to be written"""
 
-    oldname = os.path.join(FLAGS.checkpoint_dir, oldname)
-    newname = os.path.join(FLAGS.checkpoint_dir, newname)
+        self._queue.put(None)
+        self._thread.join()
 
-    # Delete oldest checkpoint
-    try:
-        tf.gfile.Remove(oldname)
-        tf.gfile.Remove(oldname + '.meta')
-    except:
-        pass
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
 
-    # Rename old checkpoint
-    try:
-        tf.gfile.Rename(newname, oldname)
-        tf.gfile.Rename(newname + '.meta', oldname + '.meta')
-    except:
-        pass
+            filename, image = item
+            try:
+                scipy.misc.toimage(image, cmin=0., cmax=1.).save(filename)
+                print("    Saved %s" % (filename,))
+            except Exception as e:
+                print("    Could not save %s: %s" % (filename, e))
 
-    # Generate new checkpoint
-    saver = tf.train.Saver()
-    saver.save(td.sess, newname)
+def _test_l1(train_data, test_feature, test_label):
+    # Metric the best checkpoint is chosen by, lower is better
+    td = train_data
 
-    print("    Checkpoint saved")
+    gene_output = td.sess.run(td.gene_moutput, feed_dict={td.gene_minput: test_feature})
+    return float(np.abs(gene_output - test_label).mean())
 
 def train_model(train_data):
     td = train_data
 
     summaries = tf.summary.merge_all()
     td.sess.run(tf.initialize_all_variables())
-    saver = tf.train.Saver()
-    saver.restore(td.sess, tf.train.latest_checkpoint("./checkpoint/"))
+
+    # When distilling, the teacher is restored from its own checkpoint and
+    # left out of the student's
+    teacher_saver = getattr(td, 'teacher_saver', None)
+    if teacher_saver is not None:
+        teacher_saver.restore(td.sess, td.teacher_checkpoint)
+        print("    Restored teacher %s" % (td.teacher_checkpoint,))
+
+    teacher_names = set(var.op.name for var in getattr(td, 'teacher_var_list', []))
+    var_list      = [var for var in tf.global_variables() if var.op.name not in teacher_names]
+
+    checkpoints = srez_checkpoint.CheckpointManager(td.sess, FLAGS.checkpoint_dir, td.global_step,
+                                                    keep=FLAGS.checkpoint_keep, var_list=var_list)
+    checkpoints.restore()
 	
     lrval       = FLAGS.learning_rate_start
     start_time  = time.time()
@@ -77,14 +118,32 @@ def train_model(train_data):
     # Cache test features and labels (they are small)
     test_feature, test_label = td.sess.run([td.test_features, td.test_labels])
 
+    montage, montage_label = _build_montage(td, test_label.shape)
+    montage_feed = {td.gene_minput: test_feature, montage_label: test_label}
+    image_writer = ImageWriter()
+
+    profiler = None
+    if FLAGS.profile_log:
+        profiler = srez_profile.StepProfiler(td.sess, FLAGS.profile_log, FLAGS.profile_trace_period)
+
+    # Everything the loop runs exists by now, adding ops from here on is a bug
+    td.sess.graph.finalize()
+
     while not done:
         batch += 1
         gene_loss = disc_real_loss = disc_fake_loss = -1.234
 
         feed_dict = {td.learning_rate : lrval}
 
-        ops = [td.gene_minimize, td.disc_minimize, td.gene_loss, td.disc_real_loss, td.disc_fake_loss]
-        _, _, gene_loss, disc_real_loss, disc_fake_loss = td.sess.run(ops, feed_dict=feed_dict)
+        if profiler is None:
+            ops = [td.gene_minimize, td.disc_minimize, td.gene_loss, td.disc_real_loss, td.disc_fake_loss]
+            _, _, gene_loss, disc_real_loss, disc_fake_loss = td.sess.run(ops, feed_dict=feed_dict)
+        else:
+            (_, gene_loss), (_, disc_real_loss, disc_fake_loss) = \
+                profiler.run_step(batch, td.train_inputs,
+                                  [td.gene_minimize, td.gene_loss],
+                                  [td.disc_minimize, td.disc_real_loss, td.disc_fake_loss],
+                                  feed_dict)
         
         if batch % 10 == 0:
             # Show we are alive
@@ -104,13 +163,21 @@ def train_model(train_data):
 
         if batch % FLAGS.summary_period == 0:
             # Show progress with test features
-            feed_dict = {td.gene_minput: test_feature}
-            gene_output = td.sess.run(td.gene_moutput, feed_dict=feed_dict)
-            _summarize_progress(td, test_feature, test_label, gene_output, batch, 'out')
+            filename = os.path.join(FLAGS.train_dir, 'batch%06d_out.png' % (batch,))
+            image_writer.write(filename, td.sess.run(montage, feed_dict=montage_feed))
             
         if batch % FLAGS.checkpoint_period == 0:
             # Save checkpoint
-            _save_checkpoint(td, batch)
+            checkpoints.save(_test_l1(td, test_feature, test_label))
+
+    checkpoints.save(_test_l1(td, test_feature, test_label))
+    checkpoints.close()
+    image_writer.close()
+
+    if profiler is not None:
+        profiler.close()
 
-    _save_checkpoint(td, batch)
+    if checkpoints.stalls:
+        print("Checkpoints stalled training for %.3fs on average, %.3fs at most" %
+              (np.mean(checkpoints.stalls), np.max(checkpoints.stalls)))
     print('Finished training!')
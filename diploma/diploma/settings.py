@@ -121,4 +121,67 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
-MEDIA_URL = '/media/'
\ No newline at end of file
+MEDIA_URL = '/media/'
+
+# Background super-resolution workers, see superez/jobs.py
+
+SUPEREZ_WORKERS = 2
+
+SUPEREZ_WORKER_THREADS = 1
+
+SUPEREZ_WORKER_POLL_SECONDS = 1.0
+
+# Jobs left running this long, e.g. by a worker that died, are queued again.
+# runworkers looks for them every SUPEREZ_STALE_CHECK_SECONDS
+SUPEREZ_STALE_JOB_SECONDS = 3600
+
+SUPEREZ_STALE_CHECK_SECONDS = 60
+
+# Uploads are refused with 503 once this many are waiting
+SUPEREZ_MAX_PENDING_JOBS = 100
+
+# Restored images are cached by content hash, least recently used are evicted
+SUPEREZ_CACHE_DIR = "superez/cache"
+
+SUPEREZ_CACHE_MAX_MB = 1024
+
+# Engine the workers restore images with: 'tensorflow', or 'numpy' to serve
+# without TensorFlow from weights written by `manage.py exportgenerator --format numpy`
+SUPEREZ_ENGINE = 'tensorflow'
+
+SUPEREZ_NUMPY_WEIGHTS = "superez/srezmodel/checkpoint/generator.npz"
+
+# Statistics the batch norms of checkpoints are served with: 'batch' normalizes
+# every image by its own, 'moving' uses the moving averages, which only
+# checkpoints trained with them have. Exported generators use the statistics
+# they were exported with, see `manage.py exportgenerator --statistics`
+SUPEREZ_INFERENCE_NORM = 'batch'
+
+# JPEG uploads with more pixels than this are decoded at 1/2 or 1/4 scale, as
+# long as that keeps this many, and restored back to their full size. 0 decodes
+# every upload at full size
+SUPEREZ_DECODE_MAX_PIXELS = 0
+
+# Quality tiers: uploads asking for 'auto' get the best tier expected to be
+# restored within this many seconds of the upload, given the queue depth
+SUPEREZ_LATENCY_SLO_SECONDS = 60
+
+# Seconds per image assumed for each tier until jobs served at it were timed
+SUPEREZ_TIER_SECONDS = {'bicubic': 0.1, 'small': 1.0, 'full': 5.0}
+
+# Checkpoint folder and generator layout of the 'small' tier, e.g. a student
+# trained with `--run=distill`, and its weights for the 'numpy' engine
+SUPEREZ_SMALL_CHECKPOINT_DIR = "superez/srezmodel/checkpoint_small"
+
+SUPEREZ_SMALL_SPEC = 'small'
+
+SUPEREZ_NUMPY_SMALL_WEIGHTS = "superez/srezmodel/checkpoint_small/generator.npz"
+
+# Adaptive compute: when above 0, images are split in blocks of this many
+# input pixels and blocks with a gradient energy below the threshold are
+# upscaled bicubic instead of by the generator. The generator still runs on
+# tiles as large as the memory budget allows. See `manage.py benchadaptive`
+# for the skip rate and PSNR cost of a threshold
+SUPEREZ_ADAPTIVE_THRESHOLD = 0
+
+SUPEREZ_ADAPTIVE_BLOCK = 32
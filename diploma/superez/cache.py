@@ -0,0 +1,124 @@
+import os
+import shutil
+import threading
+
+
+def _link_or_copy(source, destination):
+    # Hard links share the bytes when both paths are on the same filesystem
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ResultCache(object):
+    """Content-addressed store of restored images with size-bounded LRU eviction.
+
+    Entries are named after the hash of the uploaded image. Reading an entry
+    refreshes its modification time, and every write evicts the least recently
+    used entries until the cache fits in `max_bytes` again. Several processes
+    can share the same folder: entries are only ever replaced atomically."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits      = 0
+        self.misses    = 0
+
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits   += 1
+            else:
+                self.misses += 1
+
+    def restore(self, key, path):
+        """Places the cached result for `key` at `path`, replacing any file there.
+
+        Returns False, and leaves `path` alone, when there is no such entry."""
+
+        cached = self._path(key)
+        temp   = os.path.join(os.path.dirname(path),
+                              '.%s.%d.%d' % (os.path.basename(path), os.getpid(), threading.get_ident()))
+        try:
+            os.utime(cached, None)
+            if not (os.path.exists(path) and os.path.samefile(cached, path)):
+                _link_or_copy(cached, temp)
+                os.replace(temp, path)
+        except FileNotFoundError:
+            # Evicted meanwhile, or never stored
+            if os.path.exists(temp):
+                os.remove(temp)
+            self._count(hit=False)
+            return False
+
+        self._count(hit=True)
+        return True
+
+    def put(self, key, path):
+        """Stores a copy of the file at `path` as the result for `key`"""
+
+        cached = self._path(key)
+        os.makedirs(os.path.dirname(cached), exist_ok=True)
+
+        temp = os.path.join(os.path.dirname(cached), '.%s.%d.%d' % (key, os.getpid(), threading.get_ident()))
+        _link_or_copy(path, temp)
+        os.replace(temp, cached)
+
+        self.evict()
+
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return
+
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+
+            for entry in os.scandir(subdir.path):
+                if entry.is_file() and not entry.name.startswith('.'):
+                    yield entry
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in `max_bytes`"""
+
+        entries = []
+        for entry in self._entries():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        """Hit and miss counts of this process, and the current cache size"""
+
+        entries = 0
+        nbytes  = 0
+        for entry in self._entries():
+            entries += 1
+            nbytes  += entry.stat().st_size
+
+        with self._lock:
+            hits, misses = self.hits, self.misses
+
+        lookups = hits + misses
+        return {'hits':      hits,
+                'misses':    misses,
+                'hit_ratio': hits / float(lookups) if lookups else 0.0,
+                'entries':   entries,
+                'bytes':     nbytes,
+                'max_bytes': self.max_bytes}
@@ -1,8 +1,20 @@
 from django import forms
 
+from superez.models import Document
+
 
 class DocumentForm(forms.Form):
-    docfile = forms.FileField(
+    # Decodes the upload from memory to reject anything that is not an image
+    # before it is stored or queued
+    docfile = forms.ImageField(
         label='Select a file',
         help_text='max. 42 megabytes'
     )
+
+    # Left out of API uploads, the worker then picks the tier
+    tier = forms.ChoiceField(
+        label='Quality',
+        choices=Document.REQUESTED_TIER_CHOICES,
+        initial=Document.AUTO,
+        required=False
+    )
@@ -0,0 +1,355 @@
+"""Background super-resolution jobs.
+
+Every upload is a `Document` row that doubles as a job: the web process only
+stores the file and returns, worker processes started with
+`manage.py runworkers` claim pending rows from the database and run the
+generator on them.
+
+Each job is served at a quality tier: bicubic upscaling alone, the small
+generator or the full one. Uploads may ask for a tier, by default the worker
+picks one when it claims the job, so that a deep queue sheds compute rather
+than missing `SUPEREZ_LATENCY_SLO_SECONDS`. Generator tiers are only served
+by workers that have their weights."""
+
+import datetime
+import threading
+import time
+import traceback
+
+from django.conf import settings
+from django.db.models import Count, Min
+from django.utils import timezone
+
+from superez.cache import ResultCache
+from superez.models import Document
+
+
+# Restored images keyed by the hash of the upload, shared by all processes
+result_cache = ResultCache(settings.SUPEREZ_CACHE_DIR, settings.SUPEREZ_CACHE_MAX_MB * 2**20)
+
+
+# Best first
+TIERS = (Document.FULL, Document.SMALL, Document.BICUBIC)
+
+# Latest jobs of a tier its time per image is estimated from
+TIER_SAMPLES = 20
+
+# Tiers this process has weights for, see `available_tiers`
+_available_tiers = None
+
+# Jobs all workers run at once, as started by `manage.py runworkers`, see `work`
+_capacity = None
+
+
+def _inference(tier=Document.FULL):
+    """Restore function of the configured engine at `tier`.
+
+    Imported on first use, so that only worker processes load the engine
+    and the web process never imports TensorFlow."""
+
+    if tier == Document.BICUBIC:
+        from superez.srezmodel.images import restore_bicubic
+        return lambda path: restore_bicubic(path, settings.SUPEREZ_DECODE_MAX_PIXELS)
+
+    if settings.SUPEREZ_ENGINE == 'numpy':
+        from superez.srezmodel.numpy_engine import inference
+    else:
+        from superez.srezmodel.inference import inference
+
+    return lambda path: inference(path, tier=tier)
+
+def _cache_key(content_hash, tier):
+    # Full generator results keep the keys they had before there were tiers
+    if tier == Document.FULL:
+        return content_hash
+
+    return '%s-%s' % (content_hash, tier)
+
+
+def available_tiers():
+    """Tiers this process can serve, best first: bicubic, and the generators
+    whose weights exist. Looked up once, so that a missing generator isn't
+    tried again on every job"""
+
+    global _available_tiers
+    if _available_tiers is None:
+        if settings.SUPEREZ_ENGINE == 'numpy':
+            from superez.srezmodel.numpy_engine import has_weights
+        else:
+            from superez.srezmodel.inference import has_weights
+
+        _available_tiers = tuple(tier for tier in TIERS if tier == Document.BICUBIC or has_weights(tier))
+        print("    Serving tiers: %s" % (', '.join(_available_tiers),))
+
+    return _available_tiers
+
+def tier_seconds():
+    """Seconds per job at each tier, the mean of its latest jobs, or
+    `SUPEREZ_TIER_SECONDS` until it served any"""
+
+    seconds = dict(settings.SUPEREZ_TIER_SECONDS)
+    for tier in TIERS:
+        timed = Document.objects.filter(status=Document.DONE, tier=tier,
+                                        started__isnull=False, finished__isnull=False) \
+                                .order_by('-finished') \
+                                .values_list('started', 'finished')[:TIER_SAMPLES]
+
+        durations = [(finished - started).total_seconds() for started, finished in timed]
+        if durations:
+            seconds[tier] = sum(durations) / len(durations)
+
+    return seconds
+
+def pick_tier(waited, depth, seconds, capacity, slo, tiers=TIERS):
+    """Best of `tiers` expected to restore a job within `slo` seconds of its upload.
+
+    The job already `waited` seconds, and `depth` jobs are pending behind it,
+    served `capacity` at a time at the same tier, so that a growing queue
+    lowers the quality before it raises the latency. `seconds` are the times
+    per job by tier. Falls back to bicubic when nothing fits."""
+
+    for tier in tiers:
+        if waited + seconds[tier] * (1 + depth / capacity) <= slo:
+            return tier
+
+    return Document.BICUBIC
+
+def worker_capacity():
+    """Jobs run at once by all workers: the processes and threads this worker
+    was started with, or SUPEREZ_WORKERS and SUPEREZ_WORKER_THREADS outside of one"""
+
+    if _capacity is not None:
+        return _capacity
+
+    return settings.SUPEREZ_WORKERS * settings.SUPEREZ_WORKER_THREADS
+
+def choose_tier(document):
+    """Tier a claimed job is served at: the one asked for, or picked by
+    `pick_tier`, among the tiers this process has weights for. Jobs asking
+    for a missing tier get the best available one below it"""
+
+    tiers = available_tiers()
+    if document.requested_tier != Document.AUTO:
+        lower = TIERS[TIERS.index(document.requested_tier):]
+        return next(tier for tier in lower if tier in tiers)
+
+    waited   = (timezone.now() - document.created).total_seconds()
+    depth    = Document.objects.filter(status=Document.PENDING).count()
+
+    return pick_tier(waited, depth, tier_seconds(), worker_capacity(), settings.SUPEREZ_LATENCY_SLO_SECONDS,
+                     tiers)
+
+
+class QueueFull(Exception):
+    """Raised when `SUPEREZ_MAX_PENDING_JOBS` uploads are already waiting"""
+
+
+def check_capacity():
+    """Raises QueueFull when no more uploads should be accepted"""
+
+    pending = Document.objects.filter(status=Document.PENDING).count()
+    if pending >= settings.SUPEREZ_MAX_PENDING_JOBS:
+        raise QueueFull("%d images are already waiting" % (pending,))
+
+def submit(name, content_hash, store=None, size=None, width=None, height=None, tier=Document.AUTO):
+    """Queues an upload stored as `name` in the images folder. Returns its `Document`.
+
+    Images that were restored before are copied from the result cache and
+    come back already done, without going through the queue. Automatic
+    uploads only reuse full generator results. `store` is called to write
+    the original once the upload is accepted, so nothing is written for
+    uploads refused with QueueFull. `size` in bytes and the dimensions of
+    the upload go to the catalogue. `tier` is the quality asked for."""
+
+    document = Document(content_hash=content_hash, size=size, width=width, height=height,
+                        requested_tier=tier)
+    document.docfile.name = name
+
+    cached_tier   = Document.FULL if tier == Document.AUTO else tier
+    restored_path = document.docfile.storage.path(document.restored_name(cached_tier))
+    if result_cache.restore(_cache_key(content_hash, cached_tier), restored_path):
+        document.status   = Document.DONE
+        document.tier     = cached_tier
+        document.restored = document.restored_name()
+    else:
+        check_capacity()
+
+    if store is not None:
+        store()
+
+    document.save()
+
+    # Done as soon as it is created. `created` is only set by the first save
+    if document.status == Document.DONE:
+        document.finished = document.created
+        document.save(update_fields=['finished'])
+
+    return document
+
+def claim_next():
+    """Atomically marks the oldest pending job as running and returns it, or
+    None when there is nothing to do"""
+
+    candidates = Document.objects.filter(status=Document.PENDING) \
+                                 .order_by('created', 'pk') \
+                                 .values_list('pk', flat=True)[:10]
+
+    for pk in candidates:
+        # Only one worker can win the update, the others move on
+        claimed = Document.objects.filter(pk=pk, status=Document.PENDING) \
+                                  .update(status=Document.RUNNING, started=timezone.now())
+        if claimed:
+            return Document.objects.get(pk=pk)
+
+    return None
+
+def run(document):
+    """Restores a claimed document and records the outcome.
+
+    Returns False, and records nothing, when the job was queued again as
+    stale meanwhile, so that a job picked up by another worker is never
+    written twice"""
+
+    try:
+        document.tier = choose_tier(document)
+
+        _inference(document.tier)(document.docfile.path)
+        document.status   = Document.DONE
+        document.restored = document.restored_name()
+
+        if document.content_hash:
+            restored_path = document.docfile.storage.path(document.restored_name())
+            result_cache.put(_cache_key(document.content_hash, document.tier), restored_path)
+    except Exception:
+        document.status = Document.FAILED
+        document.error  = traceback.format_exc()
+        print(document.error)
+
+    finished = timezone.now()
+    recorded = Document.objects.filter(pk=document.pk, status=Document.RUNNING, started=document.started) \
+                               .update(status=document.status, tier=document.tier, restored=document.restored,
+                                       error=document.error, finished=finished)
+    if not recorded:
+        print("    Job %d was queued again meanwhile, dropped its result" % (document.pk,))
+        return False
+
+    document.finished = finished
+    return True
+
+def requeue_stale(timeout=None):
+    """Queues again the jobs that have been running for more than `timeout`
+    seconds, by default SUPEREZ_STALE_JOB_SECONDS. Returns how many"""
+
+    if timeout is None:
+        timeout = settings.SUPEREZ_STALE_JOB_SECONDS
+
+    started_before = timezone.now() - datetime.timedelta(seconds=timeout)
+    return Document.objects.filter(status=Document.RUNNING, started__lt=started_before) \
+                           .update(status=Document.PENDING, started=None)
+
+def _work_loop():
+    while True:
+        try:
+            document = claim_next()
+            if document is None:
+                time.sleep(settings.SUPEREZ_WORKER_POLL_SECONDS)
+                continue
+
+            run(document)
+        except Exception:
+            # E.g. the database is locked. A job claimed meanwhile is queued
+            # again by `supervise` once it is stale
+            traceback.print_exc()
+            time.sleep(settings.SUPEREZ_WORKER_POLL_SECONDS)
+
+def work(threads=1, processes=1):
+    """Main loop of a worker process, one of `processes` started together.
+
+    With several threads a process runs several jobs at once, which lets the
+    micro-batcher put their images in the same generator call. Tiers are
+    picked for the `processes` times `threads` jobs run at once."""
+
+    global _capacity
+    _capacity = processes * threads
+
+    available_tiers()
+
+    for _ in range(threads - 1):
+        thread = threading.Thread(target=_work_loop)
+        thread.daemon = True
+        thread.start()
+
+    _work_loop()
+
+def supervise(start_worker, processes):
+    """Main loop of `manage.py runworkers`: keeps `processes` workers alive.
+
+    `start_worker` starts a worker process and returns it. Workers that died,
+    e.g. running out of memory on a large upload, are started again, and
+    every SUPEREZ_STALE_CHECK_SECONDS the jobs they left running are queued
+    again by `requeue_stale`"""
+
+    workers = [start_worker() for _ in range(processes)]
+    checked = None
+
+    while True:
+        for i, worker in enumerate(workers):
+            if not worker.is_alive():
+                print("    Worker %s exited with code %s, starting another one" % (worker.pid, worker.exitcode))
+                workers[i] = start_worker()
+
+        if checked is None or time.time() - checked >= settings.SUPEREZ_STALE_CHECK_SECONDS:
+            checked  = time.time()
+            requeued = requeue_stale()
+            if requeued:
+                print("    Queued %d stale jobs again" % (requeued,))
+
+        time.sleep(settings.SUPEREZ_WORKER_POLL_SECONDS)
+
+def queue_position(document):
+    """Number of pending jobs that will run before this one"""
+
+    return Document.objects.filter(status=Document.PENDING, created__lt=document.created).count()
+
+def describe(document):
+    """Status of a job as a JSON-friendly dict"""
+
+    status = {'id':             document.pk,
+              'status':         document.status,
+              'original':       document.docfile.url,
+              'created':        document.created.isoformat(),
+              'requested_tier': document.requested_tier}
+
+    if document.status == Document.PENDING:
+        status['queue_position'] = queue_position(document)
+    if document.started is not None:
+        status['started'] = document.started.isoformat()
+    if document.finished is not None:
+        status['finished'] = document.finished.isoformat()
+    if document.tier:
+        status['tier'] = document.tier
+    if document.status == Document.DONE:
+        status['restored'] = document.restored_url()
+    if document.status == Document.FAILED:
+        status['error'] = document.error.strip().splitlines()[-1] if document.error else ''
+
+    return status
+
+def queue_metrics():
+    """Queue depth and job counts for monitoring"""
+
+    counts = {status: 0 for status, _ in Document.STATUS_CHOICES}
+    for row in Document.objects.values('status').annotate(count=Count('pk')):
+        counts[row['status']] = row['count']
+
+    oldest = Document.objects.filter(status=Document.PENDING).aggregate(oldest=Min('created'))['oldest']
+    oldest_age = (timezone.now() - oldest).total_seconds() if oldest is not None else 0.0
+
+    return {'depth':              counts[Document.PENDING],
+            'jobs':               counts,
+            'oldest_pending_age': oldest_age,
+            'max_pending':        settings.SUPEREZ_MAX_PENDING_JOBS,
+            'latency_slo':        settings.SUPEREZ_LATENCY_SLO_SECONDS,
+            'tier_seconds':       tier_seconds(),
+            'workers':            settings.SUPEREZ_WORKERS,
+            'worker_threads':     settings.SUPEREZ_WORKER_THREADS}
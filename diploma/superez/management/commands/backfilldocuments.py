@@ -0,0 +1,101 @@
+import datetime
+import hashlib
+import os
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from superez.models import Document, IMAGES_DIR
+from superez.srezmodel.images import image_size
+
+
+def _modified(path):
+    return datetime.datetime.fromtimestamp(os.path.getmtime(path), tz=timezone.utc)
+
+def _details(path):
+    """Catalogue fields of a stored original"""
+
+    details = {'size': os.path.getsize(path), 'width': None, 'height': None}
+    try:
+        details['width'], details['height'] = image_size(path)
+    except ValueError:
+        pass
+
+    return details
+
+def _content_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class Command(BaseCommand):
+    help = 'Adds images stored before the document catalogue existed, and fills in missing catalogue fields'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue', action='store_true',
+                            help='Queue originals without a restored image, instead of marking them failed')
+        parser.add_argument('--batch', type=int, default=500,
+                            help='Files handled per database transaction')
+
+    def handle(self, *args, **options):
+        known = set(Document.objects.values_list('docfile', flat=True))
+        names = sorted(name for name in os.listdir(IMAGES_DIR)
+                       if not name.startswith('.') and not name.startswith('restored_')
+                       and name not in known and os.path.isfile(os.path.join(IMAGES_DIR, name)))
+
+        added = 0
+        for i in range(0, len(names), options['batch']):
+            with transaction.atomic():
+                for name in names[i:i+options['batch']]:
+                    self._add(name, options['queue'])
+                    added += 1
+
+            self.stdout.write("Added %d of %d files" % (added, len(names)))
+
+        # Rows created before the catalogue fields existed
+        updated = 0
+        with transaction.atomic():
+            for document in Document.objects.filter(size__isnull=True).iterator():
+                if self._complete(document):
+                    updated += 1
+
+        self.stdout.write("Catalogued %d new files, completed %d existing documents" % (added, updated))
+
+    def _add(self, name, queue):
+        path     = os.path.join(IMAGES_DIR, name)
+        document = Document(content_hash=_content_hash(path), **_details(path))
+        document.docfile.name = name
+
+        restored_path = os.path.join(IMAGES_DIR, document.restored_name())
+        if os.path.exists(restored_path):
+            document.status   = Document.DONE
+            document.restored = document.restored_name()
+            document.finished = _modified(restored_path)
+        elif queue:
+            document.status = Document.PENDING
+        else:
+            document.status = Document.FAILED
+            document.error  = "No restored image was found when the catalogue was backfilled"
+
+        document.save()
+
+        # auto_now_add can't be overridden on save, and listings sort by upload time
+        Document.objects.filter(pk=document.pk).update(created=_modified(path))
+
+    def _complete(self, document):
+        path = os.path.join(IMAGES_DIR, document.docfile.name)
+        if not os.path.isfile(path):
+            return False
+
+        fields = _details(path)
+        if document.status == Document.DONE and not document.restored and \
+           os.path.exists(os.path.join(IMAGES_DIR, document.restored_name())):
+            fields['restored'] = document.restored_name()
+
+        Document.objects.filter(pk=document.pk).update(**fields)
+        return True
@@ -0,0 +1,66 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from superez.srezmodel import tiling
+from superez.srezmodel.images import read_image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class Command(BaseCommand):
+    help = ('Reports how many blocks adaptive compute upscales bicubic instead of by the generator, '
+            'the time it saves and what it costs in PSNR on a set of evaluation images')
+
+    def add_arguments(self, parser):
+        parser.add_argument('images', nargs='+', metavar='IMAGE',
+                            help='Full resolution evaluation images, or folders of them')
+        parser.add_argument('--threshold', type=float, nargs='+', default=[.01, .02, .04],
+                            help='Gradient energies below which blocks skip the generator')
+        parser.add_argument('--block', type=int, default=settings.SUPEREZ_ADAPTIVE_BLOCK,
+                            help='Side of the blocks told apart as flat or detailed, in input pixels')
+        parser.add_argument('--tile', type=int, default=None,
+                            help='Side of the generator tiles in input pixels. Whole images by default')
+        parser.add_argument('--overlap', type=int, default=8,
+                            help='Overlap in input pixels between neighbouring blocks and tiles')
+        parser.add_argument('--batch-size', type=int, default=8,
+                            help='Tiles run through the generator at once')
+        parser.add_argument('--tier', choices=('full', 'small'), default='full',
+                            help='Generator the detailed tiles go through')
+
+    def _paths(self, images):
+        paths = []
+        for path in images:
+            if os.path.isdir(path):
+                paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                             if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+            else:
+                paths.append(path)
+
+        if not paths:
+            raise CommandError("No evaluation images found")
+
+        return paths
+
+    def handle(self, *args, **options):
+        # Same engine as the workers
+        if settings.SUPEREZ_ENGINE == 'numpy':
+            from superez.srezmodel.numpy_engine import get_engine
+        else:
+            from superez.srezmodel.inference import get_engine
+
+        images = [read_image(path) for path in self._paths(options['images'])]
+        engine = get_engine(options['tier'])
+
+        results = tiling.evaluate_adaptive(engine.upscale_batch, images, options['threshold'],
+                                           options['block'], tile_size=options['tile'],
+                                           overlap=options['overlap'], batch_size=options['batch_size'])
+
+        self.stdout.write("%d images in blocks of %dpx, generator only: %.2fs, %.2f dB"
+                          % (len(images), options['block'], results[0]['seconds'], results[0]['psnr']))
+        for result in results[1:]:
+            self.stdout.write("threshold %.3f: %5.1f%% of blocks skipped, %.2fs, %5.1f%% time saved, "
+                              "%.2f dB, %.2f dB cost"
+                              % (result['threshold'], 100 * result['skip_rate'], result['seconds'],
+                                 100 * result['time_saved'], result['psnr'], result['psnr_cost']))
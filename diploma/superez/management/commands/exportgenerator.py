@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from superez.srezmodel import export
+from superez.srezmodel.inference import FLAGS
+
+
+class Command(BaseCommand):
+    help = 'Writes the generator of the latest checkpoint as a frozen graph or NumPy weights for the inference engines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None,
+                            help='Where to write the generator, by default where the workers look for it')
+        parser.add_argument('--format', choices=export.FORMATS, default='graph',
+                            help='Frozen TensorFlow graph, or weights for the NumPy engine')
+        parser.add_argument('--checkpoint-dir', default=None,
+                            help='Folder holding the training checkpoints')
+        parser.add_argument('--spec', default='full',
+                            help='Generator layout the checkpoint was trained with, e.g. full or small')
+        parser.add_argument('--statistics', choices=export.STATISTICS, default='batch',
+                            help='Batch norm statistics. Only moving and calibrated ones can be folded')
+        parser.add_argument('--calibration-dir', default=None,
+                            help='Images the calibrated statistics are computed on')
+        parser.add_argument('--calibration-size', type=int, default=128,
+                            help='Side in pixels of the center crop taken from every calibration image')
+        parser.add_argument('--calibration-images', type=int, default=64,
+                            help='Maximum number of calibration images used')
+        parser.add_argument('--benchmark', nargs='*', default=[], metavar='IMAGE',
+                            help='Compare startup time, latency and output against the checkpoint on these images')
+        parser.add_argument('--tolerance', type=float, default=1e-3,
+                            help='Largest difference from the checkpoint output accepted by --benchmark')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        if output is None:
+            output = settings.SUPEREZ_NUMPY_WEIGHTS if options['format'] == 'numpy' else FLAGS.frozen_graph
+
+        summary = export.export(output,
+                                checkpoint_dir=options['checkpoint_dir'],
+                                statistics=options['statistics'],
+                                format=options['format'],
+                                calibration_dir=options['calibration_dir'],
+                                calibration_size=options['calibration_size'],
+                                calibration_count=options['calibration_images'],
+                                spec=options['spec'])
+
+        self.stdout.write("Wrote %s: %d ops, %.1f MB, %s statistics, "
+                          "%d batch norms folded, %d affine, %d per-image"
+                          % (output, summary['nodes'], summary['bytes'] / 2.**20, summary['statistics'],
+                             summary['folded'], summary['affine'], summary['batch_norms']))
+
+        if not options['benchmark']:
+            return
+
+        results = export.benchmark(options['benchmark'], output,
+                                   checkpoint_dir=options['checkpoint_dir'],
+                                   format=options['format'],
+                                   spec=options['spec'],
+                                   statistics=options['statistics'])
+        for name in ('checkpoint', 'exported'):
+            self.stdout.write("%-10s startup %.2fs, latency %.3fs mean, %.3fs max"
+                              % (name, results[name]['startup'],
+                                 results[name]['latency_mean'], results[name]['latency_max']))
+        self.stdout.write("Exported against checkpoint output: lowest PSNR %.2f dB, largest difference %.2g"
+                          % (results['psnr_min'], results['max_diff']))
+
+        # Only exact statistics are expected to match the checkpoint closely
+        if options['statistics'] != 'calibrated' and results['max_diff'] > options['tolerance']:
+            raise CommandError("Exported generator differs from the checkpoint by %.2g, more than %.2g"
+                               % (results['max_diff'], options['tolerance']))
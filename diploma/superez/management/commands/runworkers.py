@@ -0,0 +1,31 @@
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from superez import jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs the background workers that restore uploaded images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.SUPEREZ_WORKERS,
+                            help='Number of worker processes, each with its own inference engine')
+        parser.add_argument('--threads', type=int, default=settings.SUPEREZ_WORKER_THREADS,
+                            help='Jobs run at once by every worker process')
+
+    def _start_worker(self, threads, processes):
+        # Children must open their own database connections
+        connections.close_all()
+
+        worker = multiprocessing.Process(target=jobs.work, args=(threads, processes))
+        worker.start()
+        return worker
+
+    def handle(self, *args, **options):
+        self.stdout.write("Starting %d workers with %d threads each" % (options['processes'], options['threads']))
+
+        # Runs until interrupted, starting workers again when they die
+        jobs.supervise(lambda: self._start_worker(options['threads'], options['processes']), options['processes'])
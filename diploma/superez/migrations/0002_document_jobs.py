@@ -0,0 +1,52 @@
+# Generated by Django 2.1.7 on 2026-10-18 19:37
+
+import django.core.files.storage
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('superez', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='finished',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='started',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Documents uploaded before the job queue were processed synchronously
+        migrations.AddField(
+            model_name='document',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='done', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='docfile',
+            field=models.FileField(storage=django.core.files.storage.FileSystemStorage(base_url='/superez/images/', location='superez/images'), upload_to=''),
+        ),
+    ]
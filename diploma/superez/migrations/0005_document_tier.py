@@ -0,0 +1,23 @@
+# Generated by Django 2.1.7 on 2026-10-18 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('superez', '0004_document_catalogue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='requested_tier',
+            field=models.CharField(choices=[('auto', 'Automatic'), ('bicubic', 'Bicubic'), ('small', 'Small generator'), ('full', 'Full generator')], default='auto', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='tier',
+            field=models.CharField(blank=True, choices=[('bicubic', 'Bicubic'), ('small', 'Small generator'), ('full', 'Full generator')], max_length=10),
+        ),
+    ]
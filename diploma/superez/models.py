@@ -1,6 +1,77 @@
+from django.core.files.storage import FileSystemStorage
 from django.db import models
 
-# Create your models here.
+from superez.srezmodel import images
+
+# Uploads and their restored versions are kept side by side in this folder
+IMAGES_DIR = "superez/images"
+
+images_storage = FileSystemStorage(location=IMAGES_DIR, base_url='/superez/images/')
 
 class Document(models.Model):
-    docfile = models.FileField(upload_to='images/%d')
\ No newline at end of file
+    """An uploaded image, doubling as its super-resolution job.
+
+    Also the catalogue of the images folder: listings page through this
+    table rather than the folder itself (see `manage.py backfilldocuments`
+    for files stored before it existed)."""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE    = 'done'
+    FAILED  = 'failed'
+
+    STATUS_CHOICES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE,    'Done'),
+        (FAILED,  'Failed'),
+    )
+
+    # Quality tiers, see jobs.choose_tier
+    AUTO    = 'auto'
+    BICUBIC = 'bicubic'
+    SMALL   = 'small'
+    FULL    = 'full'
+
+    TIER_CHOICES = (
+        (BICUBIC, 'Bicubic'),
+        (SMALL,   'Small generator'),
+        (FULL,    'Full generator'),
+    )
+
+    REQUESTED_TIER_CHOICES = ((AUTO, 'Automatic'),) + TIER_CHOICES
+
+    docfile      = models.FileField(upload_to='', storage=images_storage)
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True)
+    status       = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    error        = models.TextField(blank=True)
+    created      = models.DateTimeField(auto_now_add=True)
+    started      = models.DateTimeField(null=True, blank=True)
+    finished     = models.DateTimeField(null=True, blank=True)
+    restored     = models.CharField(max_length=255, blank=True)
+    size         = models.PositiveIntegerField(null=True, blank=True)
+    width        = models.PositiveIntegerField(null=True, blank=True)
+    height       = models.PositiveIntegerField(null=True, blank=True)
+    # Tier asked for with the upload, and the one that served it
+    requested_tier = models.CharField(max_length=10, choices=REQUESTED_TIER_CHOICES, default=AUTO)
+    tier           = models.CharField(max_length=10, choices=TIER_CHOICES, blank=True)
+
+    class Meta:
+        indexes = [
+            # Listing pages, newest first
+            models.Index(fields=['-created', '-id'], name='superez_doc_listing_idx'),
+            # Oldest pending jobs first, and queue positions
+            models.Index(fields=['status', 'created'], name='superez_doc_queue_idx'),
+        ]
+
+    def restored_name(self, tier=None):
+        """Name of the restored image at `tier`, by default the one that served
+        the document or else the full generator, next to the original"""
+        return images.restored_name(self.docfile.name, tier or self.tier or self.FULL)
+
+    def restored_url(self):
+        """URL of the restored image, or None until there is one"""
+        if not self.restored:
+            return None
+
+        return self.docfile.storage.url(self.restored)
@@ -0,0 +1,141 @@
+from superez.srezmodel.stats import RunningStats
+
+import threading
+import time
+import numpy as np
+
+
+class UpscaleRequest(object):
+    """A single image waiting in a `MicroBatcher`.
+
+    Once done, `queue_time` holds the seconds spent waiting for a batch and
+    `batch_size` the number of images it was run with."""
+
+    def __init__(self, image, key):
+        self.image      = image
+        self.key        = key
+        self.enqueued   = time.time()
+        self.queue_time = None
+        self.batch_size = None
+
+        self._done   = threading.Event()
+        self._result = None
+        self._error  = None
+
+    def result(self):
+        """Blocks until the generator output for this image is available"""
+
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+
+        return self._result
+
+
+def _exact_shape(image):
+    return image.shape + (image.dtype.str,)
+
+class MicroBatcher(object):
+    """Groups concurrent upscale requests for same-shape images into one batch.
+
+    Images belong to the same batch when `batch_key` gives them the same key,
+    by default when they have the same shape and dtype. The oldest pending
+    request decides which key runs next. It waits at most `max_wait` seconds
+    for others with its key to arrive, then up to `max_batch_size` of them go
+    through a single `engine.upscale_batch` call. Requests with other keys keep
+    their place in the queue."""
+
+    def __init__(self, engine, batch_key=_exact_shape, max_batch_size=8, max_wait=.01):
+        assert max_batch_size >= 1
+
+        self.engine         = engine
+        self.batch_key      = batch_key
+        self.max_batch_size = max_batch_size
+        self.max_wait       = max_wait
+
+        self.queue_time   = RunningStats()
+        self.request_time = RunningStats()
+        self.fill_ratio   = RunningStats()
+
+        self._pending   = []
+        self._condition = threading.Condition()
+
+        thread = threading.Thread(target=self._run, name='MicroBatcher')
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, image):
+        """Queues an HxWx3 image and returns its `UpscaleRequest`"""
+
+        image   = np.asarray(image)
+        request = UpscaleRequest(image, self.batch_key(image))
+        with self._condition:
+            self._pending.append(request)
+            self._condition.notify()
+
+        return request
+
+    def upscale(self, image):
+        """Same as `engine.upscale`, but shares the generator call with concurrent requests"""
+        return self.submit(image).result()
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+
+            oldest   = self._pending[0]
+            deadline = oldest.enqueued + self.max_wait
+
+            while True:
+                batch = [r for r in self._pending if r.key == oldest.key][:self.max_batch_size]
+
+                remaining = deadline - time.time()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+
+                self._condition.wait(remaining)
+
+            for request in batch:
+                self._pending.remove(request)
+
+        return batch
+
+    def _run_batch(self, batch):
+        start_time = time.time()
+
+        for request in batch:
+            request.queue_time = start_time - request.enqueued
+            request.batch_size = len(batch)
+            self.queue_time.add(request.queue_time)
+
+        self.fill_ratio.add(len(batch) / float(self.max_batch_size))
+
+        try:
+            outputs = self.engine.upscale_batch([r.image for r in batch])
+            for request, output in zip(batch, outputs):
+                request._result = output
+        except Exception as e:
+            for request in batch:
+                request._error = e
+
+        end_time = time.time()
+        for request in batch:
+            self.request_time.add(end_time - request.enqueued)
+            request.image = None
+            request._done.set()
+
+    def _run(self):
+        while True:
+            self._run_batch(self._next_batch())
+
+    def stats(self):
+        """Per-request queue and total time, and how full the batches were"""
+
+        with self._condition:
+            pending = len(self._pending)
+
+        return {'pending':      pending,
+                'queue_time':   self.queue_time.summary(),
+                'request_time': self.request_time.summary(),
+                'fill_ratio':   self.fill_ratio.summary()}
@@ -0,0 +1,411 @@
+"""Export of the generator as a frozen graph for serving.
+
+The generator in a checkpoint is a training-time `Model`: every batch norm is
+a separate `tf.contrib.layers.batch_norm` and the weights only exist once the
+checkpoint is restored into a freshly built graph. Here the generator is
+rebuilt from the layers it recorded, with its weights as constants and batch
+norms folded into the convolutions wherever their statistics allow, and
+written as a single constant-folded GraphDef that `FrozenInferenceEngine`
+loads directly, or as weights for the TensorFlow-free `NumpyEngine` (see
+`manage.py exportgenerator`).
+
+Convolutions and upscales are built with dynamic shapes, so one frozen graph
+serves every input size."""
+
+import superez.srezmodel.srez_model2 as srez_model
+
+from superez.srezmodel.inference import InferenceEngine, FrozenInferenceEngine, checkpoint_path
+from superez.srezmodel.numpy_engine import NumpyEngine, save_generator
+from superez.srezmodel.images import read_image
+
+import os
+import os.path
+import collections
+import time
+import numpy as np
+
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+FLAGS = tf.app.flags.FLAGS
+
+# Same as tf.contrib.layers.batch_norm
+BATCH_NORM_EPSILON = 0.001
+
+# Where batch norms get their mean and variance from in the frozen graph:
+#   batch      - each image is normalized by its own statistics, as in training. Exact, nothing is folded
+#   moving     - moving averages stored in the checkpoint, if it was trained with them
+#   calibrated - statistics pooled over a folder of calibration images
+STATISTICS = ('batch', 'moving', 'calibrated')
+
+# What the generator is exported as:
+#   graph - frozen GraphDef for `FrozenInferenceEngine`
+#   numpy - uncompressed .npz for `NumpyEngine`, which runs without TensorFlow
+FORMATS = ('graph', 'numpy')
+
+_TRANSFORMS = ['strip_unused_nodes',
+               'fold_constants(ignore_errors=true)',
+               'sort_by_execution_order']
+
+
+def read_generator(checkpoint_dir, channels=3, spec='full'):
+    """Returns the recorded generator layers and their weights from the latest checkpoint.
+
+    Only the generator variables are read. The discriminator and the
+    optimizer slots in the checkpoint are left out. `spec` is the layout the
+    checkpoint was trained with, see `srez_model.generator_spec`. Its
+    upsampling is read from the checkpoint."""
+
+    checkpoint = checkpoint_path(checkpoint_dir)
+    upsample   = srez_model.checkpoint_upsample(checkpoint, spec, channels)
+
+    with tf.Graph().as_default():
+        features = tf.placeholder(tf.float32, shape=[None, None, None, channels])
+        with tf.variable_scope('gene'):
+            model = srez_model.build_generator(features, channels, norm='batch', spec=spec,
+                                               upsample=upsample)
+
+        names = [var.op.name for var in tf.global_variables()]
+
+    reader  = tf.train.NewCheckpointReader(checkpoint)
+    weights = {name: reader.get_tensor(name) for name in names}
+
+    # Moving averages are only there if training created them
+    for layer in model.layers:
+        if layer['op'] == 'batch_norm':
+            for stat in ('moving_mean', 'moving_variance'):
+                name = 'gene/%s/BatchNorm/%s' % (layer['name'], stat)
+                if reader.has_tensor(name):
+                    weights[name] = reader.get_tensor(name)
+
+    return model.layers, weights
+
+def _variable(weights, layer, name):
+    return np.asarray(weights['gene/%s/%s' % (layer['name'], name)], dtype=np.float32)
+
+def moving_statistics(layers, weights):
+    """Per-channel (mean, variance) of every batch norm from the checkpoint moving averages"""
+
+    statistics = {}
+    for layer in layers:
+        if layer['op'] != 'batch_norm':
+            continue
+
+        try:
+            statistics[layer['name']] = (_variable(weights, layer, 'BatchNorm/moving_mean'),
+                                         _variable(weights, layer, 'BatchNorm/moving_variance'))
+        except KeyError:
+            raise ValueError("Checkpoint has no moving averages for `%s'" % (layer['name'],))
+
+    return statistics
+
+def fold_layers(layers, weights, statistics=None):
+    """Turns the recorded generator layers into the layers of the frozen graph.
+
+    Weights are attached to every layer. Stride 1 transposed convolutions
+    become plain convolutions with a flipped kernel, which need no static
+    output shape.
+
+    Given `statistics`, per-channel (mean, variance) by batch norm layer name,
+    batch norms become a fixed affine transform. It is folded into the
+    weights of the preceding convolution when nothing else reads that
+    convolution's output. Without statistics batch norms keep normalizing
+    each image by its own statistics, as the checkpoint was trained to."""
+
+    folded = []
+    for layer in layers:
+        layer = dict(layer)
+        if layer['op'] in ('conv2d', 'conv2d_transpose'):
+            layer['weight'] = _variable(weights, layer, 'weight')
+            layer['bias']   = _variable(weights, layer, 'bias')
+
+            if layer['op'] == 'conv2d_transpose' and layer['stride'] == 1 and layer['mapsize'] % 2 == 1:
+                # Transposed convolution of stride 1 is a convolution with the kernel flipped
+                layer['op']     = 'conv2d'
+                layer['weight'] = np.ascontiguousarray(layer['weight'][::-1, ::-1])
+
+        elif layer['op'] == 'subpixel_upscale':
+            layer['weight'] = _variable(weights, layer, 'weight')
+            layer['bias']   = _variable(weights, layer, 'bias')
+
+        elif layer['op'] == 'separable_conv2d':
+            layer['depthwise'] = _variable(weights, layer, 'depthwise')
+            layer['pointwise'] = _variable(weights, layer, 'pointwise')
+            layer['bias']      = _variable(weights, layer, 'bias')
+
+        elif layer['op'] == 'batch_norm':
+            layer['beta']  = _variable(weights, layer, 'BatchNorm/beta')
+            layer['gamma'] = _variable(weights, layer, 'BatchNorm/gamma') if layer['scale'] \
+                             else np.ones_like(layer['beta'])
+
+        folded.append(layer)
+
+    if statistics is None:
+        return folded
+
+    # Number of layers reading each output, outputs[0] being the input
+    readers = collections.Counter()
+    for layer in folded:
+        readers[layer['input']] += 1
+        if layer['op'] == 'sum':
+            readers[layer['term']] += 1
+
+    for layer in folded:
+        if layer['op'] != 'batch_norm':
+            continue
+
+        mean, variance = statistics[layer['name']]
+        multiplier = layer['gamma'] / np.sqrt(variance + BATCH_NORM_EPSILON)
+        offset     = layer['beta'] - mean * multiplier
+
+        producer = folded[layer['input']-1] if layer['input'] > 0 else None
+        if producer is not None and producer['op'] == 'conv2d' and readers[layer['input']] == 1:
+            producer['weight'] = (producer['weight'] * multiplier).astype(np.float32)
+            producer['bias']   = (producer['bias'] * multiplier + offset).astype(np.float32)
+            layer['op'] = 'identity'
+        else:
+            layer['op']         = 'affine'
+            layer['multiplier'] = multiplier.astype(np.float32)
+            layer['offset']     = offset.astype(np.float32)
+
+    return folded
+
+def _build_layer(layer, outputs):
+    x  = outputs[layer['input']]
+    op = layer['op']
+
+    if op == 'conv2d':
+        stride = layer['stride']
+        out    = tf.nn.conv2d(x, tf.constant(layer['weight'], name='weight'),
+                              strides=[1, stride, stride, 1],
+                              padding='SAME')
+        return tf.nn.bias_add(out, tf.constant(layer['bias'], name='bias'))
+
+    if op == 'separable_conv2d':
+        stride = layer['stride']
+        out    = tf.nn.separable_conv2d(x, tf.constant(layer['depthwise'], name='depthwise'),
+                                        tf.constant(layer['pointwise'], name='pointwise'),
+                                        strides=[1, stride, stride, 1],
+                                        padding='SAME')
+        return tf.nn.bias_add(out, tf.constant(layer['bias'], name='bias'))
+
+    if op == 'conv2d_transpose':
+        stride       = layer['stride']
+        shape        = tf.shape(x)
+        output_shape = tf.stack([shape[0], shape[1] * stride, shape[2] * stride, layer['units']])
+        weight       = np.transpose(layer['weight'], [0, 1, 3, 2])
+        out          = tf.nn.conv2d_transpose(x, tf.constant(weight, name='weight'),
+                                              output_shape=output_shape,
+                                              strides=[1, stride, stride, 1],
+                                              padding='SAME')
+        return tf.nn.bias_add(out, tf.constant(layer['bias'], name='bias'))
+
+    if op == 'batch_norm':
+        mean, variance = tf.nn.moments(x, [1, 2], keep_dims=True)
+        return tf.nn.batch_normalization(x, mean, variance,
+                                         tf.constant(layer['beta'], name='beta'),
+                                         tf.constant(layer['gamma'], name='gamma'),
+                                         BATCH_NORM_EPSILON)
+
+    if op == 'affine':
+        return x * tf.constant(layer['multiplier'], name='multiplier') + \
+               tf.constant(layer['offset'], name='offset')
+
+    if op == 'identity':
+        return x
+
+    if op == 'relu':
+        return tf.nn.relu(x)
+
+    if op == 'elu':
+        return tf.nn.elu(x)
+
+    if op == 'lrelu':
+        leak = layer['leak']
+        return .5 * (1 + leak) * x + .5 * (1 - leak) * tf.abs(x)
+
+    if op == 'sigmoid':
+        return tf.nn.sigmoid(x)
+
+    if op == 'sum':
+        return tf.add(x, outputs[layer['term']])
+
+    if op == 'upscale':
+        return tf.image.resize_nearest_neighbor(x, 2 * tf.shape(x)[1:3])
+
+    if op == 'subpixel_upscale':
+        out = tf.nn.conv2d(x, tf.constant(layer['weight'], name='weight'),
+                           strides=[1, 1, 1, 1],
+                           padding='SAME')
+        out = tf.nn.bias_add(out, tf.constant(layer['bias'], name='bias'))
+        return tf.depth_to_space(out, 2)
+
+    raise ValueError("Layer `%s' of type `%s' can't be exported" % (layer['name'], op))
+
+def build_graph(layers, channels=3):
+    """Builds the generator from `fold_layers` output in a new graph.
+
+    Returns the graph and the output of every layer, the first being the
+    'input' placeholder and the last the 'output' tensor. Both accept any
+    batch size and image size."""
+
+    graph = tf.Graph()
+    with graph.as_default():
+        features = tf.placeholder(tf.float32, shape=[None, None, None, channels], name='input')
+
+        outputs = [features]
+        for layer in layers:
+            with tf.name_scope(layer['name']):
+                outputs.append(_build_layer(layer, outputs))
+
+        outputs[-1] = tf.identity(outputs[-1], name='output')
+
+    return graph, outputs
+
+def _load_images(paths, size=None):
+    images = []
+    for path in paths:
+        image = read_image(path)
+        if size is not None:
+            # Center crop, smaller images are used whole
+            y = max(0, (image.shape[0] - size) // 2)
+            x = max(0, (image.shape[1] - size) // 2)
+            image = image[y:y+size, x:x+size]
+
+        images.append(image)
+
+    return images
+
+def _image_paths(directory, count=None):
+    names = sorted(name for name in os.listdir(directory)
+                   if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg', '.png', '.bmp'))
+    return [os.path.join(directory, name) for name in names[:count]]
+
+def calibrate(layers, images):
+    """Per-channel mean and variance at the input of every batch norm, pooled over `images`.
+
+    `layers` must come from `fold_layers` without statistics, so that the
+    activations are the ones the checkpoint produces."""
+
+    graph, outputs = build_graph(layers)
+
+    with graph.as_default():
+        moments = {}
+        for layer in layers:
+            if layer['op'] == 'batch_norm':
+                x = outputs[layer['input']]
+                moments[layer['name']] = (tf.reduce_sum(x, [0, 1, 2]),
+                                          tf.reduce_sum(tf.square(x), [0, 1, 2]),
+                                          tf.reduce_prod(tf.shape(x)[:3]))
+
+    totals = {}
+    with tf.Session(graph=graph) as sess:
+        for image in images:
+            results = sess.run(moments, feed_dict={outputs[0]: image[np.newaxis]})
+            for name, (sum1, sum2, count) in results.items():
+                previous = totals.get(name, (0., 0., 0))
+                totals[name] = (previous[0] + sum1.astype(np.float64),
+                                previous[1] + sum2.astype(np.float64),
+                                previous[2] + count)
+
+    statistics = {}
+    for name, (sum1, sum2, count) in totals.items():
+        mean = sum1 / count
+        statistics[name] = (mean, np.maximum(sum2 / count - mean * mean, 0.))
+
+    return statistics
+
+def export(output_path, checkpoint_dir=None, statistics='batch', format='graph',
+           calibration_dir=None, calibration_size=128, calibration_count=64, spec='full'):
+    """Writes the generator of the latest checkpoint at `output_path`.
+
+    See `STATISTICS` for the choices of batch norm `statistics` and `FORMATS`
+    for the output formats. `spec` is the layout of the checkpoint. Returns a
+    summary of what was folded and the size of the output."""
+
+    assert statistics in STATISTICS
+    assert format in FORMATS
+
+    if checkpoint_dir is None:
+        checkpoint_dir = FLAGS.checkpoint_dir
+
+    layers, weights = read_generator(checkpoint_dir, spec=spec)
+
+    norm_stats = None
+    if statistics == 'moving':
+        norm_stats = moving_statistics(layers, weights)
+    elif statistics == 'calibrated':
+        if calibration_dir is None:
+            raise ValueError("Calibrated statistics need a folder of calibration images")
+
+        images     = _load_images(_image_paths(calibration_dir, calibration_count), calibration_size)
+        norm_stats = calibrate(fold_layers(layers, weights), images)
+
+    folded = fold_layers(layers, weights, norm_stats)
+
+    # Never leave a partial file where the inference engine looks for it
+    temp_path = output_path + '.tmp'
+    if format == 'numpy':
+        with open(temp_path, 'wb') as f:
+            save_generator(f, folded)
+        nodes = len(folded)
+    else:
+        graph, _  = build_graph(folded)
+        graph_def = TransformGraph(graph.as_graph_def(), ['input'], ['output'], _TRANSFORMS)
+
+        with tf.gfile.GFile(temp_path, 'wb') as f:
+            f.write(graph_def.SerializeToString())
+        nodes = len(graph_def.node)
+    os.replace(temp_path, output_path)
+
+    ops = collections.Counter(layer['op'] for layer in folded)
+    return {'statistics':  statistics,
+            'format':      format,
+            'folded':      ops['identity'],
+            'affine':      ops['affine'],
+            'batch_norms': ops['batch_norm'],
+            'nodes':       nodes,
+            'bytes':       os.path.getsize(output_path)}
+
+def _psnr(a, b):
+    mse = np.mean(np.square(np.clip(a, 0., 1.) - np.clip(b, 0., 1.)))
+    return 10. * np.log10(1. / mse) if mse > 0 else float('inf')
+
+def benchmark(image_paths, output_path, checkpoint_dir=None, format='graph', spec='full', statistics='batch'):
+    """Compares an exported generator with restoring the checkpoint on the given images.
+
+    Reports the startup time and per-image latency of each engine, and the
+    PSNR and largest absolute difference of the exported outputs against the
+    checkpoint outputs. Both engines see every image alone and at its own
+    size, so that only the export can make them differ. The checkpoint runs
+    with the moving averages when they were exported, with per-sample
+    statistics otherwise."""
+
+    exported = NumpyEngine if format == 'numpy' else FrozenInferenceEngine
+    norm     = 'moving' if statistics == 'moving' else 'batch'
+
+    images  = _load_images(image_paths)
+    engines = (('checkpoint', lambda: InferenceEngine(checkpoint_dir, spec=spec, norm=norm)),
+               ('exported',   lambda: exported(output_path)))
+
+    results = {}
+    outputs = {}
+    for name, create_engine in engines:
+        engine    = create_engine()
+        latencies = []
+        outputs[name] = []
+
+        for image in images:
+            start_time = time.time()
+            outputs[name].append(engine.upscale(image))
+            latencies.append(time.time() - start_time)
+
+        results[name] = {'startup':      engine.startup_time,
+                         'latency_mean': float(np.mean(latencies)),
+                         'latency_max':  float(np.max(latencies))}
+
+    pairs = list(zip(outputs['checkpoint'], outputs['exported']))
+    results['psnr_min'] = float(np.min([_psnr(a, b) for a, b in pairs]))
+    results['max_diff'] = float(np.max([np.max(np.abs(a - b)) for a, b in pairs]))
+
+    return results
@@ -0,0 +1,179 @@
+"""Reading, preparing and saving images around the generator, without TensorFlow"""
+
+import io
+import os.path
+import ntpath
+import threading
+import numpy as np
+from PIL import Image
+
+
+def as_float(image):
+    """HxWxC image as floats in [0, 1]. Float images are returned as is"""
+
+    image = np.asarray(image)
+    if image.dtype == np.uint8:
+        image = image.astype(np.float32) / 255.0
+
+    return image
+
+class ImageBuffers(threading.local):
+    """Array storage reused by every image of a thread.
+
+    Grows to the largest image seen up to `max_bytes`. Larger images get an
+    array of their own rather than pinning that much memory for good. An
+    image written to the buffer is only valid until the next one on the
+    same thread."""
+
+    def __init__(self, dtype=np.float32, max_bytes=64 * 2**20):
+        self.dtype     = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self._storage  = np.empty([0], dtype=self.dtype)
+
+    def get(self, shape):
+        """Array of the given shape, reusing the thread's storage when it fits"""
+
+        size = int(np.prod(shape))
+        if size * self.dtype.itemsize > self.max_bytes:
+            return np.empty(shape, dtype=self.dtype)
+
+        if self._storage.size < size:
+            self._storage = np.empty([size], dtype=self.dtype)
+
+        return self._storage[:size].reshape(shape)
+
+def decode_image(source, buffers=None):
+    """Decodes an image file, path or file-like object, to HxWx3 floats in [0, 1].
+
+    With `buffers` the result is written into the thread's reusable array
+    rather than a new one."""
+
+    with Image.open(source) as image:
+        pixels = np.asarray(image.convert('RGB'))
+
+    if buffers is None:
+        return as_float(pixels)
+
+    return np.multiply(pixels, np.float32(1.0 / 255.0), out=buffers.get(pixels.shape))
+
+def decode_scaled(source, max_pixels, buffers=None, max_ratio=4):
+    """Decodes an image like `decode_image`, shrinking large JPEGs while decoding.
+
+    JPEGs with more than `max_pixels` pixels are decoded at the smallest of
+    1/2, 1/4 and 1/8 scale, up to 1/`max_ratio`, that still keeps `max_pixels`.
+    libjpeg then skips the high frequency DCT coefficients instead of
+    decoding every pixel and resampling them. Other formats, and every image
+    when `max_pixels` is 0, are decoded at full size. Returns the pixels and
+    the (rows, cols) of the full image."""
+
+    with Image.open(source) as image:
+        cols, rows = image.size
+
+        ratio = 1
+        while max_pixels and 2*ratio <= min(max_ratio, 8) and (cols // (2*ratio)) * (rows // (2*ratio)) >= max_pixels:
+            ratio *= 2
+
+        if ratio > 1:
+            image.draft('RGB', (cols // ratio, rows // ratio))
+
+        pixels = np.asarray(image.convert('RGB'))
+
+    if buffers is None:
+        return as_float(pixels), (rows, cols)
+
+    return np.multiply(pixels, np.float32(1.0 / 255.0), out=buffers.get(pixels.shape)), (rows, cols)
+
+def image_size(source):
+    """(width, height) of an image file, path or file-like object, from its header only.
+
+    Raises ValueError when it is not an image."""
+
+    try:
+        with Image.open(source) as image:
+            return image.size
+    except (IOError, SyntaxError) as e:
+        raise ValueError("Not an image: %s" % (e,))
+
+def read_image(path):
+    """Reads an image file as HxWx3 floats in [0, 1]"""
+    return decode_image(path)
+
+def postprocess(gene_output, size, buffers=None):
+    """Brings a generator output back to `size` (rows, cols) as 8-bit pixels.
+
+    Same as `tf.image.resize_nearest_neighbor`, clipping to [0, 1] and
+    `scipy.misc.toimage(cmin=0., cmax=1.)`: when shrinking by an integer factor
+    nearest neighbour keeps every K-th pixel. With `buffers`, uint8
+    `ImageBuffers`, the pixels are written into the thread's reusable array."""
+
+    rows, cols = size
+    if gene_output.shape[0] % rows == 0 and gene_output.shape[1] % cols == 0:
+        gene_output = gene_output[::gene_output.shape[0] // rows, ::gene_output.shape[1] // cols]
+    else:
+        y = (np.arange(rows) * gene_output.shape[0]) // rows
+        x = (np.arange(cols) * gene_output.shape[1]) // cols
+        gene_output = gene_output[y[:, np.newaxis], x[np.newaxis, :]]
+
+    scaled = gene_output * np.float32(255.)
+    np.clip(scaled, 0., 255., out=scaled)
+    scaled += .5
+
+    pixels = buffers.get(scaled.shape) if buffers is not None else np.empty(scaled.shape, dtype=np.uint8)
+    np.copyto(pixels, scaled, casting='unsafe')
+
+    return pixels
+
+def restored_name(name, tier='full'):
+    """Name of the restored image of the original `name` at a quality tier.
+
+    Every tier has a name of its own, full generator results keep the one
+    they had before there were tiers."""
+
+    if tier == 'full':
+        return "restored_" + ntpath.basename(name)
+
+    return "restored_%s_%s" % (tier, ntpath.basename(name))
+
+def save_restored(path_to_file, pixels, tier='full'):
+    """Saves restored 8-bit pixels next to their original. Returns the name they were saved under.
+
+    The previous result may be hard linked to a result cache entry, so it is
+    replaced by a new file rather than written over."""
+
+    imgname = restored_name(path_to_file, tier)
+    path    = os.path.join(ntpath.dirname(path_to_file), imgname)
+
+    # Same extension, PIL picks the format from it
+    temp = os.path.join(ntpath.dirname(path_to_file), '.%d.%d.%s' % (os.getpid(), threading.get_ident(), imgname))
+    try:
+        Image.fromarray(pixels).save(temp)
+        os.replace(temp, path)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+    return imgname
+
+def upscale_bicubic(image, factor=4):
+    """Bicubic upscale of an HxWx3 image by `factor`, as floats in [0, 1] like
+    a generator output"""
+
+    pixels = np.asarray(image)
+    if pixels.dtype != np.uint8:
+        pixels = np.uint8(np.clip(pixels * 255. + .5, 0., 255.))
+
+    upscaled = Image.fromarray(pixels).resize((pixels.shape[1] * factor, pixels.shape[0] * factor), Image.BICUBIC)
+
+    return as_float(upscaled)
+
+def restore_bicubic(path_to_file, max_pixels=0, data=None):
+    """Restores an image without any generator, the cheapest quality tier.
+
+    Same decoding, postprocessing and output file as the inference engines,
+    see `decode_scaled` for `max_pixels`. Returns the name it was saved under"""
+
+    source      = io.BytesIO(data) if data is not None else path_to_file
+    image, size = decode_scaled(source, max_pixels)
+
+    return save_restored(path_to_file, postprocess(upscale_bicubic(image), size), 'bicubic')
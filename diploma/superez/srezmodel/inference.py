@@ -3,15 +3,21 @@ import sys
 sys.path.insert(0, 'D:\\wamp64\\www\\diploma\\superez')
 sys.path.insert(0, 'D:\\wamp64\\www\\diploma\\superez\srezmodel')
 
-import superez.srezmodel.srez_input2 as srez_input
 import superez.srezmodel.srez_model2 as srez_model
 
+from superez.srezmodel.batching import MicroBatcher
+from superez.srezmodel.stats import RunningStats
+from superez.srezmodel.images import as_float, decode_scaled, postprocess, save_restored, ImageBuffers
+import superez.srezmodel.tiling as tiling
+
+import io
 import os.path
 import random
-import ntpath
+import collections
+import threading
+import time
 import numpy as np
 import numpy.random
-import scipy.misc
 
 import tensorflow as tf
 
@@ -29,12 +35,30 @@ tf.app.flags.DEFINE_string('dataset', 'test',
 tf.app.flags.DEFINE_string('checkpoint_dir', os.path.join(settings.BASE_DIR, "superez/srezmodel/checkpoint"),
                            "Output folder where checkpoints are dumped.")
 
+tf.app.flags.DEFINE_string('frozen_graph', os.path.join(settings.BASE_DIR, "superez/srezmodel/checkpoint/generator.pb"),
+                           "Frozen generator written by `manage.py exportgenerator`. Used instead of the checkpoint when it exists.")
+
 tf.app.flags.DEFINE_bool('log_device_placement', False,
                          "Log the device where variables are placed.")
 
+tf.app.flags.DEFINE_integer('max_batch_size', 8,
+                            "Maximum number of same-size images run through the generator at once.")
+
+tf.app.flags.DEFINE_integer('max_batch_wait_ms', 10,
+                            "Time in milliseconds a request waits for others to share its batch.")
+
 tf.app.flags.DEFINE_integer('random_seed', 0,
                             "Seed used to initialize rng.")
 
+tf.app.flags.DEFINE_integer('tile_memory_mb', 2048,
+                            "Generator memory budget in megabytes. Larger images are upscaled in tiles.")
+
+tf.app.flags.DEFINE_integer('tile_overlap', 8,
+                            "Overlap in input pixels between neighbouring tiles.")
+
+tf.app.flags.DEFINE_integer('warmup_size', 32,
+                            "Side in pixels of the image used to warm up the generator at startup.")
+
 
 def setup_tensorflow():
     # Create session
@@ -54,56 +78,300 @@ def setup_tensorflow():
     return sess, None
 
 
-def inference(path_to_file):
-    # Load checkpoint
-    if not tf.gfile.IsDirectory(FLAGS.checkpoint_dir):
-        raise FileNotFoundError("Could not find folder `%s'" % (FLAGS.checkpoint_dir,))
+def checkpoint_path(checkpoint_dir):
+    """Latest checkpoint in `checkpoint_dir`, as named by its `checkpoint` state
+    file. Folders without one are expected to hold `checkpoint_new.txt`"""
+
+    return tf.train.latest_checkpoint(checkpoint_dir) or os.path.join(checkpoint_dir, 'checkpoint_new.txt')
+
+
+def has_weights(tier='full'):
+    """True when the engine for `tier` can be built: its checkpoint, or for
+    the full generator the frozen graph, exists"""
+
+    if tier == 'small':
+        checkpoint_dir = settings.SUPEREZ_SMALL_CHECKPOINT_DIR
+    elif os.path.exists(FLAGS.frozen_graph):
+        return True
+    else:
+        checkpoint_dir = FLAGS.checkpoint_dir
+
+    if not tf.gfile.IsDirectory(checkpoint_dir):
+        return False
+
+    return tf.gfile.Exists(checkpoint_path(checkpoint_dir) + '.index')
+
+
+_Generator = collections.namedtuple('_Generator', ['sess', 'minput', 'moutput', 'nbytes'])
+
+class InferenceEngine(object):
+    """Generator that is built and restored once, then reused for every request.
+
+    Building the graph and restoring the latest checkpoint dominates the cost of
+    a single upload, so a worker process should keep one engine (see
+    `get_engine`) and call `upscale` for every image. `upscale` may be called
+    from several threads at once.
+
+    The generator accepts any batch and image size, so a single graph serves
+    every request and is finalized once restored. Images of the same size
+    share batches. `spec` is the generator layout of the checkpoint, see
+    `srez_model.generator_spec`. Its upsampling is read from the checkpoint.
+    `norm` is where batch norms get their statistics from, see
+    `srez_model.INFERENCE_NORMS`, by default SUPEREZ_INFERENCE_NORM."""
+
+    def __init__(self, checkpoint_dir=None, spec='full', norm=None):
+        if checkpoint_dir is None:
+            checkpoint_dir = FLAGS.checkpoint_dir
+        if norm is None:
+            norm = settings.SUPEREZ_INFERENCE_NORM
+
+        if norm not in srez_model.INFERENCE_NORMS:
+            raise ValueError("Invalid batch norm statistics `%s'" % (norm,))
+
+        # Load checkpoint
+        if not tf.gfile.IsDirectory(checkpoint_dir):
+            raise FileNotFoundError("Could not find folder `%s'" % (checkpoint_dir,))
+
+        start_time = time.time()
+
+        self.checkpoint = checkpoint_path(checkpoint_dir)
+        self.upsample   = srez_model.checkpoint_upsample(self.checkpoint, spec)
+        self.norm       = norm
+        self.latency    = RunningStats()
+
+        self._new_graph()
+        with self.graph.as_default():
+            gene_minput, gene_moutput = srez_model.create_generator(self.sess, norm=norm, spec=spec,
+                                                                    upsample=self.upsample)
+
+            # Moving averages are checked up front, never replaced by anything else
+            if norm == 'moving':
+                srez_model.check_moving_averages(self.checkpoint, tf.global_variables())
+
+            # Restore variables from checkpoint
+            saver = tf.train.Saver()
+            saver.restore(self.sess, self.checkpoint)
+
+        # Sizes the memory tiles
+        self.res_units = srez_model.generator_spec(spec).res_units
+
+        self._generator = _Generator(self.sess, gene_minput, gene_moutput, self.graph.as_graph_def().ByteSize())
+
+        # Requests must never add ops
+        self.graph.finalize()
+
+        # Pay for lazy kernel initialization now rather than on the first request
+        warmup = np.zeros([FLAGS.warmup_size, FLAGS.warmup_size, 3], dtype=np.float32)
+        self.upscale(warmup)
+
+        self.startup_time = time.time() - start_time
+        print("    Inference engine ready in %.2fs" % (self.startup_time,))
+
+    def _new_graph(self):
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            # Setup global tensorflow state
+            self.sess, _ = setup_tensorflow()
+
+    def batch_key(self, image):
+        """Images of the same size can share a batch.
+
+        Padding images to a common size would change their per-sample batch
+        norm statistics, and so their outputs."""
+        return (image.shape[0], image.shape[1])
+
+    def upscale_batch(self, images):
+        """Runs the generator on several images of the same size in a single call.
+
+        `images` are HxWx3, either uint8 or float in [0, 1]. Returns a list of
+        float32 images 4x larger in each spatial dimension than the inputs."""
+
+        start_time = time.time()
+
+        features = [as_float(image) for image in images]
+        key      = self.batch_key(features[0])
+        assert all(self.batch_key(f) == key for f in features) and "Images must have the same size"
+
+        generator   = self._generator
+        gene_output = generator.sess.run(generator.moutput, feed_dict={generator.minput: np.stack(features)})
+
+        self.latency.add(time.time() - start_time)
+        return list(gene_output)
+
+    def upscale(self, image_array):
+        """Runs the generator on a single HxWx3 image"""
+        return self.upscale_batch([image_array])[0]
+
+    def stats(self):
+        """Startup time and per-request latency, reported separately"""
+
+        return {'startup': self.startup_time,
+                'request': self.latency.summary(),
+                'checkpoint': {'path':     self.checkpoint,
+                               'upsample': self.upsample,
+                               'norm':     self.norm,
+                               'bytes':    self._generator.nbytes}}
+
+
+def _graph_layers(graph_def):
+    """Convolutions and upscales of a frozen generator in execution order, see `tiling.stage_widths`"""
+
+    consts = {node.name: node for node in graph_def.node if node.op == 'Const'}
+    for node in graph_def.node:
+        if node.op == 'Conv2D' and node.input[1] in consts:
+            shape = consts[node.input[1]].attr['value'].tensor.tensor_shape
+            yield 'conv2d', shape.dim[3].size
+        elif node.op in ('ResizeNearestNeighbor', 'DepthToSpace'):
+            yield 'upscale', None
+
+class FrozenInferenceEngine(InferenceEngine):
+    """Inference engine running the frozen generator written by `manage.py exportgenerator`.
+
+    The frozen graph holds the weights as constants, so there is no
+    checkpoint to restore."""
+
+    def __init__(self, frozen_graph=None):
+        if frozen_graph is None:
+            frozen_graph = FLAGS.frozen_graph
+
+        start_time = time.time()
+
+        self.frozen_graph = frozen_graph
+        self.latency      = RunningStats()
+
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(frozen_graph, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+
+        self._new_graph()
+        with self.graph.as_default():
+            gene_minput, gene_moutput = tf.import_graph_def(graph_def, name='',
+                                                            return_elements=['input:0', 'output:0'])
+
+        self._generator = _Generator(self.sess, gene_minput, gene_moutput, graph_def.ByteSize())
+        self.graph.finalize()
+
+        # The graph may have been exported from any layout
+        self.res_units = tiling.stage_widths(_graph_layers(graph_def))
+
+        # Pay for lazy kernel initialization now rather than on the first request
+        warmup = np.zeros([FLAGS.warmup_size, FLAGS.warmup_size, 3], dtype=np.float32)
+        self.upscale(warmup)
+
+        self.startup_time = time.time() - start_time
+        print("    Frozen inference engine ready in %.2fs" % (self.startup_time,))
+
+    def stats(self):
+        """Startup time and per-request latency, reported separately"""
+
+        return {'startup': self.startup_time,
+                'request': self.latency.summary(),
+                'frozen_graph': {'path':  self.frozen_graph,
+                                 'bytes': self._generator.nbytes}}
+
+
+# Engines and batchers of this process by quality tier, 'full' or 'small'
+_engines     = {}
+_batchers    = {}
+_engine_lock = threading.Lock()
+
+def _create_engine(tier):
+    if tier == 'small':
+        return InferenceEngine(settings.SUPEREZ_SMALL_CHECKPOINT_DIR, spec=settings.SUPEREZ_SMALL_SPEC)
+
+    if os.path.exists(FLAGS.frozen_graph):
+        return FrozenInferenceEngine()
+
+    return InferenceEngine()
+
+def get_engine(tier='full'):
+    """Returns the inference engine of this process for `tier`, building it on first use"""
+
+    engine = _engines.get(tier)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(tier)
+            if engine is None:
+                engine = _engines[tier] = _create_engine(tier)
+
+    return engine
+
+def get_batcher(tier='full'):
+    """Returns the request batcher in front of this process's engine for `tier`"""
+
+    batcher = _batchers.get(tier)
+    if batcher is None:
+        engine = get_engine(tier)
+        with _engine_lock:
+            batcher = _batchers.get(tier)
+            if batcher is None:
+                batcher = _batchers[tier] = MicroBatcher(engine,
+                                                         batch_key=engine.batch_key,
+                                                         max_batch_size=FLAGS.max_batch_size,
+                                                         max_wait=FLAGS.max_batch_wait_ms / 1000.0)
+
+    return batcher
+
+def upscale_image(image, tier='full'):
+    """Upscales an HxWx3 image of any size.
+
+    Images whose activations would not fit in the memory budget are split in
+    overlapping tiles that are batched through the generator and blended back.
+    With SUPEREZ_ADAPTIVE_THRESHOLD set, flat blocks of the image are upscaled
+    bicubic and only the tiles under detailed ones go through the generator."""
 
-    # Setup global tensorflow state
-    sess, summary_writer = setup_tensorflow()
+    engine        = get_engine(tier)
+    memory_budget = FLAGS.tile_memory_mb * 2**20
+    tile_size     = None
+    if tiling.needs_tiling(image.shape, memory_budget, engine.res_units):
+        tile_size = tiling.choose_tile_size(memory_budget, FLAGS.max_batch_size, FLAGS.tile_overlap,
+                                            res_units=engine.res_units)
 
-    # Prepare directories
-    filenames = [path_to_file]
+    if settings.SUPEREZ_ADAPTIVE_THRESHOLD > 0:
+        gene_output, num_blocks, num_flat = \
+                tiling.upscale_adaptive(engine.upscale_batch, image, settings.SUPEREZ_ADAPTIVE_BLOCK,
+                                        settings.SUPEREZ_ADAPTIVE_THRESHOLD, tile_size=tile_size,
+                                        overlap=FLAGS.tile_overlap, batch_size=FLAGS.max_batch_size)
+        print("    Upscaled %dx%d image in %d blocks, %d of them flat" %
+              (image.shape[1], image.shape[0], num_blocks, num_flat))
+        return gene_output
 
-    # Setup async input queues
-    features = srez_input.setup_inputs(sess, filenames, 128)
+    if tile_size is None:
+        return get_batcher(tier).upscale(image)
 
-    # Create and initialize model
-    [gene_minput, gene_moutput] = srez_model.create_model(sess, features)
+    gene_output, num_tiles = tiling.upscale_tiled(engine.upscale_batch, image, tile_size,
+                                                  overlap=FLAGS.tile_overlap,
+                                                  batch_size=FLAGS.max_batch_size)
+    print("    Upscaled %dx%d image in %d tiles of %dpx" % (image.shape[1], image.shape[0], num_tiles, tile_size))
 
-    # Restore variables from checkpoint
-    saver = tf.train.Saver()
-    filename = 'checkpoint_new.txt'
-    filename = os.path.join(FLAGS.checkpoint_dir, filename)
-    saver.restore(sess, filename)
+    return gene_output
 
-    # test_feature, test_label = sess.run([features, labels])
-    test_feature = sess.run(features)
 
-    # Show progress with test features
-    gene_output = sess.run(gene_moutput, feed_dict={gene_minput: test_feature})
+# Decoded uploads and restored pixels, reused across the requests of each worker thread
+_decode_buffers = ImageBuffers()
+_pixel_buffers  = ImageBuffers(np.uint8)
 
-    # Visualize
-    max_samples = 1
+def inference(path_to_file, data=None, tier='full'):
+    """Restores an image and saves the result next to `path_to_file`.
 
-    size = [test_feature.shape[1], test_feature.shape[2]]
+    `data` is the encoded image when it is already in memory, e.g. an upload
+    buffer. The file at `path_to_file` is then never read. `tier` picks the
+    full or the small generator."""
 
-    nearest = tf.image.resize_nearest_neighbor(test_feature, size)
-    nearest = tf.maximum(tf.minimum(nearest, 1.0), 0.0)
+    engine = get_engine(tier)
+    start_time = time.time()
 
-    gene_output = tf.image.resize_nearest_neighbor(gene_output, size)
-    clipped = tf.maximum(tf.minimum(gene_output, 1.0), 0.0)
+    # Large uploads may be decoded at a reduced scale, the result keeps their full size
+    source             = io.BytesIO(data) if data is not None else path_to_file
+    test_feature, size = decode_scaled(source, settings.SUPEREZ_DECODE_MAX_PIXELS, _decode_buffers)
 
-    # image   = tf.concat([nearest, clipped, test_label], 2)
-    image = tf.concat([clipped], 2)
+    gene_output = upscale_image(test_feature, tier)
 
-    image = image[0:max_samples, :, :, :]
-    image = tf.concat([image[i, :, :, :] for i in range(max_samples)], 0)
-    image = sess.run(image)
+    # Visualize. Plain NumPy, so that requests never add ops to the engine graph
+    image = postprocess(gene_output, size, _pixel_buffers)
 
-    imgname = "restored_" + ntpath.basename(filenames[0])
-    scipy.misc.toimage(image, cmin=0., cmax=1.).save(os.path.join(ntpath.dirname(filenames[0]), imgname))
-    print("    Saved %s" % (imgname,))
+    imgname = save_restored(path_to_file, image, tier)
+    print("    Saved %s in %.3fs (engine startup %.2fs)" % (imgname, time.time() - start_time, engine.startup_time))
 
 
 if __name__ == "__main__":
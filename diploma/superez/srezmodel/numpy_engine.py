@@ -0,0 +1,371 @@
+"""Generator implemented with NumPy alone.
+
+Runs the layers written by `manage.py exportgenerator --format numpy`, so a
+worker can serve upscales without ever importing TensorFlow. The weights are
+stored uncompressed and memory-mapped: starting an engine costs next to
+nothing, and every process serving from the same file shares its pages
+through the page cache."""
+
+from superez.srezmodel.stats import RunningStats
+from superez.srezmodel.images import as_float, decode_scaled, ImageBuffers, postprocess, save_restored
+import superez.srezmodel.tiling as tiling
+
+import io
+import json
+import os.path
+import struct
+import threading
+import time
+import zipfile
+import numpy as np
+
+from django.conf import settings
+
+# Same as tf.contrib.layers.batch_norm
+BATCH_NORM_EPSILON = 0.001
+
+# Images whose activations would take more memory than this are upscaled in tiles
+TILE_MEMORY  = 1024 * 2**20
+TILE_OVERLAP = 8
+
+
+def save_generator(f, layers):
+    """Writes layers from `export.fold_layers` to the file object `f` as an uncompressed .npz.
+
+    Every array of a layer is stored as '<layer name>/<key>', everything else
+    goes to the 'layers' JSON description."""
+
+    arrays = {}
+    spec   = []
+    for layer in layers:
+        description = {}
+        for key, value in layer.items():
+            if isinstance(value, np.ndarray):
+                arrays['%s/%s' % (layer['name'], key)] = np.ascontiguousarray(value, dtype=np.float32)
+            else:
+                description[key] = value
+
+        spec.append(description)
+
+    np.savez(f, layers=np.array(json.dumps(spec)), **arrays)
+
+def load_arrays(path):
+    """Memory-maps every array of an uncompressed .npz file. Returns a dict by name.
+
+    np.load can't map arrays inside an archive, but members that are stored
+    without compression are plain .npy files at a known offset."""
+
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                arrays[name] = np.load(archive.open(info))
+                continue
+
+            # Skip the local file header, whose extra field may differ from the central directory
+            f.seek(info.header_offset)
+            header = f.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if not shape:
+                # Scalars are too small to be worth mapping
+                arrays[name] = np.load(archive.open(info))
+                continue
+
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=f.tell(), shape=shape,
+                                     order='F' if fortran_order else 'C')
+
+    return arrays
+
+def load_generator(path):
+    """Reads a file written by `save_generator`. Returns the layers, with their arrays memory-mapped"""
+
+    arrays = load_arrays(path)
+
+    layers = json.loads(arrays.pop('layers').item())
+    for layer in layers:
+        prefix = layer['name'] + '/'
+        for name in list(arrays.keys()):
+            if name.startswith(prefix):
+                layer[name[len(prefix):]] = arrays.pop(name)
+
+    return layers
+
+
+def _pad_same(x, mapsize_y, mapsize_x, stride):
+    """Pads NHWC `x` like 'SAME' padding does. Returns it and the output rows and columns"""
+
+    _, rows, cols, _ = x.shape
+
+    out_rows = -(-rows // stride)
+    out_cols = -(-cols // stride)
+
+    pad_rows = max((out_rows - 1) * stride + mapsize_y - rows, 0)
+    pad_cols = max((out_cols - 1) * stride + mapsize_x - cols, 0)
+    if pad_rows or pad_cols:
+        x = np.pad(x, [[0, 0],
+                       [pad_rows // 2, pad_rows - pad_rows // 2],
+                       [pad_cols // 2, pad_cols - pad_cols // 2],
+                       [0, 0]], mode='constant')
+
+    return x, out_rows, out_cols
+
+def _conv2d(x, weight, bias, stride=1):
+    """Same as tf.nn.conv2d with 'SAME' padding followed by a bias, on NHWC floats.
+
+    Sums one matrix product per kernel tap rather than building the whole
+    im2col matrix, so the extra memory stays at one shifted copy of the input."""
+
+    mapsize_y, mapsize_x = weight.shape[0], weight.shape[1]
+    batch = x.shape[0]
+
+    x, out_rows, out_cols = _pad_same(x, mapsize_y, mapsize_x, stride)
+
+    out = np.empty([batch, out_rows, out_cols, weight.shape[3]], dtype=np.float32)
+    out[...] = bias
+    for dy in range(mapsize_y):
+        for dx in range(mapsize_x):
+            patch = x[:, dy:dy + (out_rows - 1) * stride + 1:stride,
+                         dx:dx + (out_cols - 1) * stride + 1:stride]
+            out += np.matmul(patch, weight[dy, dx])
+
+    return out
+
+def _separable_conv2d(x, depthwise, pointwise, bias, stride=1):
+    """Same as tf.nn.separable_conv2d with 'SAME' padding followed by a bias, on NHWC floats"""
+
+    mapsize_y, mapsize_x = depthwise.shape[0], depthwise.shape[1]
+    batch, _, _, channels = x.shape
+
+    x, out_rows, out_cols = _pad_same(x, mapsize_y, mapsize_x, stride)
+
+    # Depthwise taps are elementwise, the pointwise convolution a single matrix product
+    acc = np.zeros([batch, out_rows, out_cols, channels], dtype=np.float32)
+    for dy in range(mapsize_y):
+        for dx in range(mapsize_x):
+            patch = x[:, dy:dy + (out_rows - 1) * stride + 1:stride,
+                         dx:dx + (out_cols - 1) * stride + 1:stride]
+            acc += patch * depthwise[dy, dx, :, 0]
+
+    return np.matmul(acc, pointwise[0, 0]) + bias
+
+def _depth_to_space(x, block):
+    """Same as tf.depth_to_space on NHWC floats"""
+
+    batch, rows, cols, depth = x.shape
+    channels = depth // (block * block)
+
+    x = x.reshape([batch, rows, cols, block, block, channels]).transpose([0, 1, 3, 2, 4, 5])
+    return x.reshape([batch, rows * block, cols * block, channels])
+
+def _per_sample_norm(x, beta, gamma):
+    mean     = x.mean(axis=(1, 2), keepdims=True)
+    variance = np.square(x - mean).mean(axis=(1, 2), keepdims=True)
+    return (x - mean) * (gamma / np.sqrt(variance + BATCH_NORM_EPSILON)) + beta
+
+def _sigmoid(x):
+    # Split by sign so that exp never overflows
+    out      = np.empty_like(x)
+    positive = x >= 0
+    out[positive]  = 1. / (1. + np.exp(-x[positive]))
+    negative = np.exp(x[~positive])
+    out[~positive] = negative / (1. + negative)
+    return out
+
+def _run_layer(layer, outputs):
+    x  = outputs[layer['input']]
+    op = layer['op']
+
+    if op == 'conv2d':
+        return _conv2d(x, layer['weight'], layer['bias'], layer['stride'])
+
+    if op == 'separable_conv2d':
+        return _separable_conv2d(x, layer['depthwise'], layer['pointwise'], layer['bias'], layer['stride'])
+
+    if op == 'batch_norm':
+        return _per_sample_norm(x, layer['beta'], layer['gamma'])
+
+    if op == 'affine':
+        return x * layer['multiplier'] + layer['offset']
+
+    if op == 'identity':
+        return x
+
+    if op == 'relu':
+        return np.maximum(x, 0.)
+
+    if op == 'elu':
+        return np.where(x > 0, x, np.expm1(np.minimum(x, 0.)))
+
+    if op == 'lrelu':
+        leak = layer['leak']
+        return .5 * (1 + leak) * x + .5 * (1 - leak) * np.abs(x)
+
+    if op == 'sigmoid':
+        return _sigmoid(x)
+
+    if op == 'sum':
+        return x + outputs[layer['term']]
+
+    if op == 'upscale':
+        return x.repeat(2, axis=1).repeat(2, axis=2)
+
+    if op == 'subpixel_upscale':
+        return _depth_to_space(_conv2d(x, layer['weight'], layer['bias']), 2)
+
+    raise ValueError("Layer `%s' of type `%s' is not supported by the NumPy engine" % (layer['name'], op))
+
+
+def _layer_widths(layers):
+    # (op, output channels) of every layer, see `tiling.stage_widths`
+    for layer in layers:
+        if layer['op'] == 'conv2d':
+            yield 'conv2d', layer['weight'].shape[-1]
+        elif layer['op'] == 'subpixel_upscale':
+            yield 'conv2d', layer['weight'].shape[-1]
+            yield 'upscale', None
+        elif layer['op'] == 'separable_conv2d':
+            yield 'separable_conv2d', layer['pointwise'].shape[-1]
+        else:
+            yield layer['op'], None
+
+class NumpyEngine(object):
+    """Generator running on NumPy from weights exported with `--format numpy`.
+
+    Same interface as `inference.InferenceEngine`. `upscale` may be called
+    from several threads at once: the weights are read-only and NumPy
+    releases the GIL inside the matrix products."""
+
+    def __init__(self, weights_path=None):
+        if weights_path is None:
+            weights_path = settings.SUPEREZ_NUMPY_WEIGHTS
+
+        start_time = time.time()
+
+        self.weights_path = weights_path
+        self.layers       = load_generator(weights_path)
+        self.latency      = RunningStats()
+
+        # Sizes the memory tiles, the weights may be of any layout
+        self.res_units = tiling.stage_widths(_layer_widths(self.layers))
+
+        # Activations are only kept while some later layer still reads them
+        self._last_reader = {}
+        for i, layer in enumerate(self.layers):
+            self._last_reader[layer['input']] = i
+            if layer['op'] == 'sum':
+                self._last_reader[layer['term']] = i
+
+        self.startup_time = time.time() - start_time
+        print("    NumPy inference engine ready in %.2fs" % (self.startup_time,))
+
+    def batch_key(self, image):
+        """Images of the same size can share a batch"""
+        return (image.shape[0], image.shape[1])
+
+    def upscale_batch(self, images):
+        """Runs the generator on several images of the same size at once.
+
+        `images` are HxWx3, either uint8 or float in [0, 1]. Returns a list of
+        float32 images 4x larger in each spatial dimension than the inputs."""
+
+        start_time = time.time()
+
+        outputs = [np.stack([as_float(image) for image in images]).astype(np.float32, copy=False)]
+        for i, layer in enumerate(self.layers):
+            outputs.append(_run_layer(layer, outputs).astype(np.float32, copy=False))
+
+            # Free activations no later layer reads
+            for j in range(len(outputs) - 1):
+                if outputs[j] is not None and self._last_reader.get(j, -1) <= i:
+                    outputs[j] = None
+
+        self.latency.add(time.time() - start_time)
+        return list(outputs[-1])
+
+    def upscale(self, image_array):
+        """Runs the generator on a single HxWx3 image"""
+        return self.upscale_batch([image_array])[0]
+
+    def stats(self):
+        """Startup time and per-request latency, reported separately"""
+
+        return {'startup': self.startup_time,
+                'request': self.latency.summary(),
+                'weights': self.weights_path}
+
+
+def has_weights(tier='full'):
+    """True when the weights of `tier` exist"""
+    return os.path.exists(settings.SUPEREZ_NUMPY_SMALL_WEIGHTS if tier == 'small' else settings.SUPEREZ_NUMPY_WEIGHTS)
+
+
+# Engines of this process by quality tier, 'full' or 'small'
+_engines     = {}
+_engine_lock = threading.Lock()
+
+def get_engine(tier='full'):
+    """Returns the NumPy engine of this process for `tier`, mapping the weights on first use"""
+
+    engine = _engines.get(tier)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(tier)
+            if engine is None:
+                weights_path = settings.SUPEREZ_NUMPY_SMALL_WEIGHTS if tier == 'small' else None
+                engine = _engines[tier] = NumpyEngine(weights_path)
+
+    return engine
+
+def upscale_image(image, tier='full'):
+    """Upscales an HxWx3 image of any size, in tiles if it is too large. With
+    SUPEREZ_ADAPTIVE_THRESHOLD set flat blocks are upscaled bicubic"""
+
+    engine    = get_engine(tier)
+    tile_size = None
+    if tiling.needs_tiling(image.shape, TILE_MEMORY, engine.res_units):
+        tile_size = tiling.choose_tile_size(TILE_MEMORY, overlap=TILE_OVERLAP, res_units=engine.res_units)
+
+    if settings.SUPEREZ_ADAPTIVE_THRESHOLD > 0:
+        gene_output, _, _ = tiling.upscale_adaptive(engine.upscale_batch, image, settings.SUPEREZ_ADAPTIVE_BLOCK,
+                                                    settings.SUPEREZ_ADAPTIVE_THRESHOLD, tile_size=tile_size,
+                                                    overlap=TILE_OVERLAP, batch_size=1)
+        return gene_output
+
+    if tile_size is None:
+        return engine.upscale(image)
+
+    gene_output, _ = tiling.upscale_tiled(engine.upscale_batch, image, tile_size,
+                                          overlap=TILE_OVERLAP, batch_size=1)
+    return gene_output
+
+# Decoded uploads and restored pixels, reused across the requests of each worker thread
+_decode_buffers = ImageBuffers()
+_pixel_buffers  = ImageBuffers(np.uint8)
+
+def inference(path_to_file, data=None, tier='full'):
+    """Restores an image with the NumPy engine and saves the result next to `path_to_file`.
+
+    `data` is the encoded image when it is already in memory, e.g. an upload
+    buffer. The file at `path_to_file` is then never read. `tier` picks the
+    full or the small generator."""
+
+    engine = get_engine(tier)
+    start_time = time.time()
+
+    source      = io.BytesIO(data) if data is not None else path_to_file
+    image, size = decode_scaled(source, settings.SUPEREZ_DECODE_MAX_PIXELS, _decode_buffers)
+    gene_output = upscale_image(image, tier)
+    restored    = postprocess(gene_output, size, _pixel_buffers)
+
+    imgname = save_restored(path_to_file, restored, tier)
+    print("    Saved %s in %.3fs (engine startup %.2fs)" % (imgname, time.time() - start_time, engine.startup_time))
@@ -1,16 +1,70 @@
+import collections
+
 import numpy as np
 import tensorflow as tf
 
 FLAGS = tf.app.flags.FLAGS
 
+# Generator layouts by name, the same as in srez_model.py of the training code
+GENERATOR_SPECS = {'full':   '256x2,128x2,96',
+                   'medium': '128x2,64x2,64',
+                   'small':  '64x1,32x1,32/separable',
+                   'tiny':   '32x1,16x1,16/separable'}
+
+GeneratorSpec = collections.namedtuple('GeneratorSpec', ['res_units', 'blocks', 'separable'])
+
+# Generator upsampling, picked by --generator_upsample in training:
+#   nearest  - nearest neighbor upscale, then a convolution
+#   subpixel - convolution to 4x the channels, then depth_to_space
+UPSAMPLES = ('nearest', 'subpixel')
+
+# Statistics batch norms use when serving, as --inference_norm in training:
+#   batch  - every image is normalized by its own statistics, which any checkpoint supports
+#   moving - the moving averages, which the checkpoint must have trained, see `check_moving_averages`
+INFERENCE_NORMS = ('batch', 'moving')
+
+def generator_spec(spec='full'):
+    """Parses a generator layout, either a name from GENERATOR_SPECS or e.g.
+    '128x2,64x2,64/separable'.
+
+    Each stage before a 2x upscale is given as its width and number of
+    residual blocks, then comes the width of the final convolutions. With
+    '/separable' the 3x3 convolutions are depthwise separable."""
+
+    if isinstance(spec, GeneratorSpec):
+        return spec
+
+    text = GENERATOR_SPECS.get(spec, spec)
+    try:
+        stages, _, options = text.partition('/')
+        stages = stages.split(',')
+
+        widths = [int(stage.split('x')[0]) for stage in stages]
+        blocks = [int(stage.split('x')[1]) for stage in stages[:-1]]
+    except (ValueError, IndexError):
+        raise ValueError("Invalid generator spec `%s'" % (spec,))
+
+    if len(widths) < 2 or 'x' in stages[-1] or options not in ('', 'separable'):
+        raise ValueError("Invalid generator spec `%s'" % (spec,))
+
+    return GeneratorSpec(tuple(widths), tuple(blocks), options == 'separable')
+
 class Model:
     """A neural network model.
 
-    Currently only supports a feedforward architecture."""
+    Currently only supports a feedforward architecture.
+
+    `norm` is where batch norms get their statistics from, one of
+    INFERENCE_NORMS, or None for tf.contrib.layers.batch_norm in training
+    mode."""
     
-    def __init__(self, name, features):
+    def __init__(self, name, features, norm=None):
+        assert norm is None or norm in INFERENCE_NORMS
+
         self.name = name
         self.outputs = [features]
+        self.layers = []
+        self.norm = norm
 
     def _get_layer_str(self, layer=None):
         if layer is None:
@@ -21,6 +75,14 @@ class Model:
     def _get_num_inputs(self):
         return int(self.get_output().get_shape()[-1])
 
+    def _get_scaled_shape(self, factor, num_units):
+        """Static shape of the top layer with rows and columns times `factor`, None where unknown"""
+
+        shape = self.get_output().get_shape().as_list()
+        rows, cols = [s * factor if s is not None else None for s in shape[1:3]]
+
+        return [shape[0], rows, cols, num_units]
+
     def _glorot_initializer(self, prev_units, num_units, stddev_factor=1.0):
         """Initialization in the style of Glorot 2010.
 
@@ -41,6 +103,20 @@ class Model:
     def get_num_layers(self):
         return len(self.outputs)
 
+    def _get_output_index(self, tensor):
+        indices = [i for i, out in enumerate(self.outputs) if out is tensor]
+        assert indices and "Tensor is not an output of this model"
+        return indices[-1]
+
+    def _record(self, op, **params):
+        """Describes the layer about to be added, so that the network can be
+        rebuilt without this class (see export.py).
+
+        `input` and `term` are indices into `self.outputs`."""
+
+        layer = dict(params, op=op, name=self._get_layer_str(), input=self.get_num_layers()-1)
+        self.layers.append(layer)
+
     def add_batch_norm(self, scale=False):
         """Adds a batch normalization layer to this model.
 
@@ -48,11 +124,60 @@ class Model:
 
         # TBD: This appears to be very flaky, often raising InvalidArgumentError internally
         with tf.variable_scope(self._get_layer_str()):
-            out = tf.contrib.layers.batch_norm(self.get_output(), scale=scale)
+            if self.norm == 'batch':
+                out = self._per_sample_norm(self.get_output(), scale=scale)
+            elif self.norm == 'moving':
+                out = self._moving_norm(self.get_output(), scale=scale)
+            else:
+                out = tf.contrib.layers.batch_norm(self.get_output(), scale=scale)
         
+        self._record('batch_norm', scale=scale)
         self.outputs.append(out)
         return self
 
+    def _per_sample_norm(self, features, scale=False, epsilon=0.001):
+        """Batch normalization with statistics computed over each sample alone.
+
+        Same result and variable names as tf.contrib.layers.batch_norm in
+        training mode at batch size 1, but images that are batched together
+        no longer change each other's output."""
+
+        num_units = self._get_num_inputs()
+
+        with tf.variable_scope('BatchNorm'):
+            beta  = tf.get_variable('beta', shape=[num_units], initializer=tf.zeros_initializer())
+            gamma = None
+            if scale:
+                gamma = tf.get_variable('gamma', shape=[num_units], initializer=tf.ones_initializer())
+
+            mean, variance = tf.nn.moments(features, [1, 2], keep_dims=True)
+            out = tf.nn.batch_normalization(features, mean, variance, beta, gamma, epsilon)
+
+        return out
+
+    def _moving_norm(self, features, scale=False, epsilon=0.001):
+        """Batch normalization with the moving averages of training.
+
+        Same result and variable names as tf.contrib.layers.batch_norm in
+        inference mode."""
+
+        num_units = self._get_num_inputs()
+
+        with tf.variable_scope('BatchNorm'):
+            beta  = tf.get_variable('beta', shape=[num_units], initializer=tf.zeros_initializer())
+            gamma = None
+            if scale:
+                gamma = tf.get_variable('gamma', shape=[num_units], initializer=tf.ones_initializer())
+
+            moving_mean     = tf.get_variable('moving_mean', shape=[num_units],
+                                              initializer=tf.zeros_initializer(), trainable=False)
+            moving_variance = tf.get_variable('moving_variance', shape=[num_units],
+                                              initializer=tf.ones_initializer(), trainable=False)
+
+            out = tf.nn.batch_normalization(features, moving_mean, moving_variance, beta, gamma, epsilon)
+
+        return out
+
     def add_flatten(self):
         """Transforms the output of this network to a 1D tensor"""
 
@@ -60,6 +185,7 @@ class Model:
             batch_size = int(self.get_output().get_shape()[0])
             out = tf.reshape(self.get_output(), [batch_size, -1])
 
+        self._record('flatten')
         self.outputs.append(out)
         return self
 
@@ -85,6 +211,7 @@ class Model:
             # Output of this layer
             out     = tf.matmul(self.get_output(), weight) + bias
 
+        self._record('dense', units=num_units)
         self.outputs.append(out)
         return self
 
@@ -95,6 +222,7 @@ class Model:
             prev_units = self._get_num_inputs()
             out = tf.nn.sigmoid(self.get_output())
         
+        self._record('sigmoid')
         self.outputs.append(out)
         return self
 
@@ -108,6 +236,7 @@ class Model:
             out = this_input / (acc+FLAGS.epsilon)
             #out = tf.verify_tensor_all_finite(out, "add_softmax failed; is sum equal to zero?")
         
+        self._record('softmax')
         self.outputs.append(out)
         return self
 
@@ -117,6 +246,7 @@ class Model:
         with tf.variable_scope(self._get_layer_str()):
             out = tf.nn.relu(self.get_output())
 
+        self._record('relu')
         self.outputs.append(out)
         return self        
 
@@ -126,6 +256,7 @@ class Model:
         with tf.variable_scope(self._get_layer_str()):
             out = tf.nn.elu(self.get_output())
 
+        self._record('elu')
         self.outputs.append(out)
         return self
 
@@ -138,6 +269,7 @@ class Model:
             out = t1 * self.get_output() + \
                   t2 * tf.abs(self.get_output())
             
+        self._record('lrelu', leak=leak)
         self.outputs.append(out)
         return self
 
@@ -163,6 +295,34 @@ class Model:
             bias   = tf.get_variable('bias', initializer=initb)
             out    = tf.nn.bias_add(out, bias)
             
+        self._record('conv2d', units=num_units, mapsize=mapsize, stride=stride)
+        self.outputs.append(out)
+        return self
+
+    def add_separable_conv2d(self, num_units, mapsize=1, stride=1, stddev_factor=1.0):
+        """Adds a depthwise separable 2D convolutional layer, see Arxiv 1610.02357"""
+
+        assert len(self.get_output().get_shape()) == 4 and "Previous layer must be 4-dimensional (batch, width, height, channels)"
+
+        with tf.variable_scope(self._get_layer_str()):
+            prev_units = self._get_num_inputs()
+
+            # Spatial filter per input channel, then a 1x1 convolution
+            initd     = self._glorot_initializer_conv2d(prev_units, 1, mapsize, stddev_factor=1.)
+            depthwise = tf.get_variable('depthwise', initializer=initd)
+            initp     = self._glorot_initializer_conv2d(prev_units, num_units, 1,
+                                                        stddev_factor=stddev_factor)
+            pointwise = tf.get_variable('pointwise', initializer=initp)
+            out       = tf.nn.separable_conv2d(self.get_output(), depthwise, pointwise,
+                                               strides=[1, stride, stride, 1],
+                                               padding='SAME')
+
+            # Bias term
+            initb  = tf.constant(0.0, shape=[num_units])
+            bias   = tf.get_variable('bias', initializer=initb)
+            out    = tf.nn.bias_add(out, bias)
+
+        self._record('separable_conv2d', units=num_units, mapsize=mapsize, stride=stride)
         self.outputs.append(out)
         return self
 
@@ -181,25 +341,28 @@ class Model:
             weight = tf.get_variable('weight', initializer=initw)
             weight = tf.transpose(weight, perm=[0, 1, 3, 2])
             prev_output = self.get_output()
-            output_shape = [FLAGS.batch_size,
-                            int(prev_output.get_shape()[1]) * stride,
-                            int(prev_output.get_shape()[2]) * stride,
-                            num_units]
+            # Output shape from the input at run time, so that any batch and
+            # image size can go through the same graph
+            prev_shape   = tf.shape(prev_output)
+            output_shape = tf.stack([prev_shape[0], prev_shape[1] * stride, prev_shape[2] * stride, num_units])
             out    = tf.nn.conv2d_transpose(self.get_output(), weight,
                                             output_shape=output_shape,
                                             strides=[1, stride, stride, 1],
                                             padding='SAME')
+            out.set_shape(self._get_scaled_shape(stride, num_units))
 
             # Bias term
             initb  = tf.constant(0.0, shape=[num_units])
             bias   = tf.get_variable('bias', initializer=initb)
             out    = tf.nn.bias_add(out, bias)
             
+        self._record('conv2d_transpose', units=num_units, mapsize=mapsize, stride=stride)
         self.outputs.append(out)
         return self
 
-    def add_residual_block(self, num_units, mapsize=3, num_layers=2, stddev_factor=1e-3):
-        """Adds a residual block as per Arxiv 1512.03385, Figure 3"""
+    def add_residual_block(self, num_units, mapsize=3, num_layers=2, stddev_factor=1e-3, separable=False):
+        """Adds a residual block as per Arxiv 1512.03385, Figure 3, optionally
+        with depthwise separable convolutions"""
 
         assert len(self.get_output().get_shape()) == 4 and "Previous layer must be 4-dimensional (batch, width, height, channels)"
 
@@ -213,7 +376,10 @@ class Model:
         for _ in range(num_layers):
             self.add_batch_norm()
             self.add_relu()
-            self.add_conv2d(num_units, mapsize=mapsize, stride=1, stddev_factor=stddev_factor)
+            if separable:
+                self.add_separable_conv2d(num_units, mapsize=mapsize, stride=1, stddev_factor=stddev_factor)
+            else:
+                self.add_conv2d(num_units, mapsize=mapsize, stride=1, stddev_factor=stddev_factor)
 
         self.add_sum(bypass)
 
@@ -268,9 +434,10 @@ class Model:
             prev_shape = self.get_output().get_shape()
             term_shape = term.get_shape()
             #print("%s %s" % (prev_shape, term_shape))
-            assert prev_shape == term_shape and "Can't sum terms with a different size"
+            assert prev_shape.is_compatible_with(term_shape) and "Can't sum terms with a different size"
             out = tf.add(self.get_output(), term)
         
+        self._record('sum', term=self._get_output_index(term))
         self.outputs.append(out)
         return self
 
@@ -284,19 +451,55 @@ class Model:
             reduction_indices = reduction_indices[1:-1]
             out = tf.reduce_mean(self.get_output(), reduction_indices=reduction_indices)
         
+        self._record('mean')
         self.outputs.append(out)
         return self
 
     def add_upscale(self):
         """Adds a layer that upscales the output by 2x through nearest neighbor interpolation"""
 
-        prev_shape = self.get_output().get_shape()
-        size = [2 * int(s) for s in prev_shape[1:3]]
+        size = 2 * tf.shape(self.get_output())[1:3]
         out  = tf.image.resize_nearest_neighbor(self.get_output(), size)
+        out.set_shape(self._get_scaled_shape(2, self._get_num_inputs()))
 
+        self._record('upscale')
         self.outputs.append(out)
         return self        
 
+    def add_subpixel_upscale(self, num_units, mapsize=3, stddev_factor=1.0):
+        """Adds a layer that upscales the output by 2x through sub-pixel convolution.
+
+        A convolution at the input resolution to 4x `num_units`, rearranged
+        into 2x2 blocks by depth_to_space (see ArXiv 1609.05158). Output
+        channel c of block position k comes from convolution output
+        k*num_units + c."""
+
+        assert len(self.get_output().get_shape()) == 4 and "Previous layer must be 4-dimensional (batch, width, height, channels)"
+
+        with tf.variable_scope(self._get_layer_str()):
+            prev_units = self._get_num_inputs()
+
+            # Weight term and convolution
+            initw  = self._glorot_initializer_conv2d(prev_units, num_units,
+                                                     mapsize,
+                                                     stddev_factor=stddev_factor)
+            initw  = tf.tile(initw, [1, 1, 1, 4])
+            weight = tf.get_variable('weight', initializer=initw)
+            out    = tf.nn.conv2d(self.get_output(), weight,
+                                  strides=[1, 1, 1, 1],
+                                  padding='SAME')
+
+            # Bias term
+            initb  = tf.constant(0.0, shape=[4*num_units])
+            bias   = tf.get_variable('bias', initializer=initb)
+            out    = tf.nn.bias_add(out, bias)
+
+            out    = tf.depth_to_space(out, 2)
+
+        self._record('subpixel_upscale', units=num_units, mapsize=mapsize)
+        self.outputs.append(out)
+        return self
+
     def get_output(self):
         """Returns the output from the topmost layer of the network"""
         return self.outputs[-1]
@@ -321,22 +524,37 @@ class Model:
         scope = self._get_layer_str(layer)
         return tf.get_collection(tf.GraphKeys.VARIABLES, scope=scope)
 
-def _generator_model(sess, features, labels, channels):
+def build_generator(features, channels=3, norm=None, spec='full', upsample='nearest'):
+    """Adds the generator layers on top of `features` and returns its `Model`.
+
+    Must be called inside the 'gene' variable scope for the layers to pick up
+    the checkpoint variables, which must have been trained with the same
+    layout `spec`, see `generator_spec`, and `upsample`, see UPSAMPLES. See
+    `Model` for `norm`."""
+
     # Upside-down all-convolutional resnet
 
-    mapsize = 3
-    res_units  = [256, 128, 96]
+    spec = generator_spec(spec)
 
-    old_vars = tf.global_variables()
+    mapsize = 3
+    res_units  = spec.res_units
 
     # See Arxiv 1603.05027
-    model = Model('GEN', features)
+    model = Model('GEN', features, norm=norm)
 
     for ru in range(len(res_units)-1):
         nunits  = res_units[ru]
 
-        for j in range(2):
-            model.add_residual_block(nunits, mapsize=mapsize)
+        for j in range(spec.blocks[ru]):
+            model.add_residual_block(nunits, mapsize=mapsize, separable=spec.separable)
+
+        if upsample == 'subpixel':
+            # Same batch norm statistics as after a nearest neighbor upscale,
+            # but the convolution runs before the upscale
+            model.add_batch_norm()
+            model.add_relu()
+            model.add_subpixel_upscale(nunits, mapsize=mapsize, stddev_factor=1.)
+            continue
 
         # Spatial upscale (see http://distill.pub/2016/deconv-checkerboard/)
         # and transposed convolution
@@ -344,11 +562,17 @@ def _generator_model(sess, features, labels, channels):
         
         model.add_batch_norm()
         model.add_relu()
-        model.add_conv2d_transpose(nunits, mapsize=mapsize, stride=1, stddev_factor=1.)
+        if spec.separable:
+            model.add_separable_conv2d(nunits, mapsize=mapsize, stride=1, stddev_factor=1.)
+        else:
+            model.add_conv2d_transpose(nunits, mapsize=mapsize, stride=1, stddev_factor=1.)
 
     # Finalization a la "all convolutional net"
     nunits = res_units[-1]
-    model.add_conv2d(nunits, mapsize=mapsize, stride=1, stddev_factor=2.)
+    if spec.separable:
+        model.add_separable_conv2d(nunits, mapsize=mapsize, stride=1, stddev_factor=2.)
+    else:
+        model.add_conv2d(nunits, mapsize=mapsize, stride=1, stddev_factor=2.)
     # Worse: model.add_batch_norm()
     model.add_relu()
 
@@ -359,6 +583,56 @@ def _generator_model(sess, features, labels, channels):
     # Last layer is sigmoid with no batch normalization
     model.add_conv2d(channels, mapsize=1, stride=1, stddev_factor=1.)
     model.add_sigmoid()
+
+    return model
+
+def checkpoint_upsample(checkpoint, spec='full', channels=3):
+    """Upsampling the generator of layout `spec` in `checkpoint` was trained
+    with, one of UPSAMPLES.
+
+    Each one has variables of its own, so the one whose variables are all in
+    the checkpoint with the same shapes is it. Raises ValueError when there is
+    none, e.g. for a checkpoint of another layout."""
+
+    shapes = tf.train.NewCheckpointReader(checkpoint).get_variable_to_shape_map()
+
+    for upsample in UPSAMPLES:
+        with tf.Graph().as_default():
+            features = tf.placeholder(tf.float32, shape=[None, None, None, channels])
+            with tf.variable_scope('gene'):
+                build_generator(features, channels, norm='batch', spec=spec, upsample=upsample)
+
+            expected = {var.op.name: var.get_shape().as_list() for var in tf.global_variables()}
+
+        if all(shapes.get(name) == shape for name, shape in expected.items()):
+            return upsample
+
+    raise ValueError("Checkpoint `%s' holds no generator of layout `%s' with any of the upsamplings %s"
+                     % (checkpoint, spec, ', '.join(UPSAMPLES)))
+
+def check_moving_averages(checkpoint, var_list):
+    """Raises ValueError unless `checkpoint` has trained moving averages for
+    every batch norm of `var_list`, as built with norm='moving'.
+
+    Checkpoints trained before the batch norms updated them, like the one
+    this site first shipped with, either lack them or hold their initial
+    values, and are only served right with norm='batch'."""
+
+    reader  = tf.train.NewCheckpointReader(checkpoint)
+    moving  = [var.op.name for var in var_list if var.op.name.endswith(('/moving_mean', '/moving_variance'))]
+    missing = [name for name in moving if not reader.has_tensor(name)]
+    if missing:
+        raise ValueError("Checkpoint `%s' has no moving averages for `%s'" % (checkpoint, missing[0]))
+
+    initial = [np.all(reader.get_tensor(name) == (0. if name.endswith('/moving_mean') else 1.))
+               for name in moving]
+    if initial and all(initial):
+        raise ValueError("Moving averages of checkpoint `%s' were never updated" % (checkpoint,))
+
+def _generator_model(sess, features, labels, channels, norm=None, spec='full', upsample='nearest'):
+    old_vars = tf.global_variables()
+
+    model = build_generator(features, channels, norm=norm, spec=spec, upsample=upsample)
     
     new_vars  = tf.global_variables()
     gene_vars = list(set(new_vars) - set(old_vars))
@@ -367,11 +641,9 @@ def _generator_model(sess, features, labels, channels):
 
 def create_model(sess, features):
     # Generator
-    rows      = int(features.get_shape()[1])
-    cols      = int(features.get_shape()[2])
     channels  = int(features.get_shape()[3])
 
-    gene_minput = tf.placeholder(tf.float32, shape=[FLAGS.batch_size, rows, cols, channels])
+    gene_minput = tf.placeholder(tf.float32, shape=[None, None, None, channels])
 
     # TBD: Is there a better way to instance the generator?
     with tf.variable_scope('gene') as scope:
@@ -383,6 +655,25 @@ def create_model(sess, features):
         
     return [gene_minput,      gene_moutput]
 
+def create_generator(sess, rows=None, cols=None, channels=3, reuse=False, norm=None, spec='full',
+                     upsample='nearest'):
+    """Builds a standalone generator for any batch size, and for inputs of the
+    given size, or of any size when `rows` and `cols` are None.
+
+    The first instance must be built with `reuse=False` so that it creates the
+    generator variables, every later instance shares them. `spec` is the
+    layout of the checkpoint, see `generator_spec`, `upsample` its
+    upsampling, see `checkpoint_upsample`, and `norm` one of
+    INFERENCE_NORMS."""
+
+    gene_minput = tf.placeholder(tf.float32, shape=[None, rows, cols, channels])
+
+    with tf.variable_scope('gene', reuse=reuse):
+        gene_moutput, _ = _generator_model(sess, gene_minput, None, channels,
+                                           norm=norm, spec=spec, upsample=upsample)
+
+    return [gene_minput, gene_moutput]
+
 def _downscale(images, K):
     """Differentiable image downscaling by a factor of K"""
     arr = np.zeros([K, K, 3, 3])
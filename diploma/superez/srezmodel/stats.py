@@ -0,0 +1,46 @@
+import collections
+import threading
+
+
+class RunningStats(object):
+    """Thread-safe running summary of a measurement, e.g. a latency in seconds.
+
+    Keeps exact totals plus a bounded window of recent samples for percentiles."""
+
+    def __init__(self, window=1000):
+        self._lock    = threading.Lock()
+        self._recent  = collections.deque(maxlen=window)
+        self.count    = 0
+        self.total    = 0.0
+        self.last     = 0.0
+        self.max      = 0.0
+
+    def add(self, seconds):
+        with self._lock:
+            self._recent.append(seconds)
+            self.count += 1
+            self.total += seconds
+            self.last   = seconds
+            self.max    = max(self.max, seconds)
+
+    def percentile(self, q):
+        with self._lock:
+            recent = sorted(self._recent)
+
+        if not recent:
+            return 0.0
+
+        return recent[min(len(recent)-1, int(q * len(recent)))]
+
+    def summary(self):
+        """Returns the current numbers as a plain dict"""
+
+        with self._lock:
+            count, total, last, maximum = self.count, self.total, self.last, self.max
+
+        return {'count': count,
+                'mean':  total / count if count else 0.0,
+                'last':  last,
+                'max':   maximum,
+                'p50':   self.percentile(.50),
+                'p95':   self.percentile(.95)}
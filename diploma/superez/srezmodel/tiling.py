@@ -0,0 +1,274 @@
+from superez.srezmodel.images import upscale_bicubic
+
+import time
+import numpy as np
+
+
+# Stage widths of the full generator
+FULL_RES_UNITS = (256, 128, 96)
+
+def stage_widths(layers):
+    """Stage widths of a generator from its layers in order, as (op, output
+    channels) pairs: the widest output between two 'upscale' ops"""
+
+    widths = [0]
+    for op, channels in layers:
+        if op == 'upscale':
+            widths.append(0)
+        elif channels:
+            widths[-1] = max(widths[-1], channels)
+
+    return tuple(widths)
+
+def generator_bytes_per_pixel(res_units=FULL_RES_UNITS):
+    """Rough peak activation memory of a generator with stages of widths
+    `res_units` per input pixel, in bytes.
+
+    Each stage keeps about three float32 maps of its width alive (bypass,
+    intermediate and output), and every upscale quadruples the area of the
+    maps that follow it."""
+
+    peak = 0
+    area = 1
+    for ru in range(len(res_units)):
+        peak = max(peak, 3 * res_units[ru] * area)
+        if ru < len(res_units)-1:
+            # Upscaled map still has the width of the stage before it
+            area *= 4
+            peak  = max(peak, 3 * res_units[ru] * area)
+
+    return 4 * peak
+
+def needs_tiling(shape, memory_budget, res_units=FULL_RES_UNITS):
+    """True if a whole HxW image would not fit in `memory_budget` bytes in a
+    generator with stages of widths `res_units`"""
+    return shape[0] * shape[1] * generator_bytes_per_pixel(res_units) > memory_budget
+
+def choose_tile_size(memory_budget, batch_size=1, overlap=8, multiple=8, res_units=FULL_RES_UNITS):
+    """Largest square tile side such that `batch_size` tiles fit in `memory_budget` bytes"""
+
+    side = int(np.sqrt(memory_budget / float(batch_size * generator_bytes_per_pixel(res_units))))
+    side = side - side % multiple
+
+    # Tiles must have some interior left once both overlaps are removed
+    return max(side, 2*overlap + multiple)
+
+def _tile_starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+
+    step = tile - overlap
+    return list(range(0, length - tile, step)) + [length - tile]
+
+def _feather(length, ramp, start, end):
+    """Blending weights along one axis of a tile.
+
+    Weights rise linearly over `ramp` pixels on each side that overlaps a
+    neighbouring tile (`start`/`end`) and are 1 elsewhere."""
+
+    weight = np.ones([length], dtype=np.float32)
+    ramp   = min(ramp, length // 2)
+    if ramp > 0:
+        rise = (np.arange(ramp, dtype=np.float32) + .5) / ramp
+        if start:
+            weight[:ramp]  = rise
+        if end:
+            weight[-ramp:] = rise[::-1]
+
+    return weight
+
+def _check_tile_size(tile_size, overlap):
+    # Neighbouring tiles must start at least one pixel apart
+    if tile_size <= 2*overlap:
+        raise ValueError("Tiles of %dpx must be larger than twice their overlap of %dpx" % (tile_size, overlap))
+
+def _tile_positions(rows, cols, tile_rows, tile_cols, overlap):
+    return [(y, x) for y in _tile_starts(rows, tile_rows, overlap)
+                   for x in _tile_starts(cols, tile_cols, overlap)]
+
+def _blend_tile(output, weights, y, x, tile_output, overlap, K):
+    """Adds a tile output at input position y, x with feathered weights"""
+
+    rows, cols = output.shape[0] // K, output.shape[1] // K
+    tile_rows  = tile_output.shape[0] // K
+    tile_cols  = tile_output.shape[1] // K
+
+    wy = _feather(tile_rows*K, overlap*K, y > 0, y + tile_rows < rows)
+    wx = _feather(tile_cols*K, overlap*K, x > 0, x + tile_cols < cols)
+    weight = wy[:, np.newaxis, np.newaxis] * wx[np.newaxis, :, np.newaxis]
+
+    output [y*K:(y+tile_rows)*K, x*K:(x+tile_cols)*K] += weight * tile_output
+    weights[y*K:(y+tile_rows)*K, x*K:(x+tile_cols)*K] += weight
+
+def _upscale_tiles(upscale_batch, image, positions, tile_rows, tile_cols, overlap, batch_size):
+    """Sends the tiles at `positions` to `upscale_batch`, `batch_size` at a
+    time, and blends their outputs. Returns the weighted sum of the outputs
+    and the sum of their weights, both zero where no tile was upscaled"""
+
+    rows, cols = image.shape[0], image.shape[1]
+
+    output = weights = None
+    for i in range(0, len(positions), batch_size):
+        chunk   = positions[i:i+batch_size]
+        tiles   = [image[y:y+tile_rows, x:x+tile_cols] for y, x in chunk]
+        outputs = upscale_batch(tiles)
+
+        if output is None:
+            K       = outputs[0].shape[0] // tile_rows
+            output  = np.zeros([rows*K, cols*K, outputs[0].shape[2]], dtype=np.float32)
+            weights = np.zeros([rows*K, cols*K, 1], dtype=np.float32)
+
+        for (y, x), tile_output in zip(chunk, outputs):
+            _blend_tile(output, weights, y, x, tile_output, overlap, K)
+
+    return output, weights
+
+def upscale_tiled(upscale_batch, image, tile_size, overlap=8, batch_size=4):
+    """Upscales an HxWx3 image of any size through overlapping tiles.
+
+    All tiles have the same size, so they are sent to `upscale_batch` as
+    lists of `batch_size` tiles. Outputs are stitched back with linear
+    feathering over the overlaps to hide the seams. Returns the float32 result
+    and the number of tiles used.
+
+    Per-sample batch norm normalizes each tile by its own statistics, so
+    tiles should be as large as memory allows, see `choose_tile_size`."""
+
+    _check_tile_size(tile_size, overlap)
+
+    rows, cols   = image.shape[0], image.shape[1]
+    tile_rows    = min(tile_size, rows)
+    tile_cols    = min(tile_size, cols)
+
+    positions       = _tile_positions(rows, cols, tile_rows, tile_cols, overlap)
+    output, weights = _upscale_tiles(upscale_batch, image, positions, tile_rows, tile_cols, overlap, batch_size)
+
+    return output / weights, len(positions)
+
+def tile_detail(tile):
+    """Gradient energy of an HxWxC tile with values in [0, 1]: the root mean
+    square of the differences between neighbouring pixels. 0 for a flat tile,
+    a few hundredths for smooth gradients like sky or walls"""
+
+    tile = np.asarray(tile, dtype=np.float32)
+    dy   = np.diff(tile, axis=0)
+    dx   = np.diff(tile, axis=1)
+
+    count = dy.size + dx.size
+    if count == 0:
+        return 0.
+
+    return float(np.sqrt((np.square(dy).sum() + np.square(dx).sum()) / count))
+
+def _overlaps(a, a_size, b, b_size):
+    return a < b + b_size and b < a + a_size
+
+def upscale_adaptive(upscale_batch, image, block_size, threshold, tile_size=None, overlap=8, batch_size=4,
+                     factor=4):
+    """Upscales an HxWx3 image, skipping the generator where there is nothing
+    for it to restore.
+
+    Flat and detailed areas are told apart in overlapping blocks of
+    `block_size`. Blocks whose `tile_detail` is below `threshold` are taken
+    from a bicubic upscale of the whole image, the others from the generator.
+    The generator itself runs on tiles of `tile_size` as in `upscale_tiled`,
+    the whole image at once by default, and only on the tiles under a
+    detailed block. Large tiles keep the per-sample batch norm statistics
+    close to those of the whole image, so that with a `threshold` of 0 the
+    result is the same as upscaling the image in one piece. Blocks are blended
+    back with the same feathering as tiles. `factor` is the upscale of the
+    generator. Returns the float32 result, the number of blocks and how many
+    of them were flat."""
+
+    _check_tile_size(block_size, overlap)
+    if tile_size is not None:
+        _check_tile_size(tile_size, overlap)
+
+    rows, cols  = image.shape[0], image.shape[1]
+    block_rows  = min(block_size, rows)
+    block_cols  = min(block_size, cols)
+    tile_rows   = min(tile_size or rows, rows)
+    tile_cols   = min(tile_size or cols, cols)
+    K           = factor
+
+    blocks   = _tile_positions(rows, cols, block_rows, block_cols, overlap)
+    detailed = [(y, x) for y, x in blocks
+                if tile_detail(image[y:y+block_rows, x:x+block_cols]) >= threshold]
+
+    # Every tile that covers part of a detailed block, so that those pixels come out as in `upscale_tiled`
+    tiles = [(ty, tx) for ty, tx in _tile_positions(rows, cols, tile_rows, tile_cols, overlap)
+             if any(_overlaps(ty, tile_rows, y, block_rows) and _overlaps(tx, tile_cols, x, block_cols)
+                    for y, x in detailed)]
+
+    gene = None
+    if tiles:
+        gene, gene_weights = _upscale_tiles(upscale_batch, image, tiles, tile_rows, tile_cols, overlap, batch_size)
+        np.divide(gene, gene_weights, out=gene, where=gene_weights > 0)
+
+    flat    = upscale_bicubic(image, factor)
+    output  = np.zeros([rows*K, cols*K, flat.shape[2]], dtype=np.float32)
+    weights = np.zeros([rows*K, cols*K, 1], dtype=np.float32)
+
+    detailed = set(detailed)
+    for y, x in blocks:
+        source = gene if (y, x) in detailed else flat
+        _blend_tile(output, weights, y, x, source[y*K:(y+block_rows)*K, x*K:(x+block_cols)*K], overlap, K)
+
+    return output / weights, len(blocks), len(blocks) - len(detailed)
+
+# Identical images would be infinitely good and swamp the mean
+MAX_PSNR = 100.
+
+def _psnr(a, b):
+    mse = np.mean(np.square(np.clip(a, 0., 1.) - np.clip(b, 0., 1.)))
+    return min(10. * np.log10(1. / mse), MAX_PSNR) if mse > 0 else MAX_PSNR
+
+def _downscale(image, factor):
+    # Area downscale, like the training inputs. Sides are cropped to a multiple of `factor`
+    rows = image.shape[0] // factor * factor
+    cols = image.shape[1] // factor * factor
+
+    return image[:rows, :cols].reshape(rows // factor, factor, cols // factor, factor, -1).mean(axis=(1, 3))
+
+def evaluate_adaptive(upscale_batch, images, thresholds, block_size, tile_size=None, overlap=8, batch_size=4,
+                      factor=4):
+    """Cost and savings of `upscale_adaptive` at each of the `thresholds`.
+
+    `images` are full resolution HxWx3 references, upscaled back from their
+    area downscale by `factor`. The generator alone, `upscale_adaptive` with
+    a threshold of 0, is the baseline. Returns a list with, for the baseline
+    and each threshold, the fraction of flat blocks, the total seconds and
+    the fraction saved, and the mean PSNR against the references with its
+    loss from the baseline."""
+
+    _check_tile_size(block_size, overlap)
+
+    features = [_downscale(image, factor) for image in images]
+
+    # The first run of an engine is slower and would count against the baseline
+    upscale_batch([features[0][:block_size, :block_size]])
+
+    results = []
+    for threshold in [0.] + [t for t in thresholds if t > 0]:
+        blocks = flat = 0
+        psnrs  = []
+        start_time = time.time()
+        for image, feature in zip(images, features):
+            output, num_blocks, num_flat = upscale_adaptive(upscale_batch, feature, block_size, threshold,
+                                                            tile_size=tile_size, overlap=overlap,
+                                                            batch_size=batch_size, factor=factor)
+            blocks += num_blocks
+            flat   += num_flat
+            psnrs.append(_psnr(output, image[:output.shape[0], :output.shape[1]]))
+
+        results.append({'threshold': threshold,
+                        'skip_rate': flat / float(max(blocks, 1)),
+                        'seconds':   time.time() - start_time,
+                        'psnr':      float(np.mean(psnrs))})
+
+    baseline = results[0]
+    for result in results:
+        result['time_saved'] = 1. - result['seconds'] / baseline['seconds'] if baseline['seconds'] > 0 else 0.
+        result['psnr_cost']  = baseline['psnr'] - result['psnr']
+
+    return results
@@ -1,3 +1,733 @@
-from django.test import TestCase
+import datetime
+import importlib.util
+import io
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from PIL import Image
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from superez import jobs
+from superez.cache import ResultCache
+from superez.models import Document, images_storage
+from superez.srezmodel import tiling
+from superez.srezmodel.batching import MicroBatcher
+from superez.srezmodel.images import decode_image, decode_scaled, read_image, save_restored
+
+# Only the TensorFlow engine needs it, everything else is tested without
+HAS_TENSORFLOW = importlib.util.find_spec('tensorflow') is not None
+
+
+def _initialize(saver, sess, save_path):
+    # Random weights are enough to count ops, and keep the test independent of a trained checkpoint
+    import tensorflow as tf
+    sess.run(tf.global_variables_initializer())
+
+
+@skipUnless(HAS_TENSORFLOW, "TensorFlow is not installed")
+class InferenceGraphTest(SimpleTestCase):
+    """Serving many requests must not grow the engine graph"""
+
+    requests = 50
+
+    def setUp(self):
+        import tensorflow as tf
+        from superez.srezmodel import inference
+
+        with mock.patch.object(tf.train.Saver, 'restore', _initialize):
+            self.engine = inference.InferenceEngine()
+
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'upload.png')
+
+        pixels = np.random.RandomState(0).randint(0, 256, size=[24, 20, 3]).astype(np.uint8)
+        Image.fromarray(pixels).save(self.path)
+
+        for name, value in (('_engines', {'full': self.engine}), ('_batchers', {})):
+            patcher = mock.patch.object(inference, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_graph_size_is_constant(self):
+        from superez.srezmodel import inference
+
+        num_ops = len(self.engine.graph.get_operations())
+
+        for _ in range(self.requests):
+            inference.inference(self.path)
+
+        self.assertEqual(len(self.engine.graph.get_operations()), num_ops)
+
+        restored = Image.open(os.path.join(self.directory, 'restored_upload.png'))
+        self.assertEqual(restored.size, (20, 24))
+
+    def test_any_size_shares_the_graph(self):
+        # One generator serves every batch and image size, without building anything
+        self.assertTrue(self.engine.graph.finalized)
+
+        for rows, cols, batch in ((24, 20, 1), (40, 72, 3), (100, 33, 2)):
+            images  = [np.zeros([rows, cols, 3], dtype=np.float32)] * batch
+            outputs = self.engine.upscale_batch(images)
+
+            self.assertEqual(len(outputs), batch)
+            self.assertEqual(outputs[0].shape, (4 * rows, 4 * cols, 3))
+
+    def test_adaptive_matches_whole_image(self):
+        # With nothing flat, blocks must not change the per-sample statistics of the generator
+        image = np.random.RandomState(2).rand(70, 90, 3).astype(np.float32)
+
+        adaptive, _, num_flat = tiling.upscale_adaptive(self.engine.upscale_batch, image, 32, 0.)
+
+        self.assertEqual(num_flat, 0)
+        np.testing.assert_allclose(adaptive, self.engine.upscale(image), atol=1e-5)
+
+    def test_batching_keeps_outputs(self):
+        # Per-sample batch norm: an image must come out the same alone or in a batch
+        images = list(np.random.RandomState(1).rand(3, 27, 21, 3).astype(np.float32))
+
+        batched = self.engine.upscale_batch(images)
+        for image, output in zip(images, batched):
+            np.testing.assert_allclose(output, self.engine.upscale(image), atol=1e-5)
+
+        self.assertNotEqual(self.engine.batch_key(images[0]), self.engine.batch_key(images[0][:26]))
+
+
+@skipUnless(HAS_TENSORFLOW, "TensorFlow is not installed")
+class ExportTest(SimpleTestCase):
+    """An exact export must match the checkpoint on images of any size"""
+
+    def setUp(self):
+        import tensorflow as tf
+        import superez.srezmodel.srez_model2 as srez_model
+
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        # Random weights, saved like training checkpoints of either upsampling
+        for upsample in srez_model.UPSAMPLES:
+            os.makedirs(os.path.join(self.directory, upsample))
+            with tf.Graph().as_default(), tf.Session() as sess:
+                srez_model.create_generator(sess, norm='batch', upsample=upsample)
+                sess.run(tf.global_variables_initializer())
+                tf.train.Saver().save(sess, os.path.join(self.directory, upsample, 'model'))
+
+        # And one with trained moving averages
+        random = np.random.RandomState(0)
+        os.makedirs(os.path.join(self.directory, 'moving'))
+        with tf.Graph().as_default(), tf.Session() as sess:
+            srez_model.create_generator(sess, norm='moving')
+            sess.run(tf.global_variables_initializer())
+            for var in tf.global_variables():
+                shape = var.get_shape().as_list()
+                if var.op.name.endswith('/moving_mean'):
+                    sess.run(var.assign(random.normal(scale=.1, size=shape)))
+                elif var.op.name.endswith('/moving_variance'):
+                    sess.run(var.assign(random.uniform(.5, 2., size=shape)))
+            tf.train.Saver().save(sess, os.path.join(self.directory, 'moving', 'model'))
+
+        # Not a multiple of any shape bucket
+        self.image = os.path.join(self.directory, 'upload.png')
+        pixels = np.random.RandomState(0).randint(0, 256, size=[45, 37, 3]).astype(np.uint8)
+        Image.fromarray(pixels).save(self.image)
+
+    def test_numpy_export_matches_checkpoint(self):
+        from superez.srezmodel import export
+
+        checkpoint_dir = os.path.join(self.directory, 'nearest')
+        output         = os.path.join(self.directory, 'generator.npz')
+        export.export(output, checkpoint_dir=checkpoint_dir, format='numpy')
+
+        results = export.benchmark([self.image], output, checkpoint_dir=checkpoint_dir, format='numpy')
+        self.assertLess(results['max_diff'], 1e-3)
+
+    def test_subpixel_export_matches_checkpoint(self):
+        from superez.srezmodel import export
+
+        checkpoint_dir = os.path.join(self.directory, 'subpixel')
+        for format, name in (('numpy', 'generator.npz'), ('graph', 'generator.pb')):
+            output = os.path.join(self.directory, name)
+            export.export(output, checkpoint_dir=checkpoint_dir, format=format)
+
+            results = export.benchmark([self.image], output, checkpoint_dir=checkpoint_dir, format=format)
+            self.assertLess(results['max_diff'], 1e-3, format)
+
+    def test_moving_export_matches_checkpoint(self):
+        from superez.srezmodel import export
+
+        checkpoint_dir = os.path.join(self.directory, 'moving')
+        for format, name in (('numpy', 'generator.npz'), ('graph', 'generator.pb')):
+            output  = os.path.join(self.directory, name)
+            summary = export.export(output, checkpoint_dir=checkpoint_dir, format=format, statistics='moving')
+            self.assertEqual(summary['batch_norms'], 0)
+
+            results = export.benchmark([self.image], output, checkpoint_dir=checkpoint_dir, format=format,
+                                       statistics='moving')
+            self.assertLess(results['max_diff'], 1e-3, format)
+
+    def test_moving_averages_are_required(self):
+        from superez.srezmodel.inference import InferenceEngine
+
+        with self.assertRaises(ValueError):
+            InferenceEngine(os.path.join(self.directory, 'nearest'), norm='moving')
+
+
+class ScaledDecodeTest(SimpleTestCase):
+    """Large JPEGs decoded at a reduced scale must match an area downscale of the full image"""
+
+    def setUp(self):
+        pixels = np.random.RandomState(0).randint(0, 256, size=[30, 40, 3]).astype(np.uint8)
+        image  = Image.fromarray(pixels).resize((640, 480), Image.BICUBIC)
+
+        f = io.BytesIO()
+        image.save(f, 'JPEG', quality=90)
+        self.data = f.getvalue()
+
+    def test_matches_area_downscale(self):
+        full = decode_image(io.BytesIO(self.data))
+
+        for max_pixels, ratio in ((640 * 480, 1), (320 * 240, 2), (1, 4)):
+            scaled, size = decode_scaled(io.BytesIO(self.data), max_pixels)
+            self.assertEqual(size, (480, 640))
+            self.assertEqual(scaled.shape, (480 // ratio, 640 // ratio, 3))
+
+            reference = full.reshape(480 // ratio, ratio, 640 // ratio, ratio, 3).mean(axis=(1, 3))
+            psnr = 10 * np.log10(1. / max(np.square(scaled - reference).mean(), 1e-10))
+            self.assertGreater(psnr, 35.)
+
+    def test_disabled(self):
+        scaled, size = decode_scaled(io.BytesIO(self.data), 0)
+        self.assertEqual(scaled.shape, (480, 640, 3))
+
+
+class TierTest(SimpleTestCase):
+    """A deeper queue must lower the quality tier before it breaks the latency SLO"""
+
+    seconds = {'full': 5., 'small': 1., 'bicubic': .1}
+
+    def pick(self, waited, depth):
+        return jobs.pick_tier(waited, depth, self.seconds, capacity=2, slo=60.)
+
+    def test_empty_queue_gets_full(self):
+        self.assertEqual(self.pick(0., 0), Document.FULL)
+
+    def test_deep_queue_degrades(self):
+        self.assertEqual(self.pick(0., 40), Document.SMALL)
+        self.assertEqual(self.pick(0., 400), Document.BICUBIC)
+
+    def test_late_job_gets_bicubic(self):
+        self.assertEqual(self.pick(59.95, 0), Document.BICUBIC)
+        self.assertEqual(self.pick(90., 0), Document.BICUBIC)
+
+
+def _upscale_nearest(tiles):
+    # Stands in for the generator, every tile is upscaled the same way wherever it is
+    return [np.repeat(np.repeat(tile, 4, axis=0), 4, axis=1) for tile in tiles]
+
+
+def _upscale_normalized(tiles):
+    # Normalizes every tile by its own mean, as per-sample batch norm does
+    return [tile - tile.mean(axis=(0, 1)) for tile in _upscale_nearest(tiles)]
+
+
+class AdaptiveTilingTest(SimpleTestCase):
+    """Only tiles under detailed blocks may go through the generator"""
+
+    def setUp(self):
+        self.image = np.full([70, 90, 3], .5, dtype=np.float32)
+        self.image[:20, :20] = np.random.RandomState(0).rand(20, 20, 3)
+
+    def test_flat_blocks_skip_the_generator(self):
+        calls = []
+        def upscale_batch(tiles):
+            calls.extend(tiles)
+            return _upscale_nearest(tiles)
+
+        output, num_blocks, num_flat = tiling.upscale_adaptive(upscale_batch, self.image, 32, .02, tile_size=40)
+
+        self.assertEqual(output.shape, (280, 360, 3))
+        self.assertEqual((num_blocks, num_flat), (12, 11))
+
+        # Only the two generator tiles under the detailed corner block, at their full size
+        self.assertEqual(len(calls), 2)
+        for tile in calls:
+            self.assertEqual(tile.shape, (40, 40, 3))
+
+        # Detail comes from the generator, flat areas end up bicubic, which is exact on a constant image
+        np.testing.assert_allclose(output[:64, :64], _upscale_nearest([self.image[:16, :16]])[0], atol=1e-6)
+        np.testing.assert_allclose(output[-40:, -40:], .5, atol=1e-2)
+
+    def test_no_threshold_matches_tiled(self):
+        adaptive, num_blocks, num_flat = tiling.upscale_adaptive(_upscale_nearest, self.image, 32, 0., tile_size=48)
+        tiled, _ = tiling.upscale_tiled(_upscale_nearest, self.image, 48)
+
+        self.assertEqual(num_flat, 0)
+        np.testing.assert_allclose(adaptive, tiled, atol=1e-6)
+
+    def test_no_threshold_matches_whole_image(self):
+        # Blocks only pick where the generator output goes, its statistics are still those of the whole image
+        adaptive, _, _ = tiling.upscale_adaptive(_upscale_normalized, self.image, 32, 0.)
+
+        np.testing.assert_allclose(adaptive, _upscale_normalized([self.image])[0], atol=1e-6)
+
+    def test_memory_estimate_follows_the_layout(self):
+        # Full generator: three stages with two upscales between them
+        layers = [('conv2d', 256), ('relu', None), ('upscale', None), ('conv2d', 128), ('upscale', None),
+                  ('conv2d', 96), ('conv2d', 3), ('sigmoid', None)]
+        self.assertEqual(tiling.stage_widths(layers), tiling.FULL_RES_UNITS)
+
+        small = (64, 32, 32)
+        self.assertLess(tiling.generator_bytes_per_pixel(small), tiling.generator_bytes_per_pixel())
+        self.assertGreater(tiling.choose_tile_size(2**30, res_units=small), tiling.choose_tile_size(2**30))
+
+    def test_tiles_must_outgrow_their_overlap(self):
+        for tile in (8, 16):
+            with self.assertRaises(ValueError):
+                tiling.upscale_adaptive(_upscale_nearest, self.image, tile, .02, overlap=8)
+            with self.assertRaises(ValueError):
+                tiling.upscale_tiled(_upscale_nearest, self.image, tile, overlap=8)
+
+
+class RestoredFilesTest(SimpleTestCase):
+    """Results of one tier must never change the files of another, nor cache entries"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.cache = ResultCache(os.path.join(self.directory, 'cache'), 2**30)
+        self.path  = os.path.join(self.directory, 'upload.png')
+
+    def _read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def _save(self, value, tier):
+        return os.path.join(self.directory, save_restored(self.path, np.full([8, 8, 3], value, np.uint8), tier))
+
+    def test_tiers_keep_their_results(self):
+        bicubic = self._save(10, 'bicubic')
+        self.cache.put('hash-bicubic', bicubic)
+        cached = self._read(self.cache._path('hash-bicubic'))
+
+        full = self._save(200, 'full')
+        self._save(20, 'bicubic')
+
+        self.assertNotEqual(bicubic, full)
+        self.assertEqual(self._read(self.cache._path('hash-bicubic')), cached)
+
+    def test_restore_replaces_a_stale_result(self):
+        full = self._save(200, 'full')
+        self.cache.put('hash', full)
+        self._save(30, 'full')
+
+        self.assertTrue(self.cache.restore('hash', full))
+        self.assertEqual(self._read(full), self._read(self.cache._path('hash')))
+        self.assertFalse(self.cache.restore('other', full))
+
+
+class AutoTierTest(TestCase):
+    """Under load, automatic jobs must fall back to tiers the worker has weights for"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        pixels = np.random.RandomState(0).randint(0, 256, size=[24, 20, 3]).astype(np.uint8)
+        Image.fromarray(pixels).save(os.path.join(self.directory, 'upload.png'))
+
+        # Full generator weights exist, the small ones don't
+        weights = os.path.join(self.directory, 'generator.npz')
+        open(weights, 'wb').close()
+
+        overridden = override_settings(SUPEREZ_ENGINE='numpy', SUPEREZ_NUMPY_WEIGHTS=weights,
+                                       SUPEREZ_NUMPY_SMALL_WEIGHTS=os.path.join(self.directory, 'missing.npz'))
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+        for patcher in (mock.patch.object(images_storage, 'location', self.directory),
+                        mock.patch.object(jobs, 'result_cache',
+                                          ResultCache(os.path.join(self.directory, 'cache'), 2**30)),
+                        mock.patch.object(jobs, '_available_tiers', None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_only_tiers_with_weights(self):
+        self.assertEqual(jobs.available_tiers(), (Document.FULL, Document.BICUBIC))
+
+        document = Document(requested_tier=Document.SMALL)
+        self.assertEqual(jobs.choose_tier(document), Document.BICUBIC)
+
+    def test_deep_queue_runs_bicubic(self):
+        Document.objects.bulk_create([Document(docfile='pending%d.png' % (i,)) for i in range(100)])
+
+        document = Document.objects.create(docfile='upload.png', status=Document.RUNNING,
+                                           started=jobs.timezone.now())
+        jobs.run(document)
+
+        document.refresh_from_db()
+        self.assertEqual(document.status, Document.DONE, document.error)
+        self.assertEqual(document.tier, Document.BICUBIC)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, document.restored)))
+
+    def test_capacity_of_the_started_workers(self):
+        # Settings say one job at a time, the workers were started with 3 processes of 4 threads
+        patcher = mock.patch.object(jobs, '_capacity', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        with override_settings(SUPEREZ_WORKERS=1, SUPEREZ_WORKER_THREADS=1), \
+             mock.patch.object(jobs, '_work_loop'):
+            self.assertEqual(jobs.worker_capacity(), 1)
+            jobs.work(threads=4, processes=3)
+
+            with mock.patch.object(jobs, 'pick_tier', return_value=Document.FULL) as pick_tier:
+                jobs.choose_tier(Document.objects.create(docfile='upload.png'))
+
+        self.assertEqual(jobs.worker_capacity(), 12)
+        self.assertEqual(pick_tier.call_args[0][3], 12)
+
+
+class _Stop(BaseException):
+    pass
+
+
+class WorkerTest(TestCase):
+    """A worker must outlive database errors, and jobs left running by a dead one must run again"""
+
+    def test_stale_jobs_are_requeued(self):
+        now   = jobs.timezone.now()
+        stale = Document.objects.create(docfile='stale.png', status=Document.RUNNING,
+                                        started=now - datetime.timedelta(hours=2))
+        fresh = Document.objects.create(docfile='fresh.png', status=Document.RUNNING, started=now)
+
+        self.assertEqual(jobs.requeue_stale(timeout=3600), 1)
+
+        stale.refresh_from_db()
+        fresh.refresh_from_db()
+        self.assertEqual((stale.status, stale.started), (Document.PENDING, None))
+        self.assertEqual(fresh.status, Document.RUNNING)
+
+    def test_loop_survives_database_errors(self):
+        claim = mock.patch.object(jobs, 'claim_next', side_effect=[OperationalError('database is locked'), None])
+        sleep = mock.patch.object(jobs.time, 'sleep', side_effect=[None, _Stop()])
+
+        with claim as claim_next, sleep:
+            with self.assertRaises(_Stop):
+                jobs._work_loop()
+
+        self.assertEqual(claim_next.call_count, 2)
+
+    def test_dead_worker_is_replaced(self):
+        # The first worker died running a job two hours ago
+        job = Document.objects.create(docfile='upload.png', status=Document.RUNNING,
+                                      started=jobs.timezone.now() - datetime.timedelta(hours=2))
+
+        workers = [mock.Mock(pid=1, exitcode=-9, **{'is_alive.return_value': False}),
+                   mock.Mock(pid=2, **{'is_alive.return_value': True}),
+                   mock.Mock(pid=3, **{'is_alive.return_value': True})]
+        start_worker = mock.Mock(side_effect=workers)
+
+        with mock.patch.object(jobs.time, 'sleep', side_effect=_Stop()):
+            with self.assertRaises(_Stop):
+                jobs.supervise(start_worker, 2)
+
+        self.assertEqual(start_worker.call_count, 3)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, Document.PENDING)
+
+    def test_requeued_job_is_written_once(self):
+        Document.objects.create(docfile='upload.png', requested_tier=Document.BICUBIC)
+        slow = jobs.claim_next()
+
+        # Queued again as stale while the first worker is still on it, and claimed by another one
+        Document.objects.filter(pk=slow.pk).update(status=Document.PENDING, started=None)
+        fast = jobs.claim_next()
+
+        def out_of_memory(path):
+            raise MemoryError("out of memory")
+
+        # The first worker only fails after the job was done by the other one
+        restores = mock.Mock(side_effect=[lambda path: None, out_of_memory])
+        with mock.patch.object(jobs, '_inference', restores), \
+             mock.patch.object(jobs, '_available_tiers', (Document.BICUBIC,)):
+            self.assertTrue(jobs.run(fast))
+            self.assertFalse(jobs.run(slow))
+
+        document = Document.objects.get(pk=slow.pk)
+        self.assertEqual((document.status, document.error), (Document.DONE, ''))
+
+
+class SubmitTest(TestCase):
+    """Uploads restored before are served from the result cache, and nothing else is"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.cache = ResultCache(os.path.join(self.directory, 'cache'), 2**30)
+        for patcher in (mock.patch.object(images_storage, 'location', self.directory),
+                        mock.patch.object(jobs, 'result_cache', self.cache)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        restored = os.path.join(self.directory, 'restored.png')
+        Image.fromarray(np.zeros([8, 8, 3], np.uint8)).save(restored)
+        self.cache.put('hash', restored)
+
+    def test_cache_hit_is_done(self):
+        document = jobs.submit('hash.png', 'hash')
+        document.refresh_from_db()
+
+        self.assertEqual((document.status, document.tier), (Document.DONE, Document.FULL))
+        self.assertGreaterEqual(document.finished, document.created)
+        self.assertTrue(os.path.exists(os.path.join(self.directory, document.restored)))
+
+    def test_other_tiers_miss(self):
+        document = jobs.submit('hash.png', 'hash', tier=Document.BICUBIC)
+        self.assertEqual(document.status, Document.PENDING)
+        self.assertIsNone(document.finished)
+
+
+class _RecordingEngine(object):
+    """Doubles every image, and records the batches it was given"""
+
+    def __init__(self):
+        self.batches = []
+
+    def upscale_batch(self, images):
+        self.batches.append([image.shape for image in images])
+        if any(image.size == 0 for image in images):
+            raise ValueError("Empty image")
+
+        return [2 * image for image in images]
+
+
+class MicroBatcherTest(SimpleTestCase):
+    """Concurrent requests must only share batches with same-key requests, and never wait past max_wait"""
+
+    def setUp(self):
+        self.engine = _RecordingEngine()
+
+    def test_full_batch_runs_at_once(self):
+        batcher  = MicroBatcher(self.engine, max_batch_size=3, max_wait=10.)
+        images   = [np.full([4, 4, 3], i, np.float32) for i in range(3)]
+        requests = [batcher.submit(image) for image in images]
+
+        for image, request in zip(images, requests):
+            np.testing.assert_array_equal(request.result(), 2 * image)
+            self.assertEqual(request.batch_size, 3)
+
+        self.assertEqual(self.engine.batches, [[(4, 4, 3)] * 3])
+
+    def test_keys_never_share_a_batch(self):
+        batcher  = MicroBatcher(self.engine, max_batch_size=8, max_wait=.05)
+        requests = [batcher.submit(np.zeros(shape, np.float32))
+                    for shape in ([4, 4, 3], [5, 4, 3], [4, 4, 3])]
+
+        for request in requests:
+            request.result()
+
+        self.assertEqual(sorted(self.engine.batches), [[(4, 4, 3)] * 2, [(5, 4, 3)]])
+
+    def test_lone_request_waits_at_most_max_wait(self):
+        batcher = MicroBatcher(self.engine, max_batch_size=8, max_wait=.05)
+        request = batcher.submit(np.zeros([4, 4, 3], np.float32))
+        request.result()
+
+        self.assertEqual(request.batch_size, 1)
+        self.assertGreaterEqual(request.queue_time, .04)
+        self.assertLess(request.queue_time, 1.)
+
+    def test_errors_reach_every_request(self):
+        batcher  = MicroBatcher(self.engine, max_batch_size=2, max_wait=10.)
+        requests = [batcher.submit(np.zeros([0, 4, 3], np.float32)) for _ in range(2)]
+
+        for request in requests:
+            with self.assertRaises(ValueError):
+                request.result()
+
+
+class TiledUpscaleTest(SimpleTestCase):
+    """Stitched tiles must add up to the whole image without visible seams"""
+
+    def setUp(self):
+        self.image = np.random.RandomState(0).rand(70, 90, 3).astype(np.float32)
+
+    def test_matches_whole_image(self):
+        output, num_tiles = tiling.upscale_tiled(_upscale_nearest, self.image, 32, overlap=8, batch_size=5)
+
+        self.assertEqual(num_tiles, 12)
+        np.testing.assert_allclose(output, _upscale_nearest([self.image])[0], atol=1e-6)
+
+    def test_seams_are_feathered(self):
+        # Neighbouring tiles disagree completely: 0 everywhere in one, 1 in the next
+        count = [0]
+        def upscale_batch(tiles):
+            outputs = []
+            for tile in tiles:
+                count[0] += 1
+                outputs.append(np.full([4 * tile.shape[0], 4 * tile.shape[1], 3], count[0] % 2, np.float32))
+            return outputs
+
+        output, _ = tiling.upscale_tiled(upscale_batch, self.image, 32, overlap=8)
+
+        # Spread over the whole overlap instead of a step of 1 at the seam
+        step = max(np.abs(np.diff(output, axis=0)).max(), np.abs(np.diff(output, axis=1)).max())
+        self.assertLessEqual(step, 1. / (8 * 4) + 1e-6)
+
+
+@skipUnless(HAS_TENSORFLOW, "TensorFlow is not installed")
+class TiledCheckpointTest(SimpleTestCase):
+    """Tiles are normalized by their own statistics, which must stay close to those of the whole image"""
+
+    def setUp(self):
+        import tensorflow as tf
+        from superez.srezmodel import inference
+
+        # Random weights say nothing about how much the statistics of a tile matter
+        checkpoint = inference.checkpoint_path(inference.FLAGS.checkpoint_dir)
+        if not tf.gfile.Glob(checkpoint + '.data-*'):
+            self.skipTest("No trained checkpoint in `%s'" % (inference.FLAGS.checkpoint_dir,))
+
+        self.FLAGS  = inference.FLAGS
+        self.engine = inference.InferenceEngine()
+        self.image  = read_image(os.path.join(os.path.dirname(inference.__file__), 'test', '000621.jpg'))
+
+    def test_tiles_stay_close_to_whole_image(self):
+        # Tiles of the size served with the default memory budget
+        tile_size = tiling.choose_tile_size(self.FLAGS.tile_memory_mb * 2**20, self.FLAGS.max_batch_size,
+                                            self.FLAGS.tile_overlap, res_units=self.engine.res_units)
+
+        tiled, num_tiles = tiling.upscale_tiled(self.engine.upscale_batch, self.image, tile_size,
+                                                overlap=self.FLAGS.tile_overlap)
+        whole = self.engine.upscale(self.image)
+
+        self.assertGreater(num_tiles, 1)
+        mse = np.mean(np.square(np.clip(tiled, 0., 1.) - np.clip(whole, 0., 1.)))
+        self.assertGreater(10. * np.log10(1. / max(mse, 1e-10)), 30.)
+        self.assertLess(np.abs(tiled - whole).mean(), .02)
+
+
+class ClaimTest(TransactionTestCase):
+    """Workers claiming at the same time must never get the same job"""
+
+    def test_concurrent_claims(self):
+        Document.objects.bulk_create([Document(docfile='upload%d.png' % (i,)) for i in range(20)])
+
+        claimed = []
+        def worker():
+            try:
+                while True:
+                    document = jobs.claim_next()
+                    if document is None:
+                        break
+                    claimed.append(document.pk)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(claimed), sorted(Document.objects.values_list('pk', flat=True)))
+        self.assertFalse(Document.objects.filter(status=Document.PENDING).exists())
+
+    def test_claims_oldest_first(self):
+        first  = Document.objects.create(docfile='first.png')
+        second = Document.objects.create(docfile='second.png')
+
+        self.assertEqual(jobs.claim_next().pk, first.pk)
+        self.assertEqual(jobs.claim_next().pk, second.pk)
+        self.assertIsNone(jobs.claim_next())
+
+
+class ResultCacheTest(SimpleTestCase):
+    """The cache must evict least recently used entries first, reads counting as uses"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        # Room for two entries
+        self.cache = ResultCache(os.path.join(self.directory, 'cache'), 250)
+
+    def _put(self, key, mtime=None):
+        path = os.path.join(self.directory, key + '.png')
+        with open(path, 'wb') as f:
+            f.write(key.encode('ascii') * 100)
+
+        self.cache.put(key, path)
+        if mtime is not None:
+            os.utime(self.cache._path(key), (mtime, mtime))
+
+    def test_evicts_least_recently_used(self):
+        self._put('a', 1000)
+        self._put('b', 2000)
+
+        restored = os.path.join(self.directory, 'restored.png')
+        self.assertTrue(self.cache.restore('a', restored))
+        with open(restored, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 100)
+
+        self._put('c')
+
+        self.assertTrue(os.path.exists(self.cache._path('a')))
+        self.assertFalse(os.path.exists(self.cache._path('b')))
+        self.assertTrue(os.path.exists(self.cache._path('c')))
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['entries'], stats['bytes']), (2, 200))
+
+    def test_counts_hits_and_misses(self):
+        self._put('a')
+        path = os.path.join(self.directory, 'restored.png')
+
+        self.assertTrue(self.cache.restore('a', path))
+        self.assertFalse(self.cache.restore('b', path))
+
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_ratio']), (1, 1, .5))
+
+
+class ListPaginationTest(TestCase):
+    """The list page must show one page of the catalogue, newest first"""
+
+    def setUp(self):
+        Document.objects.bulk_create([Document(docfile='upload%02d.png' % (i,)) for i in range(45)])
+
+        # Same creation time for all of them: the newest ids come first
+        self.names = ['upload%02d.png' % (i,) for i in reversed(range(45))]
+
+    def _names(self, page):
+        response = self.client.get(reverse('list'), {'page': page})
+        self.assertEqual(response.status_code, 200)
+
+        documents = response.context['documents']
+        return documents, [document.docfile.name for document in documents]
+
+    def test_pages(self):
+        documents, names = self._names(1)
+        self.assertEqual(documents.paginator.num_pages, 3)
+        self.assertEqual(names, self.names[:20])
+
+        _, names = self._names(3)
+        self.assertEqual(names, self.names[40:])
+
+    def test_invalid_pages(self):
+        _, names = self._names('x')
+        self.assertEqual(names, self.names[:20])
+
+        _, names = self._names(99)
+        self.assertEqual(names, self.names[40:])
@@ -8,5 +8,7 @@ from . import views
 
 urlpatterns = [
     url(r'^$', views.index, name='index'),
-    path('list/', views.list, name='list')
-] + static('images/', document_root=os.path.join(settings.BASE_DIR, "superez", "images"))
\ No newline at end of file
+    path('list/', views.list, name='list'),
+    path('jobs/<int:job_id>/', views.job_status, name='job_status'),
+    path('jobs/metrics/', views.job_metrics, name='job_metrics')
+] + static('images/', document_root=os.path.join(settings.BASE_DIR, "superez", "images"))
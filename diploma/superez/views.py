@@ -1,33 +1,78 @@
 from django.shortcuts import render
 from django.conf import settings
+import hashlib
 import os
 import sys
+import tempfile
 sys.path.insert(0, 'D:\\wamp64\\www\\diploma\\superez')
 sys.path.insert(0, 'D:\\wamp64\\www\\diploma\\superez\\srezmodel')
-from superez.srezmodel.inference import inference
 
 
 def index(request):
     return render(request, "index.html")
 
 
-from django.shortcuts import render
+from django.shortcuts import render, get_object_or_404
 
 from django.template import RequestContext
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse
 from django.urls import reverse
+from django.core.files.move import file_move_safe
+from django.core.paginator import Paginator
 
-from superez.models import Document
+from superez import jobs
+from superez.models import Document, IMAGES_DIR
 from superez.forms import DocumentForm
 
-def handle_uploaded_file(f, path_to_save):
-    with open(path_to_save, 'wb+') as destination:
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+DOCUMENTS_PER_PAGE = 20
+
+def hash_uploaded_file(f):
+    """SHA-256 of an upload and the name it is stored under.
+
+    Reads Django's upload buffer in place, nothing is written to disk.
+    Identical uploads get the same name, different ones never collide."""
+
+    digest = hashlib.sha256()
+    for chunk in f.chunks():
+        digest.update(chunk)
+
+    extension = os.path.splitext(f.name)[1].lower()
+    if extension not in IMAGE_EXTENSIONS:
+        extension = '.jpg'
+
+    digest = digest.hexdigest()
+    return digest, digest + extension
+
+def store_uploaded_file(f, path):
+    """Writes an upload to `path`, unless an identical file is already there"""
+
+    if os.path.exists(path):
+        return
+
+    if hasattr(f, 'temporary_file_path'):
+        # Large uploads are already spooled to disk by Django, move them instead of copying
+        file_move_safe(f.temporary_file_path(), path, allow_overwrite=True)
+        os.chmod(path, 0o644)
+        return
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+    with os.fdopen(fd, 'wb') as destination:
         for chunk in f.chunks():
             destination.write(chunk)
 
-files_path = "superez/images"
+    os.chmod(temp_path, 0o644)
+    os.rename(temp_path, path)
+
+files_path = IMAGES_DIR
+
+def _wants_json(request):
+    return 'application/json' in request.META.get('HTTP_ACCEPT', '')
 
 def list(request):
+    status = 200
+
     # Handle file upload
     if request.method == 'POST':
         form = DocumentForm(request.POST, request.FILES)
@@ -35,23 +80,57 @@ def list(request):
 
             print("="*30, request.FILES["docfile"])
 
-            handle_uploaded_file(request.FILES["docfile"], os.path.join(files_path, str(request.FILES["docfile"])))
-
-            # newdoc = Document(docfile = request.FILES['docfile'])
-            # newdoc.save()
-
-            inference(os.path.join(files_path, str(request.FILES["docfile"])))
-
-            # Redirect to the document list after POST
-            return HttpResponseRedirect(reverse('list'))
+            upload = request.FILES["docfile"]
+
+            try:
+                content_hash, name = hash_uploaded_file(upload)
+                path = os.path.join(files_path, name)
+
+                # The image is restored by a background worker, or straight
+                # from the cache when it was uploaded before. The original is
+                # only written once the job is accepted
+                newdoc = jobs.submit(name, content_hash,
+                                     store=lambda: store_uploaded_file(upload, path),
+                                     size=upload.size,
+                                     width=upload.image.width,
+                                     height=upload.image.height,
+                                     tier=form.cleaned_data.get('tier') or Document.AUTO)
+            except jobs.QueueFull as e:
+                if _wants_json(request):
+                    return JsonResponse({'error': str(e)}, status=503)
+
+                form.add_error(None, "The server is busy, please try again in a few minutes.")
+                status = 503
+            else:
+                if _wants_json(request):
+                    return JsonResponse({'job': newdoc.pk,
+                                         'tier': newdoc.requested_tier,
+                                         'status_url': reverse('job_status', args=[newdoc.pk])},
+                                        status=202)
+
+                # Redirect to the document list after POST
+                return HttpResponseRedirect('%s?job=%d' % (reverse('list'), newdoc.pk))
     else:
         form = DocumentForm() # A empty, unbound form
 
-    # Load documents for the list page
-    # documents = Document.objects.all()
-    documents = [file for file in os.listdir(files_path) if os.path.isfile(os.path.join(files_path, file))]
-    print("!"*30, documents)
+    # Job submitted by the previous POST, if any
+    job = None
+    if request.GET.get('job', '').isdigit():
+        job = Document.objects.filter(pk=int(request.GET['job'])).first()
 
+    # Load one page of documents for the list page, newest first
+    documents = Document.objects.order_by('-created', '-id')
+    documents = Paginator(documents, DOCUMENTS_PER_PAGE).get_page(request.GET.get('page'))
 
     # Render list page with the documents and the form
-    return render(request, 'list.html', {'documents': documents, 'form': form})
\ No newline at end of file
+    return render(request, 'list.html', {'documents': documents, 'form': form, 'job': job}, status=status)
+
+def job_status(request, job_id):
+    document = get_object_or_404(Document, pk=job_id)
+    return JsonResponse(jobs.describe(document))
+
+def job_metrics(request):
+    metrics = jobs.queue_metrics()
+    metrics['cache'] = jobs.result_cache.stats()
+
+    return JsonResponse(metrics)